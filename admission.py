@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Control de admisión y readiness del nodo
+Decide si el nodo puede aceptar más compresiones a partir de las compresiones en curso frente a la capacidad
+de cada carril, las peticiones esperando turno, la cola asíncrona, el disco libre en las carpetas temporales y
+la tasa de fallos reciente de Ghostscript. /health/ready lo expone al balanceador y /compress rechaza con 503
+cuando el nodo supera los umbrales, para que la carga se desvíe a réplicas sanas en lugar de agotar timeouts.
+El controlador solo evalúa: app.py le pasa el estado de todos los workers, sumado a través de la base de estado.
+"""
+
+import os
+import shutil
+
+MB = 1024 * 1024
+
+
+def sum_lane_stats(workers_stats):
+    """Sumar por carril las estadísticas del planificador (FairScheduler.stats()) de varios workers"""
+    lanes = {}
+    for stats in workers_stats:
+        for name, lane in stats.items():
+            total = lanes.setdefault(name, {'running': 0, 'waiting': 0, 'clients': 0, 'concurrency': 0})
+            for key in total:
+                total[key] += lane.get(key, 0)
+    return lanes
+
+
+class AdmissionController:
+    """Umbrales de readiness del nodo"""
+
+    def __init__(self, max_waiting_per_slot=1, max_queue_percent=90, min_free_disk_mb=500,
+                 failure_window_seconds=300, failure_min_runs=10, max_failure_percent=50):
+        # Peticiones en espera admitidas en un carril lleno por cada compresión simultánea del carril
+        self.max_waiting_per_slot = max_waiting_per_slot
+        self.max_queue_percent = max_queue_percent
+        self.min_free_disk_bytes = min_free_disk_mb * MB
+        self.failure_window_seconds = failure_window_seconds
+        self.failure_min_runs = failure_min_runs
+        self.max_failure_percent = max_failure_percent
+
+    @classmethod
+    def from_config(cls, admission_config):
+        """Crear el controlador a partir de la sección admission de config.json"""
+        return cls(max_waiting_per_slot=admission_config.get('max_waiting_per_slot', 1),
+                   max_queue_percent=admission_config.get('max_queue_percent', 90),
+                   min_free_disk_mb=admission_config.get('min_free_disk_mb', 500),
+                   failure_window_seconds=admission_config.get('gs_failure_window_seconds', 300),
+                   failure_min_runs=admission_config.get('gs_failure_min_runs', 10),
+                   max_failure_percent=admission_config.get('max_gs_failure_percent', 50))
+
+    def evaluate(self, lane_stats, queued, queue_capacity, folders, ghostscript_runs, lane=None):
+        """Comprobar los umbrales; devuelve ready, los motivos por los que no lo está y el detalle de cada
+        comprobación
+
+        lane_stats son las estadísticas por carril del planificador (sumadas entre workers con
+        sum_lane_stats), queued los trabajos asíncronos encolados, folders un diccionario nombre -> carpeta cuyo
+        disco libre se vigila y ghostscript_runs (ejecuciones, fallos) de Ghostscript en los últimos
+        failure_window_seconds. Un carril está saturado con todos sus huecos ocupados y tantas peticiones
+        esperando como admite. Con lane se comprueba solo ese carril (admisión de una petición); sin él, el
+        nodo deja de estar listo cuando todos los carriles están saturados.
+        """
+        reasons = []
+        lanes = {}
+        for name, stats in lane_stats.items():
+            max_waiting = stats['concurrency'] * self.max_waiting_per_slot
+            lanes[name] = {'running': stats['running'], 'capacity': stats['concurrency'],
+                           'waiting': stats['waiting'], 'max_waiting': max_waiting,
+                           'saturated': stats['running'] >= stats['concurrency'] and stats['waiting'] >= max_waiting}
+        checked = [lanes[lane]] if lane is not None else list(lanes.values())
+        compressions_ok = not all(check['saturated'] for check in checked)
+        if not compressions_ok:
+            reasons.append('capacity')
+        running = sum(check['running'] for check in lanes.values())
+        capacity = sum(check['capacity'] for check in lanes.values())
+
+        queue_limit = queue_capacity * self.max_queue_percent / 100
+        queue_ok = queued < queue_limit
+        if not queue_ok:
+            reasons.append('queue')
+
+        disk = {}
+        for name, folder in folders.items():
+            free = shutil.disk_usage(folder).free
+            disk[name] = {'free_mb': round(free / MB, 1), 'ok': free >= self.min_free_disk_bytes}
+        if not all(check['ok'] for check in disk.values()):
+            reasons.append('disk')
+
+        runs, failures = ghostscript_runs
+        failure_percent = round(failures / runs * 100, 1) if runs else 0.0
+        # Con pocas ejecuciones la tasa no es significativa
+        ghostscript_ok = runs < self.failure_min_runs or failure_percent < self.max_failure_percent
+        if not ghostscript_ok:
+            reasons.append('ghostscript_failures')
+
+        return {
+            'ready': not reasons,
+            'reasons': reasons,
+            'checks': {
+                'compressions': {'running': running, 'capacity': capacity,
+                                 'utilization_percent': round(running / capacity * 100, 1) if capacity else 0.0,
+                                 'lanes': lanes, 'ok': compressions_ok},
+                'queue': {'queued': queued, 'capacity': queue_capacity, 'max_percent': self.max_queue_percent,
+                          'ok': queue_ok},
+                'disk': {'min_free_mb': round(self.min_free_disk_bytes / MB, 1), 'folders': disk,
+                         'ok': 'disk' not in reasons},
+                'ghostscript': {'runs': runs, 'failures': failures, 'failure_percent': failure_percent,
+                                'window_seconds': self.failure_window_seconds, 'ok': ghostscript_ok}
+            },
+            'pid': os.getpid()
+        }
@@ -1,19 +1,53 @@
+import fcntl
+import hashlib
+import hmac
 import json
+import math
 import os
-import subprocess
+import queue
+import re
+import sqlite3
+import sys
+import tempfile
 import uuid
+import zipfile
+import image_engine
+import tracing
+from admission import AdmissionController, sum_lane_stats
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
 from flask_cors import CORS
-from flask import Flask, request, jsonify, send_file
+from ghostscript_pool import GS_SUCCESS_CODES, GhostscriptCancelled, GhostscriptPool
+from pdf_analyzer import analyze_pdf
+from pdf_compression import (ENGINES, LEVEL_PDFSETTINGS, CompressionInputError, PdfCompressor, execute, file_sha256,
+                             keep_smaller_result, link_or_copy, output_size, validate_profile)
+from resource_limits import GhostscriptLimitExceeded, ResourceLimits
+from scheduler import FairScheduler, SchedulerTimeout
+from storage import StorageError, storage_from_config
+from webhooks import InvalidCallbackUrl, WebhookSender
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from flask import Flask, Request, Response, g, request, jsonify, send_file
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 import logging
 import threading
 import time
 
 # Configuración de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s')
+# El identificador de la petición en curso se añade a todos los registros
+for handler in logging.getLogger().handlers:
+    handler.addFilter(tracing.RequestIdFilter())
 logger = logging.getLogger(__name__)
 
-with open('config.json', 'r') as f:
+# PDF_COMPRESSOR_CONFIG permite arrancar con otra configuración (por ejemplo, la de las pruebas en vivo)
+CONFIG_PATH = os.environ.get('PDF_COMPRESSOR_CONFIG', 'config.json')
+with open(CONFIG_PATH, 'r') as f:
     config = json.load(f)
 
 if not config:
@@ -28,7 +62,61 @@ if not config.get('max_file_size_mb'):
 if not config.get('allowed_extensions'):
     logger.warning('\033[93mAllowed extensions are not set in config.json, using default allowed extensions [pdf]\033[0m')
 
+class StreamingUpload:
+    """Archivo en UPLOAD_FOLDER donde se escribe la subida por bloques, con hash y límite de tamaño incrementales"""
+
+    def __init__(self, max_size):
+        fd, self.name = tempfile.mkstemp(dir=UPLOAD_FOLDER, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha256 = hashlib.sha256()
+        self._persisted = False
+        self.size = 0
+        self.max_size = max_size
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def persist(self, path):
+        """Mover la subida a su ruta definitiva (sin copiar) y devolver su SHA-256"""
+        self._file.flush()
+        os.replace(self.name, path)
+        self.name = path
+        self._persisted = True
+        return self._sha256.hexdigest()
+
+    def close(self):
+        self._file.close()
+        # Una subida que no llegó a usarse (petición inválida o abortada) no deja restos
+        if not self._persisted and os.path.exists(self.name):
+            os.remove(self.name)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class StreamingRequest(Request):
+    """Request que escribe los archivos subidos directamente en UPLOAD_FOLDER"""
+
+    @property
+    def max_content_length(self):
+        # Los lotes admiten varios archivos en la misma petición
+        if self.path == '/compress/batch':
+            return BATCH_MAX_CONTENT_LENGTH
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Cada PDF respeta el tamaño máximo por archivo; un ZIP de lote, el máximo de la petición
+        if filename and filename.lower().endswith('.zip'):
+            return StreamingUpload(self.max_content_length)
+        return StreamingUpload(app.config['MAX_CONTENT_LENGTH'])
+
+
 app = Flask(__name__)
+app.request_class = StreamingRequest
 app.config['MAX_CONTENT_LENGTH'] = config.get('max_file_size_mb', 50) * 1024 * 1024  # 50MB max file size
 # redoc = Redoc(app, 'doc.yml')  # Eliminado
 cors = CORS(app, resources={r"/*":{'origins':"*"}})
@@ -36,11 +124,344 @@ cors = CORS(app, resources={r"/*":{'origins':"*"}})
 # Configuración de directorios
 UPLOAD_FOLDER = '/tmp/uploads'
 COMPRESSED_FOLDER = '/tmp/compressed'
+JOBS_FOLDER = '/tmp/jobs'
+# La caché vive dentro de COMPRESSED_FOLDER para poder servir aciertos con enlaces duros
+CACHE_FOLDER = os.path.join(COMPRESSED_FOLDER, '.cache')
+STATE_DB = '/tmp/pdf_compressor.db'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 ALLOWED_EXTENSIONS = config.get('allowed_extensions', ['pdf'])
 
+# Configuración de la cola de trabajos asíncronos
+COMPRESSION_WORKERS = config.get('compression_workers') or os.cpu_count() or 1
+JOB_QUEUE_SIZE = config.get('job_queue_size') or COMPRESSION_WORKERS * 4
+JOB_RETRY_AFTER_SECONDS = config.get('job_retry_after_seconds', 30)
+BATCH_MAX_FILES = config.get('batch_max_files', 100)
+BATCH_MAX_CONTENT_LENGTH = config.get('batch_max_size_mb', 500) * 1024 * 1024
+
+# Planificador: carriles por coste (tamaño y páginas) con su límite de compresiones simultáneas por worker
+# de Gunicorn y reparto por turnos entre clientes (X-API-Key o IP)
+SCHEDULER_CONFIG = config.get('scheduler', {})
+SCHEDULER_LANES = SCHEDULER_CONFIG.get('lanes') or [
+    {'name': 'default', 'max_size_mb': None, 'max_pages': None, 'concurrency': COMPRESSION_WORKERS}]
+SCHEDULER_MAX_WAIT_SECONDS = SCHEDULER_CONFIG.get('max_wait_seconds', 120)
+for lane_config in SCHEDULER_LANES:
+    if (not lane_config.get('name') or not isinstance(lane_config.get('concurrency'), int)
+            or lane_config['concurrency'] < 1):
+        logger.error(f'\033[91mCarril del planificador no válido en config.json: {lane_config}\033[0m')
+        exit(1)
+
+# Configuración de la compresión paralela por rangos de páginas
+PARALLEL_CONFIG = config.get('parallel_compression', {})
+PARALLEL_ENABLED = PARALLEL_CONFIG.get('enabled', True)
+PARALLEL_MIN_SIZE_BYTES = PARALLEL_CONFIG.get('min_size_mb', 10) * 1024 * 1024
+PARALLEL_CHUNK_PAGES = PARALLEL_CONFIG.get('chunk_pages', 50)
+PARALLEL_MIN_PAGES = PARALLEL_CONFIG.get('min_pages', PARALLEL_CHUNK_PAGES * 2)
+PARALLEL_WORKERS = PARALLEL_CONFIG.get('workers') or os.cpu_count() or 1
+
+# Configuración del pool de intérpretes Ghostscript persistentes
+GS_POOL_CONFIG = config.get('ghostscript_pool', {})
+GS_POOL_ENABLED = GS_POOL_CONFIG.get('enabled', True)
+GS_POOL_SIZE = GS_POOL_CONFIG.get('size') or COMPRESSION_WORKERS
+GS_POOL_MAX_JOBS = GS_POOL_CONFIG.get('max_jobs_per_worker', 200)
+GS_TIMEOUT_SECONDS = 300
+
+# Límites de recursos de cada ejecución de Ghostscript (memoria, CPU, tamaño de salida y prioridad)
+GS_LIMITS = ResourceLimits.from_config(config.get('ghostscript_limits', {}))
+
+# Perfiles de compresión con nombre definidos en config.json (se validan al arrancar)
+PROFILES_CONFIG = config.get('profiles', {})
+
+# Victorias necesarias para que el modo adaptativo confíe en el nivel aprendido de un perfil
+ADAPTIVE_MIN_WINS = config.get('adaptive_min_wins', 3)
+
+# Configuración de la caché de resultados (0 la desactiva)
+CACHE_MAX_BYTES = config.get('cache_max_size_mb', 500) * 1024 * 1024
+
+# Análisis previo: si la ganancia estimada del nivel no llega al mínimo se devuelve el original sin comprimir
+PREFLIGHT_CONFIG = config.get('preflight', {})
+PREFLIGHT_ENABLED = PREFLIGHT_CONFIG.get('enabled', True)
+PREFLIGHT_MIN_GAIN_PERCENT = PREFLIGHT_CONFIG.get('min_gain_percent', 5)
+
+# No devolver nunca un resultado mayor que el original (se puede cambiar por petición con keep_smaller)
+KEEP_SMALLER = config.get('keep_smaller', True)
+
+# Motor alternativo por imágenes (pikepdf + Pillow): se ejecuta como subproceso con los mismos límites que gs
+IMAGE_ENGINE_CONFIG = config.get('image_engine', {})
+IMAGE_ENGINE_ENABLED = IMAGE_ENGINE_CONFIG.get('enabled', True)
+IMAGE_ENGINE_WORKERS = IMAGE_ENGINE_CONFIG.get('workers') or os.cpu_count() or 1
+if IMAGE_ENGINE_ENABLED and not image_engine.available():
+    logger.warning('\033[93mImage engine disabled: pikepdf and Pillow are not installed\033[0m')
+    IMAGE_ENGINE_ENABLED = False
+
+# Descargas: rangos admitidos por petición (más se ignoran y se envía el archivo entero) y sendfile bajo Gunicorn
+DOWNLOAD_CONFIG = config.get('download', {})
+DOWNLOAD_MAX_RANGES = DOWNLOAD_CONFIG.get('max_ranges', 16)
+DOWNLOAD_SENDFILE = DOWNLOAD_CONFIG.get('sendfile', True)
+
+# Notificaciones (webhooks) a la callback_url de la petición; el secreto de la firma puede venir del entorno
+WEBHOOKS_CONFIG = config.get('webhooks', {})
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or WEBHOOKS_CONFIG.get('secret')
+if not WEBHOOK_SECRET:
+    logger.warning('\033[93mWebhook secret is not set (WEBHOOK_SECRET or webhooks.secret), callbacks will not be signed\033[0m')
+
+# Trazas: siempre activas en modo detallado (si no, solo con trace=1 o X-Trace: 1), trabajos lentos que se
+# conservan y token del endpoint de administración
+TRACING_CONFIG = config.get('tracing', {})
+TRACING_ALWAYS = TRACING_CONFIG.get('always', False)
+SLOW_JOBS_SIZE = TRACING_CONFIG.get('slow_jobs', 50)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or TRACING_CONFIG.get('admin_token')
+if not ADMIN_TOKEN:
+    logger.warning('\033[93mAdmin token is not set (ADMIN_TOKEN or tracing.admin_token), /admin endpoints are unauthenticated\033[0m')
+
+# Control de admisión: /compress responde 503 mientras el nodo supera los umbrales de readiness
+ADMISSION_CONFIG = config.get('admission', {})
+ADMISSION_ENABLED = ADMISSION_CONFIG.get('enabled', True)
+ADMISSION_RETRY_AFTER_SECONDS = ADMISSION_CONFIG.get('retry_after_seconds', 10)
+admission = AdmissionController.from_config(ADMISSION_CONFIG)
+# Cada worker publica su carga en la base de estado para que la readiness sea la del nodo y no la del worker
+# que atiende la petición; una publicación más antigua que WORKER_LOAD_STALE_SECONDS es de un worker terminado
+WORKER_LOAD_INTERVAL_SECONDS = 1
+WORKER_LOAD_STALE_SECONDS = 5
+
+# Limpieza: caducidad de resultados, cuota de disco y restos de peticiones fallidas
+CLEANUP_CONFIG = config.get('cleanup', {})
+RESULT_TTL_SECONDS = CLEANUP_CONFIG.get('result_ttl_seconds', 3600)
+RESULTS_MAX_BYTES = CLEANUP_CONFIG['max_disk_mb'] * 1024 * 1024 if CLEANUP_CONFIG.get('max_disk_mb') else None
+EVICTION_POLICY = CLEANUP_CONFIG.get('eviction', 'oldest')
+ORPHAN_MAX_AGE_SECONDS = CLEANUP_CONFIG.get('orphan_max_age_seconds', 3600)
+ORPHAN_SWEEP_INTERVAL_SECONDS = CLEANUP_CONFIG.get('orphan_sweep_interval_seconds', 3600)
+CLEANUP_LOCK_FILE = '/tmp/pdf_compressor_cleanup.lock'
+CLEANUP_LOCK_RETRY_SECONDS = 60
+# Orden de desalojo del índice de resultados según la política
+EVICTION_ORDER = {'oldest': 'created_at', 'least_downloaded': 'download_count, created_at'}
+if EVICTION_POLICY not in EVICTION_ORDER:
+    logger.error(f"\033[91mcleanup.eviction debe ser uno de: {', '.join(EVICTION_ORDER)}\033[0m")
+    exit(1)
+
 # Crear directorios si no existen
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(COMPRESSED_FOLDER, exist_ok=True)
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+
+# Almacenamiento de los resultados: carpeta local o bucket S3 compartido entre réplicas
+# (COMPRESSED_FOLDER sigue siendo el área de trabajo local de las compresiones)
+STORAGE_CONFIG = config.get('storage', {})
+try:
+    storage = storage_from_config(STORAGE_CONFIG, COMPRESSED_FOLDER)
+    if storage.shared:
+        storage.check()
+        logger.info(f"Resultados almacenados en el bucket {storage.bucket}")
+        if STORAGE_CONFIG.get('lifecycle_rule', False):
+            days = storage.ensure_lifecycle_rule(RESULT_TTL_SECONDS)
+            logger.info(f"Regla de ciclo de vida: los objetos de {storage.prefix} caducan a los {days} días")
+except StorageError as e:
+    logger.error(f"\033[91m{str(e)}\033[0m")
+    exit(1)
+# Con deduplicación los resultados del índice con el mismo hash comparten un blob y ocupan el disco una vez
+# (las filas antiguas sin hash cuentan cada una por su cuenta)
+RESULT_CONTENT_KEY = 'COALESCE(sha256, file_id)' if storage.deduplicate else 'file_id'
+
+scheduler = FairScheduler(SCHEDULER_LANES, JOB_QUEUE_SIZE)
+
+# Métricas Prometheus. Bajo Gunicorn se usa el modo multiproceso de prometheus_client
+# (PROMETHEUS_MULTIPROC_DIR) para que /metrics agregue los valores de todos los workers.
+SIZE_BUCKETS = (10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2,
+                25 * 1024 ** 2, 50 * 1024 ** 2, 100 * 1024 ** 2)
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+UPLOAD_SAVE_SECONDS = Histogram('pdf_upload_save_seconds', 'Tiempo en recibir y guardar la subida',
+                                buckets=TIME_BUCKETS)
+GHOSTSCRIPT_SECONDS = Histogram('pdf_ghostscript_seconds', 'Tiempo de compresión con Ghostscript',
+                                ['level'], buckets=TIME_BUCKETS)
+DOWNLOAD_SECONDS = Histogram('pdf_download_seconds', 'Tiempo en servir una descarga completa',
+                             buckets=TIME_BUCKETS)
+BYTES_IN = Histogram('pdf_input_bytes', 'Tamaño de los PDFs recibidos', buckets=SIZE_BUCKETS)
+BYTES_OUT = Histogram('pdf_output_bytes', 'Tamaño de los PDFs comprimidos', buckets=SIZE_BUCKETS)
+ERRORS = Counter('pdf_errors_total', 'Errores por etapa', ['stage'])
+GHOSTSCRIPT_TIMEOUTS = Counter('pdf_ghostscript_timeouts_total', 'Ejecuciones de Ghostscript que superaron el timeout')
+CLEANUP_DELETIONS = Counter('pdf_cleanup_deleted_total', 'Archivos eliminados por la limpieza', ['reason'])
+GHOSTSCRIPT_PEAK_RSS = Histogram('pdf_ghostscript_peak_rss_bytes', 'Pico de memoria residente de cada ejecución de Ghostscript',
+                                buckets=(64 * 1024 ** 2, 128 * 1024 ** 2, 256 * 1024 ** 2, 512 * 1024 ** 2,
+                                         1024 ** 3, 2 * 1024 ** 3, 4 * 1024 ** 3))
+GHOSTSCRIPT_CPU_SECONDS = Histogram('pdf_ghostscript_cpu_seconds', 'Tiempo de CPU de cada ejecución de Ghostscript',
+                                    buckets=TIME_BUCKETS)
+GHOSTSCRIPT_LIMITS = Counter('pdf_ghostscript_limit_exceeded_total', 'Ejecuciones de Ghostscript que superaron un límite',
+                             ['limit'])
+NEVER_GROW_KEPT = Counter('pdf_original_kept_total', 'Resultados sustituidos por el original por ser mayores')
+PREFLIGHT_SKIPS = Counter('pdf_preflight_skipped_total', 'Compresiones omitidas por el análisis previo', ['level'])
+ADMISSION_REJECTIONS = Counter('pdf_admission_rejected_total', 'Compresiones rechazadas con 503 por el control de admisión',
+                               ['reason'])
+WEBHOOK_DELIVERIES = Counter('pdf_webhook_deliveries_total', 'Intentos de entrega de webhooks por resultado',
+                             ['result'])
+# Hilos dedicados al envío de webhooks: las entregas y sus reintentos no ocupan workers de compresión
+webhook_sender = WebhookSender(WEBHOOK_SECRET,
+                               workers=WEBHOOKS_CONFIG.get('workers', 2),
+                               max_attempts=WEBHOOKS_CONFIG.get('max_attempts', 5),
+                               backoff_seconds=WEBHOOKS_CONFIG.get('backoff_seconds', 2),
+                               max_backoff_seconds=WEBHOOKS_CONFIG.get('max_backoff_seconds', 300),
+                               timeout_seconds=WEBHOOKS_CONFIG.get('timeout_seconds', 10),
+                               allowed_hosts=WEBHOOKS_CONFIG.get('allowed_hosts'),
+                               on_result=lambda result: WEBHOOK_DELIVERIES.labels(result=result).inc())
+COMPRESSIONS_IN_FLIGHT = Gauge('pdf_compressions_in_flight', 'Compresiones en curso',
+                               multiprocess_mode='livesum')
+
+class ServiceStateCollector:
+    """Métricas calculadas en el momento de la consulta: ocupación de disco, cola y caché"""
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        disk_usage = GaugeMetricFamily('pdf_folder_bytes', 'Bytes ocupados por carpeta', labels=['folder'])
+        for name, folder in (('uploads', UPLOAD_FOLDER), ('compressed', COMPRESSED_FOLDER), ('cache', CACHE_FOLDER)):
+            disk_usage.add_metric([name], folder_size(folder))
+        if storage.shared:
+            disk_usage.add_metric(['storage_cache'], storage.cache_size())
+        yield disk_usage
+        # Sumas de todos los workers del nodo (base de estado): cada scrape lo atiende un worker cualquiera
+        lane_stats, queued, _, webhooks_pending, _ = node_load()
+        yield GaugeMetricFamily('pdf_job_queue_depth', 'Trabajos en la cola asíncrona del nodo', value=queued)
+        running = GaugeMetricFamily('pdf_scheduler_running', 'Compresiones en curso por carril en el nodo',
+                                    labels=['lane'])
+        waiting = GaugeMetricFamily('pdf_scheduler_waiting', 'Compresiones esperando turno por carril en el nodo',
+                                    labels=['lane'])
+        for lane, stats in lane_stats.items():
+            running.add_metric([lane], stats['running'])
+            waiting.add_metric([lane], stats['waiting'])
+        yield running
+        yield waiting
+        dedup = deduplication_stats()
+        yield GaugeMetricFamily('pdf_dedup_saved_bytes', 'Bytes ahorrados por resultados con contenido idéntico',
+                                value=dedup['logical_size'] - dedup['stored_size'])
+        yield GaugeMetricFamily('pdf_webhooks_pending', 'Webhooks pendientes de enviar o reintentar en el nodo',
+                                value=webhooks_pending)
+        counters = get_counters()
+        cache = GaugeMetricFamily('pdf_cache_requests', 'Consultas a la caché de resultados', labels=['result'])
+        cache.add_metric(['hit'], counters.get('cache_hits', 0))
+        cache.add_metric(['miss'], counters.get('cache_misses', 0))
+        yield cache
+
+def folder_size(folder):
+    """Bytes ocupados por los archivos de una carpeta (sin recorrer subcarpetas)
+
+    Los enlaces duros a un mismo archivo (resultados deduplicados) se cuentan una sola vez.
+    """
+    total = 0
+    seen = set()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.inode() not in seen:
+                    seen.add(entry.inode())
+                    total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+service_state_collector = ServiceStateCollector()
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    REGISTRY.register(service_state_collector)
+
+def metrics_registry():
+    """Registro a exponer en /metrics, agregando todos los procesos si hay modo multiproceso"""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(service_state_collector)
+    return registry
+
+def db_connect():
+    """Abrir una conexión a la base de estado compartida entre workers"""
+    conn = sqlite3.connect(STATE_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_db():
+    """Crear las tablas de estado si no existen"""
+    with closing(db_connect()) as conn, conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS cache_entries (
+            key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache_entries (last_access)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS files (
+            file_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            original_size INTEGER NOT NULL,
+            compressed_size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL,
+            download_count INTEGER NOT NULL DEFAULT 0,
+            sha256 TEXT,
+            filename TEXT
+        )''')
+        # Bases creadas por versiones anteriores: añadir las columnas de caducidad y descargas
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(files)')}
+        if 'expires_at' not in columns:
+            conn.execute('ALTER TABLE files ADD COLUMN expires_at REAL')
+            conn.execute('UPDATE files SET expires_at = created_at + ?', (RESULT_TTL_SECONDS,))
+        if 'download_count' not in columns:
+            conn.execute('ALTER TABLE files ADD COLUMN download_count INTEGER NOT NULL DEFAULT 0')
+        if 'sha256' not in columns:
+            conn.execute('ALTER TABLE files ADD COLUMN sha256 TEXT')
+        if 'filename' not in columns:
+            conn.execute('ALTER TABLE files ADD COLUMN filename TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_files_created_at ON files (created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files (expires_at)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS adaptive_levels (
+            profile TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            wins INTEGER NOT NULL,
+            PRIMARY KEY (profile, level)
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS slow_jobs (
+            request_id TEXT PRIMARY KEY,
+            duration REAL NOT NULL,
+            created_at REAL NOT NULL,
+            details TEXT NOT NULL
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_slow_jobs_duration ON slow_jobs (duration)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )''')
+        # Ejecuciones recientes de Ghostscript de todos los workers (tasa de fallos de la readiness)
+        conn.execute('''CREATE TABLE IF NOT EXISTS ghostscript_runs (
+            finished_at REAL NOT NULL,
+            succeeded INTEGER NOT NULL
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ghostscript_runs_finished_at ON ghostscript_runs (finished_at)')
+        # Última carga publicada por cada worker: compresiones por carril y cola asíncrona
+        conn.execute('''CREATE TABLE IF NOT EXISTS worker_load (
+            pid INTEGER PRIMARY KEY,
+            updated_at REAL NOT NULL,
+            lanes TEXT NOT NULL,
+            queued INTEGER NOT NULL,
+            queue_capacity INTEGER NOT NULL,
+            webhooks_pending INTEGER NOT NULL DEFAULT 0
+        )''')
+        # Bases creadas por versiones anteriores: añadir los webhooks pendientes de cada worker
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(worker_load)')}
+        if 'webhooks_pending' not in columns:
+            conn.execute('ALTER TABLE worker_load ADD COLUMN webhooks_pending INTEGER NOT NULL DEFAULT 0')
+
+init_db()
+
+def increment_counter(name, amount=1):
+    """Incrementar un contador persistente"""
+    with closing(db_connect()) as conn, conn:
+        conn.execute('INSERT INTO counters (name, value) VALUES (?, ?) '
+                     'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, amount))
+
+def get_counters():
+    """Leer todos los contadores persistentes"""
+    with closing(db_connect()) as conn:
+        return {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM counters')}
 
 
 
@@ -49,39 +470,885 @@ def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def compress_pdf(input_path, output_path, level):
-    """Comprimir PDF usando Ghostscript con diferentes niveles"""
-    commands = {
-        1: [
-            'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-            '-dPDFSETTINGS=/prepress', '-dNOPAUSE', '-dQUIET', '-dBATCH',
-            '-sOutputFile=' + output_path, input_path
-        ],
-        2: [
-            'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-            '-dPDFSETTINGS=/ebook', '-dNOPAUSE', '-dQUIET', '-dBATCH',
-            '-sOutputFile=' + output_path, input_path
-        ],
-        3: [
-            'gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
-            '-dPDFSETTINGS=/screen', '-dNOPAUSE', '-dQUIET', '-dBATCH',
-            '-sOutputFile=' + output_path, input_path
-        ]
-    }
-    
-    if level not in commands:
-        raise ValueError(f"Nivel de compresión {level} no válido. Use 1, 2 o 3.")
+def build_compressor(profiles_config):
+    """Validar los perfiles de config.json y crear el compresor de la biblioteca, que construye una sola vez
+    las líneas de comandos de todos los niveles y perfiles"""
+    errors = [error for name, settings in profiles_config.items() for error in validate_profile(name, settings)]
+    if errors:
+        for error in errors:
+            logger.error(f'\033[91mPerfil no válido en config.json: {error}\033[0m')
+        exit(1)
+    return PdfCompressor(profiles_config, GS_LIMITS, GS_TIMEOUT_SECONDS, IMAGE_ENGINE_WORKERS,
+                         PREFLIGHT_MIN_GAIN_PERCENT if PREFLIGHT_ENABLED else None)
+
+# Líneas de comandos por nivel (1, 2, 3) y por perfil, claves de caché y decisión del análisis previo: las mismas
+# que usa la compresión sin servidor (bulk_compress.py)
+compressor = build_compressor(PROFILES_CONFIG)
+
+gs_pool = None
+gs_pool_lock = threading.Lock()
+
+def get_gs_pool():
+    """Crear el pool de Ghostscript la primera vez que se usa (None si no está disponible)"""
+    global gs_pool, GS_POOL_ENABLED
+    if not GS_POOL_ENABLED:
+        return None
+    with gs_pool_lock:
+        if gs_pool is None and GS_POOL_ENABLED:
+            try:
+                gs_pool = GhostscriptPool(GS_POOL_SIZE, GS_POOL_MAX_JOBS, GS_LIMITS)
+                logger.info(f"Pool de Ghostscript iniciado con {GS_POOL_SIZE} intérpretes")
+            except OSError as e:
+                logger.warning(f"\033[93mPool de Ghostscript no disponible, se usará un proceso por petición: {str(e)}\033[0m")
+                GS_POOL_ENABLED = False
+        return gs_pool
+
+def record_ghostscript_usage(command, usage):
+    """Registrar el pico de memoria y la CPU de una ejecución para ajustar los límites con datos reales"""
+    if usage.get('peak_rss_mb') is not None:
+        GHOSTSCRIPT_PEAK_RSS.observe(usage['peak_rss_mb'] * 1024 * 1024)
+    if usage.get('cpu_seconds') is not None:
+        GHOSTSCRIPT_CPU_SECONDS.observe(usage['cpu_seconds'])
+    logger.info(f"Recursos de Ghostscript: {usage['peak_rss_mb']} MB de pico, {usage['cpu_seconds']} s de CPU, "
+                f"{usage['wall_seconds']} s ({os.path.basename(command[-1])})")
+
+def check_ghostscript_limits(command, stop_signal, code, stderr, usage):
+    """Lanzar GhostscriptLimitExceeded si el fallo de una ejecución se debe a un límite de recursos"""
+    limit = GS_LIMITS.classify(stop_signal, code, stderr, usage, output_size(command))
+    if limit is not None:
+        GHOSTSCRIPT_LIMITS.labels(limit=limit).inc()
+        logger.error(f"Ghostscript superó un límite ({limit}): {usage}")
+        raise GS_LIMITS.exceeded(limit, usage)
+
+def trace_ghostscript(command, start, usage, stdout, stderr, code, stdout_marks=None, interpreter='process'):
+    """Añadir a la traza activa el tramo de una ejecución con su uso de recursos, si se ejecutó en el pool
+    de intérpretes (pool) o como proceso independiente (process) y, en modo detallado, el resumen de la salida
+    de Ghostscript con el tiempo de cada página"""
+    trace = tracing.current()
+    if trace is None:
+        return
+    if command[0] == sys.executable:
+        name, settings = 'image_engine', command[2:-2]
+    else:
+        name = 'ghostscript'
+        settings = [arg for arg in command if arg.startswith(('-dPDFSETTINGS=', '-dFirstPage=', '-dLastPage='))]
+    attributes = {'settings': settings, 'exit_code': code, 'interpreter': interpreter, **usage}
+    if trace.verbose and name == 'ghostscript':
+        attributes['output'] = tracing.parse_ghostscript_output(stdout, stderr, stdout_marks,
+                                                                usage.get('wall_seconds'))
+    trace.add_span(name, start, time.perf_counter() - start, **attributes)
+
+def run_ghostscript(command, cancel_event=None, use_pool=True):
+    """Ejecutar Ghostscript con los límites de recursos y traducir sus fallos a errores del servicio
+
+    Si cancel_event se activa, Ghostscript se detiene y se lanza GhostscriptCancelled. Si supera un límite
+    de memoria, CPU o tamaño de salida se lanza GhostscriptLimitExceeded. Con use_pool=False se ejecuta
+    siempre como proceso independiente (así se lanza también el motor por imágenes).
+
+    Para la tasa de fallos de la readiness cuentan las ejecuciones correctas y los fallos del nodo: timeouts,
+    límites superados, procesos muertos por una señal y Ghostscript ausente. Un PDF dañado o cifrado
+    (CompressionInputError) es un error del cliente y no cuenta.
+    """
+    try:
+        stdout = execute_ghostscript(command, cancel_event, use_pool)
+    except (GhostscriptCancelled, CompressionInputError):
+        raise
+    except Exception:
+        record_ghostscript_run(False)
+        raise
+    record_ghostscript_run(True)
+    return stdout
+
+def record_ghostscript_run(succeeded):
+    """Anotar en la base de estado el resultado de una ejecución de Ghostscript y olvidar las que ya salieron
+    de la ventana de la readiness"""
+    now = time.time()
+    with closing(db_connect()) as conn, conn:
+        conn.execute('INSERT INTO ghostscript_runs (finished_at, succeeded) VALUES (?, ?)', (now, int(succeeded)))
+        conn.execute('DELETE FROM ghostscript_runs WHERE finished_at < ?', (now - admission.failure_window_seconds,))
+
+def execute_ghostscript(command, cancel_event=None, use_pool=True):
+    """Ejecución de run_ghostscript, con el pool o como proceso independiente"""
+    trace = tracing.current()
+    stdout_marks = None
+    if trace is not None and trace.verbose:
+        # Sin -dQUIET Ghostscript informa de las páginas, las fuentes y los avisos; los instantes en que
+        # escribe cada línea dan el tiempo de cada página
+        command = [arg for arg in command if arg != '-dQUIET']
+        stdout_marks = []
+    start = time.perf_counter()
+    pool = get_gs_pool() if use_pool else None
+    if pool is not None:
+        try:
+            code, stdout, stderr, usage = pool.run(command, timeout=GS_TIMEOUT_SECONDS, cancel_event=cancel_event,
+                                                   stdout_marks=stdout_marks)
+        except TimeoutError:
+            GHOSTSCRIPT_TIMEOUTS.inc()
+            raise Exception("Timeout al comprimir el PDF")
+        except GhostscriptLimitExceeded as e:
+            GHOSTSCRIPT_LIMITS.labels(limit=e.limit).inc()
+            raise
+        record_ghostscript_usage(command, usage)
+        trace_ghostscript(command, start, usage, stdout, stderr, code, stdout_marks, interpreter='pool')
+        if code not in GS_SUCCESS_CODES:
+            check_ghostscript_limits(command, None, code, stderr, usage)
+            logger.error(f"Error en Ghostscript (código {code}): {stderr}")
+            # Si el worker muere, pool.run lanza OSError: un código de error es un rechazo de la entrada
+            raise CompressionInputError(f"Error al comprimir PDF: {stderr}")
+        return stdout
     
     try:
-        result = subprocess.run(commands[level], capture_output=True, text=True, timeout=300)
-        if result.returncode != 0:
-            logger.error(f"Error en Ghostscript: {result.stderr}")
-            raise Exception(f"Error al comprimir PDF: {result.stderr}")
-        return True
-    except subprocess.TimeoutExpired:
-        raise Exception("Timeout al comprimir el PDF")
+        result = execute(command, GS_LIMITS, GS_TIMEOUT_SECONDS, cancel_event, stdout_marks)
     except FileNotFoundError:
         raise Exception("Ghostscript no está instalado")
+    
+    if result['reason'] == 'cancelled':
+        raise GhostscriptCancelled()
+    if result['reason'] == 'timeout':
+        GHOSTSCRIPT_TIMEOUTS.inc()
+        raise Exception("Timeout al comprimir el PDF")
+    code, stdout, stderr, usage = result['code'], result['stdout'], result['stderr'], result['usage']
+    record_ghostscript_usage(command, usage)
+    trace_ghostscript(command, start, usage, stdout, stderr, code, stdout_marks)
+    if code != 0:
+        check_ghostscript_limits(command, result['signal'], code, stderr, usage)
+        logger.error(f"Error en Ghostscript: {stderr}")
+        if result['signal'] is not None:
+            raise Exception(f"Error al comprimir PDF (Ghostscript terminó por la señal {result['signal']}): {stderr}")
+        raise CompressionInputError(f"Error al comprimir PDF: {stderr}")
+    return stdout
+
+def count_pdf_pages(input_path):
+    """Contar las páginas de un PDF con Ghostscript (sin renderizar)
+
+    El PDF es una subida sin confianza: Ghostscript se ejecuta con -dSAFER y solo puede leer ese archivo.
+    """
+    ps_path = input_path.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    output = run_ghostscript([
+        'gs', '-q', '-dNODISPLAY', '-dSAFER', f'--permit-file-read={input_path}', '-dNOPAUSE', '-dBATCH',
+        '-c', f'({ps_path}) (r) file runpdfbegin pdfpagecount = quit'
+    ])
+    return int(output.strip().splitlines()[-1])
+
+def should_split(input_path, page_count=None):
+    """Decidir si un PDF es lo bastante grande para comprimirlo por rangos en paralelo
+
+    Las páginas se toman del análisis previo (page_count); solo si no las encontró (por ejemplo, páginas dentro
+    de flujos de objetos comprimidos) se cuentan con Ghostscript.
+    """
+    if not PARALLEL_ENABLED or PARALLEL_WORKERS < 2:
+        return 0
+    if os.path.getsize(input_path) < PARALLEL_MIN_SIZE_BYTES:
+        return 0
+    pages = page_count
+    if not pages:
+        try:
+            pages = count_pdf_pages(input_path)
+        except Exception as e:
+            logger.warning(f"No se pudo contar las páginas de {input_path}: {str(e)}")
+            return 0
+    return pages if pages >= PARALLEL_MIN_PAGES else 0
+
+def compress_pdf_parallel(input_path, output_path, level, pages, cancel_event=None, profile=None):
+    """Dividir el PDF en rangos de páginas, comprimirlos en paralelo y unirlos"""
+    ranges = [(first, min(first + PARALLEL_CHUNK_PAGES - 1, pages))
+              for first in range(1, pages + 1, PARALLEL_CHUNK_PAGES)]
+    logger.info(f"Compresión paralela: {pages} páginas en {len(ranges)} bloques con {PARALLEL_WORKERS} workers")
+
+    with tempfile.TemporaryDirectory(dir=UPLOAD_FOLDER) as chunk_dir:
+        chunk_paths = [os.path.join(chunk_dir, f"chunk_{index:05d}.pdf") for index in range(len(ranges))]
+
+        def compress_range(index):
+            first, last = ranges[index]
+            command = compressor.ghostscript_command(level, input_path, chunk_paths[index], profile)
+            # Los rangos de páginas deben ir antes del archivo de entrada
+            command[-1:-1] = [f'-dFirstPage={first}', f'-dLastPage={last}']
+            run_ghostscript(command, cancel_event)
+
+        # Cada bloque es un proceso gs independiente; los hilos solo esperan su finalización
+        with ThreadPoolExecutor(max_workers=PARALLEL_WORKERS) as executor:
+            list(executor.map(tracing.propagate(compress_range), range(len(ranges))))
+
+        # Unir los bloques con los mismos ajustes, deduplicando imágenes y sin recomprimir JPEG
+        command = compressor.ghostscript_command(level, chunk_paths[0], output_path, profile)
+        command[-1:] = ['-dDetectDuplicateImages=true', '-dPassThroughJPEGImages=true'] + chunk_paths
+        run_ghostscript(command, cancel_event)
+    return True
+
+def compress_pdf(input_path, output_path, level, cancel_event=None, profile=None, engine='gs', page_count=None):
+    """Comprimir PDF usando Ghostscript con diferentes niveles o con un perfil con nombre
+
+    Con engine='images' solo se recomprimen las imágenes con el motor por imágenes, sin pasar por Ghostscript.
+    page_count son las páginas del análisis previo, si se hizo.
+    """
+    if engine == 'images':
+        stdout = run_ghostscript(compressor.command(input_path, output_path, level, engine='images'), cancel_event,
+                                 use_pool=False)
+        try:
+            # Resumen del motor: imágenes recomprimidas, unificadas y bytes ahorrados
+            tracing.annotate(image_engine=json.loads(stdout.strip().splitlines()[-1]))
+        except (ValueError, IndexError):
+            pass
+        return True
+    
+    command = compressor.ghostscript_command(level, input_path, output_path, profile)
+    
+    pages = should_split(input_path, page_count)
+    if pages:
+        return compress_pdf_parallel(input_path, output_path, level, pages, cancel_event, profile)
+    
+    run_ghostscript(command, cancel_event)
+    return True
+
+def save_upload(file, input_path):
+    """Guardar el archivo subido por bloques calculando su SHA-256 al mismo tiempo"""
+    if isinstance(file.stream, StreamingUpload):
+        # La subida ya está en disco: basta con renombrarla
+        return file.stream.persist(input_path)
+    return save_stream(file.stream, input_path)
+
+def save_stream(stream, path, max_size=None):
+    """Copiar un stream a disco por bloques calculando su SHA-256 y aplicando un tamaño máximo"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as f:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_size and size > max_size:
+                f.close()
+                os.remove(path)
+                raise RequestEntityTooLarge()
+            sha256.update(chunk)
+            f.write(chunk)
+    return sha256.hexdigest()
+
+def cache_key(input_sha256, level, profile=None, engine='gs'):
+    """Clave de caché: hash del contenido, nivel y parámetros del motor (incluidos los del perfil de Ghostscript)"""
+    settings = compressor.settings_key(level, profile, engine)
+    return hashlib.sha256(f"{input_sha256}:{level}:{settings}".encode('utf-8')).hexdigest()
+
+def fetch_cached_result(key, output_path):
+    """Servir un resultado cacheado en output_path; devuelve False si no hay acierto"""
+    with closing(db_connect()) as conn, conn:
+        row = conn.execute('SELECT path FROM cache_entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False
+        try:
+            link_or_copy(row['path'], output_path)
+        except FileNotFoundError:
+            conn.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            return False
+        conn.execute('UPDATE cache_entries SET last_access = ? WHERE key = ?', (time.time(), key))
+    return True
+
+def store_cached_result(key, output_path):
+    """Guardar un resultado en la caché y aplicar el límite de tamaño"""
+    cache_path = os.path.join(CACHE_FOLDER, f"{key}.pdf")
+    if not os.path.exists(cache_path):
+        link_or_copy(output_path, cache_path)
+    with closing(db_connect()) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO cache_entries (key, path, size, last_access) VALUES (?, ?, ?, ?)',
+                     (key, cache_path, os.path.getsize(cache_path), time.time()))
+    evict_cache()
+
+def evict_cache():
+    """Eliminar los resultados menos usados recientemente hasta respetar el límite de tamaño"""
+    evicted_count = 0
+    with closing(db_connect()) as conn, conn:
+        total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache_entries').fetchone()[0]
+        if total_size <= CACHE_MAX_BYTES:
+            return 0
+        for row in conn.execute('SELECT key, path, size FROM cache_entries ORDER BY last_access').fetchall():
+            if total_size <= CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(row['path'])
+            except FileNotFoundError:
+                pass
+            conn.execute('DELETE FROM cache_entries WHERE key = ?', (row['key'],))
+            total_size -= row['size']
+            evicted_count += 1
+    if evicted_count > 0:
+        logger.info(f"Caché: se desalojaron {evicted_count} resultados")
+    return evicted_count
+
+def compress_with_cache(input_path, output_path, level, input_sha256=None, cancel_event=None, profile=None,
+                        engine='gs', page_count=None):
+    """Comprimir el archivo o servirlo desde la caché; devuelve True si fue un acierto de caché"""
+    key = cache_key(input_sha256, level, profile, engine) if input_sha256 and CACHE_MAX_BYTES > 0 else None
+    if key is not None and fetch_cached_result(key, output_path):
+        increment_counter('cache_hits')
+        logger.info(f"Resultado servido desde caché: {output_path}")
+        return True
+
+    if key is not None:
+        increment_counter('cache_misses')
+    try:
+        with COMPRESSIONS_IN_FLIGHT.track_inprogress(), GHOSTSCRIPT_SECONDS.labels(level=str(level)).time():
+            compress_pdf(input_path, output_path, level, cancel_event, profile, engine, page_count)
+    except (GhostscriptCancelled, GhostscriptLimitExceeded):
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    logger.info(f"PDF comprimido exitosamente: {output_path}")
+
+    # Verificar que el archivo comprimido existe
+    if not os.path.exists(output_path):
+        raise Exception('Error al generar archivo comprimido')
+
+    if key is not None:
+        store_cached_result(key, output_path)
+    return False
+
+def preflight_analysis(input_path):
+    """Analizar el PDF antes de comprimirlo; devuelve None si está desactivado o el archivo no se puede analizar"""
+    if not PREFLIGHT_ENABLED:
+        return None
+    try:
+        return analyze_pdf(input_path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"No se pudo analizar {input_path}: {str(e)}")
+        return None
+
+def apply_keep_smaller(input_path, output_path, original_size, compressed_size):
+    """Sustituir la salida por el original si la compresión no lo redujo; devuelve el ganador
+
+    El original de la subida ya no se necesita: se mueve en lugar de copiarse.
+    """
+    if keep_smaller_result(input_path, output_path, original_size, move=True) == 'compressed':
+        return 'compressed'
+    NEVER_GROW_KEPT.inc()
+    logger.info(f"La salida de Ghostscript ({compressed_size} bytes) no es menor que el original "
+                f"({original_size} bytes), se conserva el original: {output_path}")
+    return 'original'
+
+def process_compression(input_path, output_path, level, input_sha256=None, keep_smaller=None, analysis=None,
+                        profile=None, engine='gs'):
+    """Comprimir el archivo subido (o servirlo desde la caché), eliminar el original y devolver el resultado
+
+    Devuelve un diccionario con original_size, compressed_size, cached, skipped, winner, profile, engine y
+    analysis. Si el análisis previo estima una ganancia menor que PREFLIGHT_MIN_GAIN_PERCENT, el original se
+    devuelve tal cual (salvo con un perfil o con el motor por imágenes: la estimación es la de Ghostscript); con
+    keep_smaller (por defecto KEEP_SMALLER) también cuando la salida del motor no es menor.
+    """
+    keep_smaller = KEEP_SMALLER if keep_smaller is None else keep_smaller
+    if analysis is None:
+        analysis = preflight_analysis(input_path)
+    original_size = os.path.getsize(input_path)
+    skipped = analysis is not None and compressor.should_skip(input_path, level, profile, engine, analysis)
+    if skipped:
+        # El original pasa a ser el resultado: no se ejecuta Ghostscript
+        os.replace(input_path, output_path)
+        PREFLIGHT_SKIPS.labels(level=str(level)).inc()
+        logger.info(f"Compresión omitida por el análisis previo (ganancia estimada "
+                     f"{analysis['predicted_gain_percent'][str(level)]}%): {output_path}")
+        BYTES_IN.observe(original_size)
+        BYTES_OUT.observe(original_size)
+        return {'original_size': original_size, 'compressed_size': original_size, 'cached': False,
+                'skipped': True, 'winner': 'original', 'profile': profile, 'engine': engine, 'analysis': analysis}
+
+    cached = compress_with_cache(input_path, output_path, level, input_sha256, profile=profile, engine=engine,
+                                 page_count=analysis['pages'] if analysis else None)
+
+    # Obtener tamaños de archivo
+    compressed_size = os.path.getsize(output_path)
+    winner = 'compressed'
+    if keep_smaller:
+        winner = apply_keep_smaller(input_path, output_path, original_size, compressed_size)
+        compressed_size = min(compressed_size, original_size)
+    BYTES_IN.observe(original_size)
+    BYTES_OUT.observe(compressed_size)
+
+    # Limpiar archivo original
+    if winner == 'compressed':
+        os.remove(input_path)
+    return {'original_size': original_size, 'compressed_size': compressed_size, 'cached': cached,
+            'skipped': False, 'winner': winner, 'profile': profile, 'engine': engine, 'analysis': analysis}
+
+def adaptive_profile(original_size, target_bytes):
+    """Perfil de una entrada para el modo adaptativo: tamaño (log2 KB) y reducción pedida (décimas)"""
+    size_bucket = int(math.log2(max(original_size // 1024, 1)))
+    ratio_bucket = min(10, int(target_bytes / original_size * 10))
+    return f"{size_bucket}:{ratio_bucket}"
+
+def learned_level(profile):
+    """Nivel que más veces ganó para un perfil, o None si aún no hay suficientes datos"""
+    with closing(db_connect()) as conn:
+        row = conn.execute('SELECT level, wins FROM adaptive_levels WHERE profile = ? ORDER BY wins DESC LIMIT 1',
+                           (profile,)).fetchone()
+    if row is None or row['wins'] < ADAPTIVE_MIN_WINS:
+        return None
+    return row['level']
+
+def record_adaptive_win(profile, level):
+    """Registrar qué nivel ganó para un perfil"""
+    with closing(db_connect()) as conn, conn:
+        conn.execute('INSERT INTO adaptive_levels (profile, level, wins) VALUES (?, ?, 1) '
+                     'ON CONFLICT(profile, level) DO UPDATE SET wins = wins + 1', (profile, level))
+
+def compress_to_target(input_path, file_id, original_filename, target_bytes, input_sha256=None, keep_smaller=None):
+    """Comprimir con varios niveles y quedarse con el de mayor calidad bajo target_bytes
+
+    Los niveles se prueban de uno en uno dentro del turno del planificador que tiene la petición, así que el
+    modo adaptativo no ejecuta más Ghostscript a la vez que la concurrencia de su carril. Sin nivel aprendido
+    se prueban de más a menos calidad hasta que uno cumple. Si el perfil de la entrada ya tiene un nivel
+    ganador aprendido se empieza por él: si cumple se prueban los de más calidad mientras sigan cumpliendo,
+    y si no, los de menos calidad hasta que uno cumpla.
+    """
+    original_size = os.path.getsize(input_path)
+    profile = adaptive_profile(original_size, target_bytes)
+    learned = learned_level(profile)
+    output_paths = {level: os.path.join(COMPRESSED_FOLDER, f"{file_id}_compressed_level_{level}_{original_filename}")
+                    for level in (1, 2, 3)}
+    outcomes = {}
+
+    def run_candidate(level):
+        try:
+            cached = compress_with_cache(input_path, output_paths[level], level, input_sha256)
+            outcomes[level] = {'status': 'done', 'size': os.path.getsize(output_paths[level]), 'cached': cached}
+        except Exception as e:
+            logger.error(f"Error en candidato de nivel {level}: {str(e)}")
+            outcomes[level] = {'status': 'failed', 'error': str(e)}
+
+    def meets_target(level):
+        return outcomes.get(level, {}).get('status') == 'done' and outcomes[level]['size'] <= target_bytes
+
+    def try_levels(levels, stop_when_met):
+        """Probar los niveles en orden hasta que uno cumpla (stop_when_met) o deje de cumplir el objetivo"""
+        for level in levels:
+            run_candidate(level)
+            if meets_target(level) == stop_when_met:
+                return
+
+    if learned is None:
+        try_levels((1, 2, 3), stop_when_met=True)
+    else:
+        run_candidate(learned)
+        if meets_target(learned):
+            try_levels(range(learned - 1, 0, -1), stop_when_met=False)
+        else:
+            try_levels(range(learned + 1, 4), stop_when_met=True)
+
+    winners = [level for level in sorted(outcomes) if meets_target(level)]
+    if winners:
+        chosen = winners[0]
+        record_adaptive_win(profile, chosen)
+    else:
+        finished = [level for level in outcomes if outcomes[level]['status'] == 'done']
+        if not finished:
+            raise Exception('Ningún nivel de compresión terminó correctamente')
+        chosen = min(finished, key=lambda level: outcomes[level]['size'])
+
+    # Conservar solo la salida elegida
+    for level, path in output_paths.items():
+        if level != chosen and os.path.exists(path):
+            os.remove(path)
+
+    compressed_size = outcomes[chosen]['size']
+    winner = 'compressed'
+    if KEEP_SMALLER if keep_smaller is None else keep_smaller:
+        winner = apply_keep_smaller(input_path, output_paths[chosen], original_size, compressed_size)
+        compressed_size = min(compressed_size, original_size)
+    BYTES_IN.observe(original_size)
+    BYTES_OUT.observe(compressed_size)
+    if winner == 'compressed':
+        os.remove(input_path)
+    logger.info(f"Modo adaptativo: nivel {chosen} elegido para el perfil {profile} "
+                f"({'cumple' if winners else 'no cumple'} el objetivo)")
+    return {
+        'level': chosen,
+        'output_path': output_paths[chosen],
+        'original_size': original_size,
+        'compressed_size': compressed_size,
+        'cached': outcomes[chosen]['cached'],
+        'winner': winner,
+        'target_met': bool(winners),
+        'candidates': [{'level': level, 'status': outcomes[level]['status'],
+                        'compressed_size_mb': round(outcomes[level]['size'] / (1024 * 1024), 2)
+                        if 'size' in outcomes[level] else None}
+                       for level in sorted(outcomes)]
+    }
+
+def register_result(file_id, output_path, level, original_size, compressed_size):
+    """Guardar un resultado en el almacenamiento y registrarlo en el índice file_id -> ubicación usado por
+    /download y por la limpieza
+
+    El hash del contenido se guarda para servir un ETag fuerte sin volver a leer el archivo. Los mismos datos
+    acompañan al objeto en el almacenamiento compartido para que otra réplica pueda servirlo.
+    """
+    content_sha256 = file_sha256(output_path)
+    now = time.time()
+    metadata = {'filename': os.path.basename(output_path), 'level': level, 'original_size': original_size,
+                'compressed_size': compressed_size, 'created_at': now, 'expires_at': now + RESULT_TTL_SECONDS,
+                'sha256': content_sha256}
+    location = storage.put(file_id, output_path, metadata)
+    with closing(db_connect()) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO files (file_id, path, level, original_size, compressed_size, created_at, '
+                     'expires_at, sha256, filename) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (file_id, location, level, original_size, compressed_size, now, now + RESULT_TTL_SECONDS,
+                      content_sha256, metadata['filename']))
+    # La cuota se comprueba al registrar para que el disco no se llene entre limpiezas
+    enforce_disk_quota(keep_file_id=file_id)
+
+def lookup_result(file_id):
+    """Buscar un resultado en el índice, o None si no existe"""
+    with closing(db_connect()) as conn:
+        return conn.execute('SELECT * FROM files WHERE file_id = ?', (file_id,)).fetchone()
+
+def find_result(file_id):
+    """Buscar un resultado en el índice local o, con almacenamiento compartido, entre los de otras réplicas
+
+    Devuelve (datos del resultado, True si está en el índice local) o (None, False).
+    """
+    result = lookup_result(file_id)
+    if result is not None:
+        return dict(result), True
+    if storage.shared:
+        return storage.head(file_id), False
+    return None, False
+
+def deduplication_stats():
+    """Tamaño de los resultados indexados tal como se sirven (lógico) y tal como ocupan el disco (almacenado)"""
+    with closing(db_connect()) as conn:
+        row = conn.execute(f'SELECT COUNT(*) AS contents, COALESCE(SUM(refs), 0) AS results, '
+                           f'COALESCE(SUM(CASE WHEN refs > 1 THEN 1 ELSE 0 END), 0) AS shared, '
+                           f'COALESCE(SUM(size * refs), 0) AS logical_size, COALESCE(SUM(size), 0) AS stored_size '
+                           f'FROM (SELECT COUNT(*) AS refs, MAX(compressed_size) AS size FROM files '
+                           f'GROUP BY {RESULT_CONTENT_KEY})').fetchone()
+    return dict(row)
+
+def record_download(file_id):
+    """Contar una descarga de un resultado (política de desalojo least_downloaded)"""
+    with closing(db_connect()) as conn, conn:
+        conn.execute('UPDATE files SET download_count = download_count + 1 WHERE file_id = ?', (file_id,))
+
+def forget_result(file_id):
+    """Eliminar un resultado del índice"""
+    with closing(db_connect()) as conn, conn:
+        conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+
+def build_compression_result(file_id, original_filename, output_filename, level, outcome):
+    """Construir la respuesta con los tamaños, el ratio de compresión y el análisis previo"""
+    original_size = outcome['original_size']
+    compressed_size = outcome['compressed_size']
+    compression_ratio = ((original_size - compressed_size) / original_size) * 100
+    setting = f"perfil {outcome['profile']}" if outcome.get('profile') else f'nivel {level}'
+    if outcome.get('engine') == 'images':
+        setting += ' (motor de imágenes)'
+    if outcome.get('skipped'):
+        message = f'Compresión con {setting} omitida: la ganancia estimada es insignificante'
+    elif outcome.get('winner') == 'original':
+        message = f'La compresión con {setting} no redujo el tamaño, se conserva el original'
+    else:
+        message = f'PDF comprimido exitosamente con {setting}'
+    return {
+        'success': True,
+        'message': message,
+        'original_filename': original_filename,
+        'compressed_filename': output_filename,
+        'original_size_mb': round(original_size / (1024 * 1024), 2),
+        'compressed_size_mb': round(compressed_size / (1024 * 1024), 2),
+        'compression_ratio_percent': round(compression_ratio, 2),
+        'cached': outcome.get('cached', False),
+        'skipped': outcome.get('skipped', False),
+        'winner': outcome.get('winner', 'compressed'),
+        'profile': outcome.get('profile'),
+        'engine': outcome.get('engine', 'gs'),
+        'analysis': outcome.get('analysis'),
+        'file_id': file_id
+    }
+
+def parse_compression_level():
+    """Leer el nivel de compresión del formulario; devuelve (nivel, mensaje de error)"""
+    level = request.form.get('level', '1')
+    try:
+        level = int(level)
+        if level not in [1, 2, 3]:
+            return None, 'Nivel debe ser 1, 2 o 3'
+    except ValueError:
+        return None, 'Nivel debe ser un número entero'
+    return level, None
+
+def is_truthy(value):
+    """Interpretar parámetros tipo bandera (1, true, yes, on)"""
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def client_key():
+    """Cliente para el reparto equitativo: hash de la API key (X-API-Key) o, si no hay, la IP"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return f"key:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]}"
+    return f"ip:{request.remote_addr}"
+
+def estimate_lane(input_path):
+    """Carril del planificador según el tamaño y las páginas de la subida; devuelve (carril, análisis previo)"""
+    analysis = preflight_analysis(input_path)
+    pages = analysis['pages'] if analysis else None
+    return scheduler.lane_for(os.path.getsize(input_path), pages), analysis
+
+def busy_response():
+    """Respuesta 429 con Retry-After cuando no hay capacidad para la petición"""
+    response = jsonify({'error': 'El servicio está ocupado, intente más tarde'})
+    response.headers['Retry-After'] = str(JOB_RETRY_AFTER_SECONDS)
+    return response, 429
+
+def publish_worker_load(conn):
+    """Guardar la carga actual de este worker (compresiones por carril, cola asíncrona y webhooks pendientes)
+    en la base de estado"""
+    conn.execute('INSERT OR REPLACE INTO worker_load (pid, updated_at, lanes, queued, queue_capacity, '
+                 'webhooks_pending) VALUES (?, ?, ?, ?, ?, ?)',
+                 (os.getpid(), time.time(), json.dumps(scheduler.stats()), scheduler.qsize(), JOB_QUEUE_SIZE,
+                  webhook_sender.pending()))
+
+def node_load():
+    """Carga del nodo: la de este worker al momento y la última publicada por los demás
+
+    Devuelve (estadísticas por carril sumadas, trabajos encolados, capacidad de la cola, webhooks pendientes,
+    workers). Las publicaciones de workers que ya no la renuevan se descartan.
+    """
+    now = time.time()
+    with closing(db_connect()) as conn, conn:
+        publish_worker_load(conn)
+        conn.execute('DELETE FROM worker_load WHERE updated_at < ?', (now - WORKER_LOAD_STALE_SECONDS,))
+        rows = conn.execute('SELECT lanes, queued, queue_capacity, webhooks_pending FROM worker_load').fetchall()
+    return (sum_lane_stats(json.loads(row['lanes']) for row in rows), sum(row['queued'] for row in rows),
+            sum(row['queue_capacity'] for row in rows), sum(row['webhooks_pending'] for row in rows), len(rows))
+
+def ghostscript_runs():
+    """(ejecuciones, fallos) de Ghostscript de todos los workers dentro de la ventana de la readiness"""
+    with closing(db_connect()) as conn:
+        runs, failures = conn.execute('SELECT COUNT(*), COALESCE(SUM(1 - succeeded), 0) FROM ghostscript_runs '
+                                      'WHERE finished_at >= ?',
+                                      (time.time() - admission.failure_window_seconds,)).fetchone()
+    return runs, failures
+
+def readiness(lane=None):
+    """Comprobaciones de readiness del nodo: capacidad, cola, disco libre y fallos recientes de Ghostscript
+    (con lane, la capacidad solo de ese carril), sumando la carga de todos los workers"""
+    lane_stats, queued, queue_capacity, _, workers = node_load()
+    state = admission.evaluate(lane_stats, queued, queue_capacity,
+                               {'uploads': UPLOAD_FOLDER, 'compressed': COMPRESSED_FOLDER, 'jobs': JOBS_FOLDER},
+                               ghostscript_runs(), lane)
+    state['workers'] = workers
+    return state
+
+def publish_worker_load_periodically():
+    """Renovar la carga publicada de este worker aunque no reciba peticiones"""
+    while True:
+        try:
+            with closing(db_connect()) as conn, conn:
+                publish_worker_load(conn)
+        except Exception as e:
+            logger.warning(f"No se pudo publicar la carga del worker: {str(e)}")
+        time.sleep(WORKER_LOAD_INTERVAL_SECONDS)
+
+def admission_response():
+    """Respuesta 503 con Retry-After si el nodo supera sus umbrales, o None si se admite la petición
+
+    Se comprueba antes de leer la subida: el rechazo es inmediato y el balanceador puede reintentar en otra réplica.
+    El carril se estima con Content-Length (las páginas aún no se conocen); un lote comprueba todos los carriles.
+    """
+    if not ADMISSION_ENABLED:
+        return None
+    lane = scheduler.lane_for(request.content_length or 0) if request.endpoint == 'compress_pdf_endpoint' else None
+    state = readiness(lane)
+    if state['ready']:
+        return None
+    for reason in state['reasons']:
+        ADMISSION_REJECTIONS.labels(reason=reason).inc()
+    logger.warning(f"Nodo saturado ({', '.join(state['reasons'])}), rechazando solicitud")
+    response = jsonify({'error': 'El servicio está saturado, intente más tarde', 'reasons': state['reasons']})
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER_SECONDS)
+    return response, 503
+
+def parse_profile():
+    """Leer el perfil de compresión de la petición; devuelve (perfil o None, mensaje de error)"""
+    profile = request.args.get('profile', request.form.get('profile'))
+    if profile is None or profile == '':
+        return None, None
+    if profile not in PROFILES_CONFIG:
+        return None, f"Perfil desconocido: {profile}. Disponibles: {', '.join(sorted(PROFILES_CONFIG)) or 'ninguno'}"
+    return profile, None
+
+def parse_engine():
+    """Leer el motor de compresión de la petición (gs por defecto); devuelve (motor, mensaje de error)"""
+    engine = request.args.get('engine', request.form.get('engine')) or 'gs'
+    if engine not in ENGINES:
+        return None, f"Motor desconocido: {engine}. Disponibles: {', '.join(ENGINES)}"
+    if engine == 'images' and not IMAGE_ENGINE_ENABLED:
+        return None, 'El motor de imágenes no está disponible en este servidor'
+    return engine, None
+
+def output_name(level, profile, filename):
+    """Nombre del archivo comprimido según el nivel o el perfil"""
+    return f"compressed_{profile}_{filename}" if profile else f"compressed_level_{level}_{filename}"
+
+def parse_keep_smaller():
+    """Leer keep_smaller de la petición; si no se indica se usa la configuración"""
+    value = request.args.get('keep_smaller', request.form.get('keep_smaller'))
+    return KEEP_SMALLER if value is None else is_truthy(value)
+
+def parse_callback_url():
+    """Leer la callback_url de la petición; devuelve (URL o None, mensaje de error)"""
+    callback_url = request.args.get('callback_url', request.form.get('callback_url'))
+    if not callback_url:
+        return None, None
+    try:
+        webhook_sender.validate_url(callback_url)
+    except InvalidCallbackUrl as e:
+        return None, str(e)
+    return callback_url, None
+
+def notify_callback(callback_url, file_id, result=None, error=None):
+    """Programar la notificación a callback_url con el resultado o el error de una compresión"""
+    if not callback_url:
+        return
+    if error is None:
+        payload = {'event': 'compression.completed', **result, 'download_path': f'/download/{file_id}'}
+    else:
+        payload = {'event': 'compression.failed', 'success': False, 'file_id': file_id, 'error': str(error)}
+        if isinstance(error, GhostscriptLimitExceeded):
+            payload.update(error.details())
+    webhook_sender.enqueue(file_id, callback_url, payload)
+
+def pdf_characteristics(analysis):
+    """Datos del análisis previo que explican el coste de una compresión"""
+    if analysis is None:
+        return None
+    return {key: analysis[key] for key in ('pages', 'images', 'image_bytes', 'max_image_dpi', 'median_image_dpi',
+                                           'fonts', 'filters', 'uncompressed_stream_bytes')}
+
+def record_slow_job(trace, status):
+    """Guardar la traza si está entre las SLOW_JOBS_SIZE más lentas (tabla compartida por los workers)"""
+    if not SLOW_JOBS_SIZE:
+        return
+    duration = trace.elapsed()
+    with closing(db_connect()) as conn, conn:
+        count, fastest = conn.execute('SELECT COUNT(*), MIN(duration) FROM slow_jobs').fetchone()
+        # Con la tabla llena, una traza más rápida que todas las guardadas no entra
+        if count >= SLOW_JOBS_SIZE and duration <= fastest:
+            return
+        details = {**trace.to_dict(), 'status': status, 'created_at': trace.started_at}
+        conn.execute('INSERT OR REPLACE INTO slow_jobs (request_id, duration, created_at, details) VALUES (?, ?, ?, ?)',
+                     (trace.request_id, duration, trace.started_at, json.dumps(details)))
+        conn.execute('DELETE FROM slow_jobs WHERE request_id NOT IN '
+                     '(SELECT request_id FROM slow_jobs ORDER BY duration DESC LIMIT ?)', (SLOW_JOBS_SIZE,))
+
+def job_state_path(job_id):
+    """Ruta del archivo de estado de un trabajo"""
+    return os.path.join(JOBS_FOLDER, f"{secure_filename(job_id)}.json")
+
+def save_job_state(job_id, state):
+    """Guardar el estado de un trabajo en disco para que cualquier worker de Gunicorn pueda consultarlo"""
+    state['updated_at'] = time.time()
+    path = job_state_path(job_id)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def load_job_state(job_id):
+    """Leer el estado de un trabajo, o None si no existe"""
+    try:
+        with open(job_state_path(job_id), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def run_compression_job(job):
+    """Ejecutar un trabajo encolado y registrar su resultado"""
+    # El trabajo conserva el identificador de la petición que lo encoló
+    trace = tracing.Trace(job['request_id'], job['trace'])
+    with tracing.activate(trace):
+        run_traced_compression_job(job, trace)
+
+def run_traced_compression_job(job, trace):
+    job_id = job['job_id']
+    state = {'job_id': job_id, 'status': 'running', 'level': job['level'], 'created_at': job['created_at']}
+    save_job_state(job_id, state)
+    trace.annotate(job_id=job_id, level=job['level'], profile=job['profile'], engine=job['engine'],
+                   queued_ms=round((time.time() - job['created_at']) * 1000, 1),
+                   input_bytes=os.path.getsize(job['input_path']), pdf=pdf_characteristics(job['analysis']))
+    result, error = None, None
+    try:
+        with tracing.span('compression'):
+            outcome = process_compression(job['input_path'], job['output_path'], job['level'], job['input_sha256'],
+                                          job['keep_smaller'], job['analysis'], job['profile'], job['engine'])
+        with tracing.span('store'):
+            register_result(job_id, job['output_path'], job['level'], outcome['original_size'],
+                            outcome['compressed_size'])
+        result = build_compression_result(job_id, job['original_filename'], job['output_filename'],
+                                          job['level'], outcome)
+        trace.annotate(compressed_bytes=outcome['compressed_size'], cached=outcome['cached'],
+                       skipped=outcome['skipped'])
+        state.update(result)
+        state['status'] = 'done'
+    except Exception as e:
+        ERRORS.labels(stage='async').inc()
+        logger.error(f"Error en trabajo {job_id}: {str(e)}")
+        error = e
+        state.update({'status': 'failed', 'error': str(e)})
+        if isinstance(e, GhostscriptLimitExceeded):
+            state.update(e.details())
+        if os.path.exists(job['input_path']):
+            os.remove(job['input_path'])
+    if trace.verbose:
+        state['trace'] = trace.to_dict()
+    save_job_state(job_id, state)
+    record_slow_job(trace, state['status'])
+    # Después de guardar el estado, para que el destinatario ya lo vea actualizado en /jobs
+    notify_callback(job['callback_url'], job_id, result, error)
+
+def compression_worker():
+    """Worker que consume la cola de trabajos de compresión"""
+    while True:
+        ticket = scheduler.next_task()
+        try:
+            ticket.task()
+        except Exception as e:
+            logger.error(f"Error inesperado en worker de compresión: {str(e)}")
+        finally:
+            scheduler.release(ticket.lane)
+
+@app.before_request
+def start_trace():
+    """Asignar el identificador de la petición (X-Request-ID) y empezar su traza
+
+    La traza es detallada (salida de Ghostscript y tramos en la respuesta) con trace=1 en la URL, la cabecera
+    X-Trace: 1 o tracing.always.
+    """
+    verbose = TRACING_ALWAYS or is_truthy(request.args.get('trace', request.headers.get('X-Trace', '0')))
+    g.trace = tracing.Trace(tracing.new_request_id(request.headers.get('X-Request-ID')), verbose)
+    g.trace_token = tracing.start(g.trace)
+
+@app.after_request
+def finish_trace(response):
+    """Devolver el identificador de la petición y guardar la traza de las compresiones síncronas"""
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    response.headers['X-Request-ID'] = trace.request_id
+    # Solo las peticiones que llegaron a comprimir; los trabajos encolados (202) guardan su propia traza
+    if 'level' in trace.attributes and response.status_code != 202:
+        trace.annotate(http_status=response.status_code)
+        record_slow_job(trace, 'done' if response.status_code < 400 else 'failed')
+        if trace.verbose:
+            logger.info(f"Traza: {json.dumps(trace.to_dict(), ensure_ascii=False)}")
+    return response
+
+@app.teardown_request
+def stop_trace(error=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        tracing.stop(token)
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    """Responder en JSON cuando la subida supera el tamaño máximo"""
+    return jsonify({'error': f'El archivo supera el tamaño máximo de {config.get("max_file_size_mb", 50)}MB'}), 413
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -92,10 +1359,29 @@ def health_check():
         'version': '1.0.0'
     })
 
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness: el proceso responde (no depende de la carga; un nodo saturado sigue vivo)"""
+    return jsonify({'status': 'alive', 'pid': os.getpid()})
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: 503 mientras el nodo supera los umbrales de admisión, para que el balanceador lo saque"""
+    state = readiness()
+    return jsonify({'status': 'ready' if state['ready'] else 'not_ready', **state}), 200 if state['ready'] else 503
+
 @app.route('/compress', methods=['POST'])
 def compress_pdf_endpoint():
     """Endpoint para comprimir un archivo PDF"""
+    upload_start = time.perf_counter()
+    callback_url = None
+    file_id = None
     try:
+        # Control de admisión antes de leer la subida
+        rejection = admission_response()
+        if rejection is not None:
+            return rejection
+        
         # Verificar si se envió un archivo
         if 'file' not in request.files:
             return jsonify({'error': 'No se proporcionó ningún archivo'}), 400
@@ -108,118 +1394,880 @@ def compress_pdf_endpoint():
         if not allowed_file(file.filename):
             return jsonify({'error': 'Solo se permiten archivos PDF'}), 400
         
-        # Obtener nivel de compresión
-        level = request.form.get('level', '1')
-        try:
-            level = int(level)
-            if level not in [1, 2, 3]:
-                return jsonify({'error': 'Nivel debe ser 1, 2 o 3'}), 400
-        except ValueError:
-            return jsonify({'error': 'Nivel debe ser un número entero'}), 400
+        # Obtener nivel de compresión o perfil (el perfil fija su propio nivel base)
+        level, error = parse_compression_level()
+        if error:
+            return jsonify({'error': error}), 400
+        profile, error = parse_profile()
+        if error:
+            return jsonify({'error': error}), 400
+        if profile:
+            level = compressor.level(level, profile)
+        engine, error = parse_engine()
+        if error:
+            return jsonify({'error': error}), 400
+        if engine != 'gs' and profile:
+            return jsonify({'error': 'Los perfiles solo se aplican con el motor gs'}), 400
         
         # Generar nombres únicos para los archivos
         original_filename = secure_filename(file.filename)
         file_id = str(uuid.uuid4())
         input_path = os.path.join(UPLOAD_FOLDER, f"{file_id}_{original_filename}")
-        output_filename = f"compressed_level_{level}_{original_filename}"
+        output_filename = output_name(level, profile, original_filename)
         output_path = os.path.join(COMPRESSED_FOLDER, f"{file_id}_{output_filename}")
         
-        # Guardar archivo original
-        file.save(input_path)
+        async_mode = is_truthy(request.args.get('async', request.form.get('async', '0')))
+        stream_mode = is_truthy(request.args.get('stream', request.form.get('stream', '0')))
+        keep_smaller = parse_keep_smaller()
+        if async_mode and stream_mode:
+            return jsonify({'error': 'Los modos async y stream no se pueden combinar'}), 400
+        callback_url, error = parse_callback_url()
+        if error:
+            return jsonify({'error': error}), 400
+        if callback_url and stream_mode:
+            return jsonify({'error': 'callback_url no se puede combinar con el modo stream'}), 400
+        
+        # Tamaño objetivo opcional: se elige automáticamente el nivel
+        target_size_mb = request.form.get('target_size_mb')
+        if target_size_mb is not None:
+            try:
+                target_size_mb = float(target_size_mb)
+                if target_size_mb <= 0:
+                    raise ValueError()
+            except ValueError:
+                return jsonify({'error': 'target_size_mb debe ser un número positivo'}), 400
+            if async_mode:
+                return jsonify({'error': 'target_size_mb no se puede combinar con el modo async'}), 400
+            if profile:
+                return jsonify({'error': 'target_size_mb no se puede combinar con un perfil'}), 400
+            if engine != 'gs':
+                return jsonify({'error': 'target_size_mb solo se admite con el motor gs'}), 400
+        
+        # Guardar archivo original calculando su hash para la caché
+        input_sha256 = save_upload(file, input_path)
+        UPLOAD_SAVE_SECONDS.observe(time.perf_counter() - upload_start)
+        tracing.record_span('upload', upload_start, bytes=os.path.getsize(input_path))
         logger.info(f"Archivo guardado: {input_path}")
         
-        # Comprimir PDF
-        compress_pdf(input_path, output_path, level)
-        logger.info(f"PDF comprimido exitosamente: {output_path}")
+        # Carril según el coste estimado y cliente para el reparto equitativo
+        with tracing.span('preflight'):
+            lane, analysis = estimate_lane(input_path)
+        client = client_key()
+        tracing.annotate(file_id=file_id, level=level, profile=profile, engine=engine, lane=lane,
+                         input_bytes=os.path.getsize(input_path), pdf=pdf_characteristics(analysis))
         
-        # Verificar que el archivo comprimido existe
-        if not os.path.exists(output_path):
-            return jsonify({'error': 'Error al generar archivo comprimido'}), 500
+        # Modo asíncrono: encolar el trabajo y responder de inmediato
+        if async_mode:
+            return enqueue_compression_job(file_id, input_path, output_path, level, original_filename,
+                                           output_filename, input_sha256, keep_smaller, client, lane, analysis,
+                                           profile, callback_url, engine)
         
-        # Obtener tamaños de archivo
-        original_size = os.path.getsize(input_path)
-        compressed_size = os.path.getsize(output_path)
-        compression_ratio = ((original_size - compressed_size) / original_size) * 100
+        wait_start = time.perf_counter()
+        try:
+            with scheduler.slot(client, lane, SCHEDULER_MAX_WAIT_SECONDS):
+                tracing.record_span('queue_wait', wait_start, lane=lane)
+                # Modo adaptativo: el nivel de más calidad que cumpla el tamaño objetivo
+                if target_size_mb is not None:
+                    return compress_to_target_response(file_id, input_path, original_filename, target_size_mb,
+                                                       input_sha256, stream_mode, keep_smaller, callback_url)
+                
+                # Comprimir PDF
+                with tracing.span('compression'):
+                    outcome = process_compression(input_path, output_path, level, input_sha256, keep_smaller,
+                                                  analysis, profile, engine)
+                tracing.annotate(compressed_bytes=outcome['compressed_size'], cached=outcome['cached'],
+                                 skipped=outcome['skipped'])
+        except SchedulerTimeout as e:
+            logger.warning(f"{str(e)}, rechazando solicitud")
+            os.remove(input_path)
+            return busy_response()
         
-        # Limpiar archivo original
-        os.remove(input_path)
+        # Modo stream: devolver el PDF comprimido en la misma respuesta sin dejarlo en disco
+        if stream_mode:
+            return stream_compressed_file(output_path, output_filename, outcome)
         
-        return jsonify({
-            'success': True,
-            'message': f'PDF comprimido exitosamente con nivel {level}',
-            'original_filename': original_filename,
-            'compressed_filename': output_filename,
+        with tracing.span('store'):
+            register_result(file_id, output_path, level, outcome['original_size'], outcome['compressed_size'])
+        
+        result = build_compression_result(file_id, original_filename, output_filename, level, outcome)
+        notify_callback(callback_url, file_id, result)
+        if g.trace.verbose:
+            result['trace'] = g.trace.to_dict()
+        return jsonify(result)
+        
+    except RequestEntityTooLarge:
+        raise
+    except GhostscriptLimitExceeded as e:
+        ERRORS.labels(stage='compress').inc()
+        logger.error(f"Error en compresión: {str(e)}")
+        if callback_url and file_id:
+            notify_callback(callback_url, file_id, error=e)
+        return jsonify({'error': f'Error al procesar el archivo: {str(e)}', **e.details()}), 422
+    except Exception as e:
+        ERRORS.labels(stage='compress').inc()
+        logger.error(f"Error en compresión: {str(e)}")
+        if callback_url and file_id:
+            notify_callback(callback_url, file_id, error=e)
+        return jsonify({'error': f'Error al procesar el archivo: {str(e)}'}), 500
+
+def compress_to_target_response(file_id, input_path, original_filename, target_size_mb, input_sha256, stream_mode,
+                                keep_smaller, callback_url=None):
+    """Responder a una petición con target_size_mb"""
+    result = compress_to_target(input_path, file_id, original_filename, int(target_size_mb * 1024 * 1024),
+                                input_sha256, keep_smaller)
+    level = result['level']
+    output_filename = f"compressed_level_{level}_{original_filename}"
+    if stream_mode:
+        return stream_compressed_file(result['output_path'], output_filename, result)
+    
+    register_result(file_id, result['output_path'], level, result['original_size'], result['compressed_size'])
+    response = build_compression_result(file_id, original_filename, output_filename, level, result)
+    response.update({
+        'level': level,
+        'target_size_mb': target_size_mb,
+        'target_met': result['target_met'],
+        'candidates': result['candidates']
+    })
+    notify_callback(callback_url, file_id, response)
+    return jsonify(response)
+
+def stream_compressed_file(output_path, output_filename, outcome):
+    """Responder con el contenido del PDF comprimido y eliminarlo del disco"""
+    original_size = outcome['original_size']
+    compressed_size = outcome['compressed_size']
+    compressed_file = open(output_path, 'rb')
+    # El archivo ya abierto sigue siendo legible tras eliminarlo, así no quedan restos aunque el cliente se desconecte
+    os.remove(output_path)
+    compression_ratio = ((original_size - compressed_size) / original_size) * 100
+    response = Response(wrap_file(request.environ, compressed_file, UPLOAD_CHUNK_SIZE),
+                        mimetype='application/pdf', direct_passthrough=True)
+    response.headers['Content-Length'] = str(compressed_size)
+    response.headers['Content-Disposition'] = f'attachment; filename="{output_filename}"'
+    response.headers['X-Original-Size'] = str(original_size)
+    response.headers['X-Compressed-Size'] = str(compressed_size)
+    response.headers['X-Compression-Ratio-Percent'] = str(round(compression_ratio, 2))
+    response.headers['X-Cached'] = str(outcome.get('cached', False)).lower()
+    response.headers['X-Compression-Skipped'] = str(outcome.get('skipped', False)).lower()
+    response.headers['X-Winner'] = outcome.get('winner', 'compressed')
+    response.headers['X-Engine'] = outcome.get('engine', 'gs')
+    if outcome.get('analysis'):
+        gains = outcome['analysis']['predicted_gain_percent']
+        response.headers['X-Predicted-Gain-Percent'] = ','.join(f"{level}={gains[level]}" for level in sorted(gains))
+    return response
+
+def enqueue_compression_job(file_id, input_path, output_path, level, original_filename, output_filename,
+                            input_sha256, keep_smaller, client, lane, analysis, profile=None, callback_url=None,
+                            engine='gs'):
+    """Encolar un trabajo de compresión en su carril; responde 429 si la cola está llena"""
+    created_at = time.time()
+    job = {
+        'job_id': file_id,
+        'input_path': input_path,
+        'output_path': output_path,
+        'level': level,
+        'original_filename': original_filename,
+        'output_filename': output_filename,
+        'input_sha256': input_sha256,
+        'keep_smaller': keep_smaller,
+        'analysis': analysis,
+        'profile': profile,
+        'engine': engine,
+        'callback_url': callback_url,
+        'request_id': g.trace.request_id,
+        'trace': g.trace.verbose,
+        'created_at': created_at
+    }
+    # El estado se guarda antes de encolar para que el worker no lo sobrescriba
+    save_job_state(file_id, {'job_id': file_id, 'status': 'queued', 'level': level, 'created_at': created_at})
+    try:
+        scheduler.submit(partial(run_compression_job, job), client, lane)
+    except queue.Full:
+        os.remove(input_path)
+        os.remove(job_state_path(file_id))
+        logger.warning(f"Cola de compresión llena ({JOB_QUEUE_SIZE} trabajos), rechazando solicitud")
+        return busy_response()
+
+    logger.info(f"Trabajo encolado en el carril {lane}: {file_id}")
+    return jsonify({
+        'success': True,
+        'job_id': file_id,
+        'status': 'queued',
+        'status_url': f'/jobs/{file_id}'
+    }), 202
+
+class ZipStreamBuffer:
+    """Destino no buscable para zipfile que acumula los bytes escritos hasta que se consumen"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def save_batch_inputs(files, batch_id):
+    """Guardar las partes de un lote (PDFs o ZIPs) en UPLOAD_FOLDER; devuelve (elementos, fallos)"""
+    items, failures = [], []
+
+    def add_item(filename):
+        item_id = f"{batch_id}_{len(items) + len(failures):04d}"
+        item = {'filename': filename, 'input_path': os.path.join(UPLOAD_FOLDER, f"{item_id}_{filename}"),
+                'output_path': os.path.join(COMPRESSED_FOLDER, f"{item_id}_{filename}")}
+        items.append(item)
+        return item
+
+    for file in files:
+        filename = secure_filename(file.filename or '')
+        if filename.lower().endswith('.zip'):
+            archive_path = os.path.join(UPLOAD_FOLDER, f"{batch_id}_{filename}")
+            save_upload(file, archive_path)
+            try:
+                with zipfile.ZipFile(archive_path) as archive:
+                    for member in archive.infolist():
+                        if member.is_dir():
+                            continue
+                        member_name = secure_filename(os.path.basename(member.filename))
+                        if not allowed_file(member_name):
+                            failures.append({'filename': member_name, 'status': 'failed',
+                                             'error': 'Solo se permiten archivos PDF'})
+                            continue
+                        item = add_item(member_name)
+                        try:
+                            # El tamaño declarado en el ZIP no es fiable: se limita mientras se extrae
+                            with archive.open(member) as source:
+                                item['input_sha256'] = save_stream(source, item['input_path'],
+                                                                   app.config['MAX_CONTENT_LENGTH'])
+                        except RequestEntityTooLarge:
+                            items.remove(item)
+                            failures.append({'filename': member_name, 'status': 'failed',
+                                             'error': 'El archivo supera el tamaño máximo'})
+            except zipfile.BadZipFile:
+                failures.append({'filename': filename, 'status': 'failed', 'error': 'Archivo ZIP no válido'})
+            finally:
+                os.remove(archive_path)
+        elif allowed_file(filename):
+            item = add_item(filename)
+            item['input_sha256'] = save_upload(file, item['input_path'])
+        else:
+            failures.append({'filename': filename, 'status': 'failed', 'error': 'Solo se permiten archivos PDF'})
+    return items, failures
+
+def run_batch_item(item, level, keep_smaller, profile, results):
+    """Comprimir un elemento de un lote y publicar su resultado"""
+    try:
+        outcome = process_compression(item['input_path'], item['output_path'], level, item['input_sha256'],
+                                      keep_smaller, item.get('analysis'), profile)
+        original_size = outcome['original_size']
+        compressed_size = outcome['compressed_size']
+        compression_ratio = ((original_size - compressed_size) / original_size) * 100
+        results.put((item, {
+            'filename': item['filename'],
+            'status': 'done',
             'original_size_mb': round(original_size / (1024 * 1024), 2),
             'compressed_size_mb': round(compressed_size / (1024 * 1024), 2),
             'compression_ratio_percent': round(compression_ratio, 2),
-            'file_id': file_id
-        })
+            'cached': outcome['cached'],
+            'skipped': outcome['skipped'],
+            'winner': outcome['winner'],
+            'analysis': outcome['analysis']
+        }))
+    except Exception as e:
+        ERRORS.labels(stage='batch').inc()
+        logger.error(f"Error en lote al comprimir {item['filename']}: {str(e)}")
+        if os.path.exists(item['input_path']):
+            os.remove(item['input_path'])
+        entry = {'filename': item['filename'], 'status': 'failed', 'error': str(e)}
+        if isinstance(e, GhostscriptLimitExceeded):
+            entry.update(e.details())
+        results.put((item, entry))
+
+def generate_batch_zip(items, failures, level, keep_smaller, client, profile=None):
+    """Comprimir los elementos en el pool de workers y emitir el ZIP a medida que terminan"""
+    buffer = ZipStreamBuffer()
+    results = queue.Queue()
+    manifest = list(failures)
+    used_names = set()
+    pending = list(items)
+    in_flight = 0
+    try:
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+            while pending or in_flight:
+                # Mantener como mucho un elemento en curso por worker para no acaparar la cola
+                while pending and in_flight < COMPRESSION_WORKERS:
+                    item = pending.pop(0)
+                    lane, item['analysis'] = estimate_lane(item['input_path'])
+                    try:
+                        scheduler.submit(partial(run_batch_item, item, level, keep_smaller, profile, results), client, lane,
+                                         timeout=JOB_RETRY_AFTER_SECONDS)
+                        in_flight += 1
+                    except queue.Full:
+                        os.remove(item['input_path'])
+                        manifest.append({'filename': item['filename'], 'status': 'failed',
+                                         'error': 'El servicio está ocupado, intente más tarde'})
+
+                if not in_flight:
+                    continue
+                item, entry = results.get()
+                in_flight -= 1
+                manifest.append(entry)
+                if entry['status'] != 'done':
+                    continue
+
+                arcname = output_name(level, profile, item['filename'])
+                if arcname in used_names:
+                    arcname = f"{len(manifest):04d}_{arcname}"
+                used_names.add(arcname)
+                entry['archive_name'] = arcname
+                with archive.open(arcname, 'w') as target, open(item['output_path'], 'rb') as source:
+                    while True:
+                        chunk = source.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield buffer.drain()
+                os.remove(item['output_path'])
+
+            done = sum(1 for entry in manifest if entry['status'] == 'done')
+            archive.writestr('manifest.json', json.dumps({
+                'level': level,
+                'profile': profile,
+                'total': len(manifest),
+                'done': done,
+                'failed': len(manifest) - done,
+                'files': manifest
+            }, indent=2, ensure_ascii=False))
+        yield buffer.drain()
+        logger.info(f"Lote completado: {len(manifest)} archivos")
+    finally:
+        # Si el cliente se desconecta, no dejar entradas sin procesar en disco
+        for item in pending:
+            if os.path.exists(item['input_path']):
+                os.remove(item['input_path'])
+
+@app.route('/compress/batch', methods=['POST'])
+def compress_batch_endpoint():
+    """Endpoint para comprimir varios PDFs (o un ZIP) y devolver un ZIP con los resultados"""
+    try:
+        rejection = admission_response()
+        if rejection is not None:
+            return rejection
+        
+        files = [file for file in request.files.getlist('file') if file.filename]
+        if not files:
+            return jsonify({'error': 'No se proporcionó ningún archivo'}), 400
+        
+        level, error = parse_compression_level()
+        if error:
+            return jsonify({'error': error}), 400
+        profile, error = parse_profile()
+        if error:
+            return jsonify({'error': error}), 400
+        if profile:
+            level = compressor.level(level, profile)
+        
+        keep_smaller = parse_keep_smaller()
+        items, failures = save_batch_inputs(files, str(uuid.uuid4()))
+        if len(items) + len(failures) > BATCH_MAX_FILES:
+            for item in items:
+                os.remove(item['input_path'])
+            return jsonify({'error': f'Un lote admite como máximo {BATCH_MAX_FILES} archivos'}), 400
+        logger.info(f"Lote recibido: {len(items)} archivos válidos, {len(failures)} rechazados")
         
+        response = Response(generate_batch_zip(items, failures, level, keep_smaller, client_key(), profile),
+                            mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="{output_name(level, profile, "batch.zip")}"'
+        return response
+        
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        logger.error(f"Error en compresión: {str(e)}")
-        return jsonify({'error': f'Error al procesar el archivo: {str(e)}'}), 500
+        logger.error(f"Error en compresión por lotes: {str(e)}")
+        return jsonify({'error': f'Error al procesar el lote: {str(e)}'}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Endpoint para consultar el estado de un trabajo asíncrono"""
+    state = load_job_state(job_id)
+    if state is None and storage.shared:
+        # Trabajo de otra réplica: su estado no está aquí, pero si terminó su resultado está en el almacenamiento
+        result = storage.head(job_id)
+        if result is not None:
+            state = {'job_id': job_id, 'status': 'done', 'level': result['level'], 'file_id': job_id,
+                     'compressed_filename': result['filename'],
+                     'original_size_mb': round(result['original_size'] / (1024 * 1024), 2),
+                     'compressed_size_mb': round(result['compressed_size'] / (1024 * 1024), 2)}
+    if state is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(state)
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Endpoint con las estadísticas de la caché de resultados"""
+    counters = get_counters()
+    hits = counters.get('cache_hits', 0)
+    misses = counters.get('cache_misses', 0)
+    with closing(db_connect()) as conn:
+        entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries').fetchone()
+    return jsonify({
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio_percent': round(hits / (hits + misses) * 100, 2) if hits + misses else 0.0,
+        'entries': entries,
+        'size_mb': round(size / (1024 * 1024), 2),
+        'max_size_mb': round(CACHE_MAX_BYTES / (1024 * 1024), 2)
+    })
+
+@app.route('/storage/stats', methods=['GET'])
+def storage_stats():
+    """Endpoint con la ocupación de los resultados, el ahorro por deduplicación de contenidos idénticos y los
+    límites de la limpieza (caducidad y cuota de disco)"""
+    dedup = deduplication_stats()
+    saved = dedup['logical_size'] - dedup['stored_size']
+    return jsonify({
+        'backend': STORAGE_CONFIG.get('backend', 'local'),
+        'deduplicate': storage.deduplicate,
+        'results': dedup['results'],
+        'unique_contents': dedup['contents'],
+        'shared_contents': dedup['shared'],
+        'logical_size_mb': round(dedup['logical_size'] / (1024 * 1024), 2),
+        'stored_size_mb': round(dedup['stored_size'] / (1024 * 1024), 2),
+        'saved_mb': round(saved / (1024 * 1024), 2),
+        'saved_percent': round(saved / dedup['logical_size'] * 100, 2) if dedup['logical_size'] else 0.0,
+        'result_ttl_seconds': RESULT_TTL_SECONDS,
+        'max_disk_mb': round(RESULTS_MAX_BYTES / (1024 * 1024), 2) if RESULTS_MAX_BYTES is not None else None,
+        'eviction': EVICTION_POLICY
+    })
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    """Listar los perfiles de compresión configurados con sus opciones"""
+    return jsonify({
+        'levels': {str(level): pdfsettings for level, pdfsettings in LEVEL_PDFSETTINGS.items()},
+        'profiles': PROFILES_CONFIG
+    })
+
+@app.route('/admin/slow-jobs', methods=['GET'])
+def list_slow_jobs():
+    """Endpoint de administración: compresiones más lentas con sus tramos y las características del PDF"""
+    if ADMIN_TOKEN and not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'error': 'Token de administración no válido'}), 401
+    limit = request.args.get('limit', SLOW_JOBS_SIZE, type=int)
+    with closing(db_connect()) as conn:
+        rows = conn.execute('SELECT details FROM slow_jobs ORDER BY duration DESC LIMIT ?', (limit,)).fetchall()
+    return jsonify({'capacity': SLOW_JOBS_SIZE, 'slow_jobs': [json.loads(row['details']) for row in rows]})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Endpoint de métricas en formato Prometheus"""
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+def result_etag(result, file_path):
+    """ETag fuerte de un resultado: el hash de su contenido guardado en el índice (se calcula si falta)"""
+    if result['sha256'] is not None:
+        return result['sha256']
+    content_sha256 = file_sha256(file_path)
+    with closing(db_connect()) as conn, conn:
+        conn.execute('UPDATE files SET sha256 = ? WHERE file_id = ?', (content_sha256, result['file_id']))
+    return content_sha256
+
+def is_not_modified(etag, last_modified):
+    """Evaluar If-None-Match o, si no se envía, If-Modified-Since"""
+    if request.if_none_match:
+        # En GET la comparación es débil
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(last_modified) <= request.if_modified_since.timestamp()
+    return False
+
+# Un rango de bytes: "inicio-fin", "inicio-" o "-sufijo"
+BYTE_RANGE_PATTERN = re.compile(r'\s*([0-9]*)\s*-\s*([0-9]*)\s*')
+
+def parse_byte_ranges(header):
+    """Rangos de una cabecera Range como (inicio, fin exclusivo o None); los sufijos son (None, longitud)
+
+    A diferencia de request.range (werkzeug), admite rangos desordenados o solapados, que RFC 7233 permite
+    y que se fusionan después. None si la cabecera no es de bytes o no es válida.
+    """
+    if not header or '=' not in header:
+        return None
+    units, specs = header.split('=', 1)
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        match = BYTE_RANGE_PATTERN.fullmatch(spec)
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+        first, last = match.groups()
+        if first == '':
+            ranges.append((None, int(last)))
+        elif last == '':
+            ranges.append((int(first), None))
+        elif int(last) < int(first):
+            return None
+        else:
+            ranges.append((int(first), int(last) + 1))
+    return ranges or None
+
+def requested_ranges(etag, last_modified, size):
+    """Rangos de Range ajustados al tamaño, ordenados y fusionados; None si se debe enviar el archivo entero
+
+    Devuelve una lista vacía si ningún rango es satisfacible (416).
+    """
+    ranges = parse_byte_ranges(request.headers.get('Range'))
+    if ranges is None or len(ranges) > DOWNLOAD_MAX_RANGES:
+        return None
+    # If-Range: el rango solo vale si el cliente tiene la misma versión (comparación fuerte)
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and int(last_modified) > if_range.date.timestamp():
+        return None
+    satisfiable = []
+    for start, stop in ranges:
+        if start is None:
+            # Rango sufijo: los últimos stop bytes
+            start, stop = max(size - stop, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            satisfiable.append((start, stop))
+    merged = []
+    for start, stop in sorted(satisfiable):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def read_file_range(file, start, length):
+    """Leer length bytes de un archivo abierto desde start, por bloques; cierra el archivo al terminar"""
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+def file_range_body(file, start, length):
+    """Cuerpo de la respuesta con length bytes desde start
+
+    Bajo Gunicorn se devuelve el wsgi.file_wrapper con el archivo ya posicionado: Gunicorn envía
+    Content-Length bytes desde la posición actual con sendfile(2), sin copiarlos a Python.
+    """
+    if DOWNLOAD_SENDFILE and request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        file.seek(start)
+        return wrap_file(request.environ, file, UPLOAD_CHUNK_SIZE)
+    return read_file_range(file, start, length)
+
+def multipart_byteranges(file, ranges, size, boundary):
+    """Partes de una respuesta multipart/byteranges; devuelve (iterable, longitud total)"""
+    headers = [f"--{boundary}\r\nContent-Type: application/pdf\r\nContent-Range: bytes {start}-{stop - 1}/{size}"
+               f"\r\n\r\n".encode('ascii') for start, stop in ranges]
+    closing_boundary = f"--{boundary}--\r\n".encode('ascii')
+    length = sum(len(header) + stop - start + 2 for header, (start, stop) in zip(headers, ranges)) + len(closing_boundary)
+
+    def generate():
+        try:
+            for header, (start, stop) in zip(headers, ranges):
+                yield header
+                file.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = file.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+                yield b'\r\n'
+            yield closing_boundary
+        finally:
+            file.close()
+
+    return generate(), length
+
+def send_result(result, file_path):
+    """Servir un resultado desde file_path con ETag, caché de larga duración, peticiones condicionales y rangos"""
+    etag = result_etag(result, file_path)
+    stat = os.stat(file_path)
+    size = stat.st_size
+    # El contenido de un file_id no cambia: se puede cachear hasta que caduque
+    max_age = max(int(result['expires_at'] - time.time()), 0)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': f'public, max-age={max_age}, immutable',
+        'Accept-Ranges': 'bytes',
+        'X-Original-Size': str(result['original_size']),
+        'X-Compressed-Size': str(result['compressed_size'])
+    }
+    if is_not_modified(etag, stat.st_mtime):
+        return Response(status=304, headers=headers)
+
+    ranges = requested_ranges(etag, stat.st_mtime, size)
+    if ranges == []:
+        response = jsonify({'error': 'Rango no satisfacible'})
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+
+    filename = result.get('filename') or os.path.basename(result['path'])
+    headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    file = open(file_path, 'rb')
+    if ranges is None:
+        response = Response(wrap_file(request.environ, file, UPLOAD_CHUNK_SIZE), mimetype='application/pdf',
+                            headers=headers, direct_passthrough=True)
+        response.headers['Content-Length'] = str(size)
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(file_range_body(file, start, stop - start), status=206, mimetype='application/pdf',
+                            headers=headers, direct_passthrough=True)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        response.headers['Content-Length'] = str(stop - start)
+    else:
+        boundary = uuid.uuid4().hex
+        body, length = multipart_byteranges(file, ranges, size, boundary)
+        response = Response(body, status=206, mimetype=f'multipart/byteranges; boundary={boundary}',
+                            headers=headers, direct_passthrough=True)
+        response.headers['Content-Length'] = str(length)
+    return response
 
 @app.route('/download/<file_id>', methods=['GET'])
 def download_compressed_file(file_id):
     """Endpoint para descargar archivo comprimido"""
+    download_start = time.perf_counter()
     try:
-        # Buscar archivo comprimido por file_id
-        for filename in os.listdir(COMPRESSED_FOLDER):
-            if filename.startswith(file_id):
-                file_path = os.path.join(COMPRESSED_FOLDER, filename)
-                return send_file(file_path, as_attachment=True, download_name=filename)
+        # Buscar archivo comprimido por file_id en el índice (o en el almacenamiento compartido)
+        result, indexed = find_result(file_id)
+        if result is None:
+            return jsonify({'error': 'Archivo no encontrado'}), 404
+        # Caducado pero aún no eliminado por la limpieza
+        if result['expires_at'] <= time.time():
+            return jsonify({'error': 'Archivo no encontrado'}), 404
         
-        return jsonify({'error': 'Archivo no encontrado'}), 404
+        # Ruta local del resultado (con S3, la copia de la caché de lectura)
+        file_path = storage.fetch(result['path'], result['created_at'])
+        if file_path is None:
+            if indexed:
+                forget_result(file_id)
+            return jsonify({'error': 'Archivo no encontrado'}), 404
+        
+        response = send_result(result, file_path)
+        # Las descargas de resultados de otras réplicas no están en el índice local
+        if response.status_code != 304 and indexed:
+            record_download(file_id)
+        # La transferencia termina cuando se cierra la respuesta
+        response.call_on_close(lambda: DOWNLOAD_SECONDS.observe(time.perf_counter() - download_start))
+        return response
         
     except Exception as e:
+        ERRORS.labels(stage='download').inc()
         logger.error(f"Error al descargar archivo: {str(e)}")
         return jsonify({'error': f'Error al descargar archivo: {str(e)}'}), 500
 
 @app.route('/cleanup', methods=['POST'])
 def cleanup_files():
-    """Endpoint para limpiar archivos temporales (opcional)"""
+    """Endpoint para forzar la limpieza: resultados caducados, cuota de disco y restos de peticiones fallidas"""
     try:
-        # Limpiar archivos comprimidos más antiguos de 1 hora
-        import time
-        current_time = time.time()
-        cleaned_count = 0
-        
-        for filename in os.listdir(COMPRESSED_FOLDER):
-            file_path = os.path.join(COMPRESSED_FOLDER, filename)
-            if os.path.getctime(file_path) < (current_time - 3600):  # 1 hora
-                os.remove(file_path)
-                cleaned_count += 1
+        counts = run_cleanup(include_orphans=True)
         
         return jsonify({
             'success': True,
-            'message': f'Se limpiaron {cleaned_count} archivos temporales'
+            'message': f'Se limpiaron {sum(counts.values())} archivos temporales',
+            **counts
         })
         
     except Exception as e:
+        ERRORS.labels(stage='cleanup').inc()
         logger.error(f"Error en limpieza: {str(e)}")
         return jsonify({'error': f'Error en limpieza: {str(e)}'}), 500
 
+def release_blobs(hashes):
+    """Eliminar los blobs cuyo contenido ya no referencia ningún resultado del índice"""
+    hashes = {sha256 for sha256 in hashes if sha256}
+    if not hashes or not storage.deduplicate:
+        return 0
+    with closing(db_connect()) as conn:
+        referenced = {row['sha256'] for row in conn.execute(
+            f"SELECT DISTINCT sha256 FROM files WHERE sha256 IN ({', '.join('?' * len(hashes))})", tuple(hashes))}
+    return sum(storage.release_blob(sha256) for sha256 in hashes - referenced)
+
+def remove_results(rows):
+    """Eliminar del almacenamiento los resultados ya retirados del índice, el estado de sus trabajos y los blobs
+    que se quedan sin referencias"""
+    removed_count = 0
+    for row in rows:
+        try:
+            removed_count += storage.delete(row['path'])
+        except Exception as e:
+            logger.warning(f"No se pudo eliminar {row['path']}: {str(e)}")
+        try:
+            os.remove(job_state_path(row['file_id']))
+        except FileNotFoundError:
+            pass
+    release_blobs(row['sha256'] for row in rows)
+    return removed_count
+
+def expire_results(now=None):
+    """Eliminar los resultados caducados; solo lee del índice las filas vencidas, sin recorrer las carpetas"""
+    now = time.time() if now is None else now
+    with closing(db_connect()) as conn, conn:
+        rows = conn.execute('SELECT file_id, path, sha256 FROM files WHERE expires_at <= ?', (now,)).fetchall()
+        conn.executemany('DELETE FROM files WHERE file_id = ?', [(row['file_id'],) for row in rows])
+    removed_count = remove_results(rows)
+    CLEANUP_DELETIONS.labels(reason='expired').inc(removed_count)
+    return removed_count
+
+def enforce_disk_quota(keep_file_id=None):
+    """Desalojar resultados según la política configurada hasta que quepan en max_disk_mb
+
+    Con deduplicación cuenta el espacio real: un contenido compartido solo se libera al desalojar su última
+    referencia.
+    """
+    if RESULTS_MAX_BYTES is None:
+        return 0
+    evicted = []
+    with closing(db_connect()) as conn, conn:
+        references = {}
+        total_size = 0
+        for row in conn.execute(f'SELECT {RESULT_CONTENT_KEY} AS content, COUNT(*) AS refs, '
+                                f'MAX(compressed_size) AS size FROM files GROUP BY content'):
+            references[row['content']] = row['refs']
+            total_size += row['size']
+        if total_size <= RESULTS_MAX_BYTES:
+            return 0
+        # El resultado recién registrado nunca se desaloja: su cliente aún no ha podido descargarlo. Tampoco
+        # las otras referencias a su contenido, que no liberarían nada.
+        for row in conn.execute(f'SELECT file_id, path, sha256, compressed_size, {RESULT_CONTENT_KEY} AS content '
+                                f'FROM files WHERE file_id != ? AND {RESULT_CONTENT_KEY} != COALESCE('
+                                f'(SELECT {RESULT_CONTENT_KEY} FROM files WHERE file_id = ?), \'\') '
+                                f'ORDER BY {EVICTION_ORDER[EVICTION_POLICY]}',
+                                (keep_file_id or '', keep_file_id or '')):
+            if total_size <= RESULTS_MAX_BYTES:
+                break
+            evicted.append(row)
+            references[row['content']] -= 1
+            if references[row['content']] == 0:
+                total_size -= row['compressed_size']
+        conn.executemany('DELETE FROM files WHERE file_id = ?', [(row['file_id'],) for row in evicted])
+    removed_count = remove_results(evicted)
+    CLEANUP_DELETIONS.labels(reason='quota').inc(removed_count)
+    if evicted:
+        logger.info(f"Cuota de disco: se desalojaron {len(evicted)} resultados ({EVICTION_POLICY})")
+    return removed_count
+
+def sweep_orphans(now=None):
+    """Eliminar restos de peticiones fallidas: subidas, resultados sin indexar y estados de trabajos antiguos"""
+    now = time.time() if now is None else now
+    with closing(db_connect()) as conn:
+        rows = conn.execute('SELECT path, sha256 FROM files').fetchall()
+    indexed_paths = {row['path'] for row in rows}
+    removed_count = 0
+    for folder, max_age in ((UPLOAD_FOLDER, ORPHAN_MAX_AGE_SECONDS), (COMPRESSED_FOLDER, ORPHAN_MAX_AGE_SECONDS),
+                            (JOBS_FOLDER, RESULT_TTL_SECONDS)):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    # La caché (subcarpeta) tiene su propia política de desalojo
+                    if not entry.is_file() or entry.path in indexed_paths:
+                        continue
+                    if entry.stat().st_mtime < now - max_age:
+                        os.remove(entry.path)
+                        removed_count += folder != JOBS_FOLDER
+                except FileNotFoundError:
+                    pass
+    # Blobs sin ningún resultado que los referencie (por ejemplo, de un resultado que se perdió del índice)
+    if storage.deduplicate:
+        referenced_blobs = {storage.blob_path(row['sha256']) for row in rows if row['sha256']}
+        with os.scandir(storage.blob_folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.path not in referenced_blobs and entry.stat().st_mtime < now - ORPHAN_MAX_AGE_SECONDS:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    CLEANUP_DELETIONS.labels(reason='orphan').inc(removed_count)
+    return removed_count
+
+def run_cleanup(include_orphans=False):
+    """Caducidad, cuota de disco y, opcionalmente, restos huérfanos; devuelve los archivos eliminados por motivo"""
+    return {'expired': expire_results(),
+            'evicted': enforce_disk_quota(),
+            'orphans': sweep_orphans() if include_orphans else 0}
+
+def next_expiry():
+    """Instante en que caduca el próximo resultado, o None si no hay ninguno"""
+    with closing(db_connect()) as conn:
+        return conn.execute('SELECT MIN(expires_at) FROM files').fetchone()[0]
+
+def acquire_cleanup_lock():
+    """Tomar sin bloquear el lock de limpieza del nodo; devuelve el archivo abierto, o None si lo tiene otro proceso"""
+    lock_file = open(CLEANUP_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
 def cleanup_files_periodically():
-    """Limpia archivos temporales cada 2 horas en segundo plano"""
+    """Limpieza en segundo plano: despierta cuando caduca el siguiente resultado
+
+    Todos los workers lanzan el hilo, pero solo el que obtiene el lock del nodo limpia; el resto
+    reintenta periódicamente por si ese proceso termina (el kernel libera el lock).
+    """
+    lock_file = acquire_cleanup_lock()
+    while lock_file is None:
+        time.sleep(CLEANUP_LOCK_RETRY_SECONDS)
+        lock_file = acquire_cleanup_lock()
+    logger.info(f"Limpieza automática a cargo del proceso {os.getpid()}")
+    next_orphan_sweep = time.time()
     while True:
+        wake_at = time.time() + RESULT_TTL_SECONDS
         try:
-            logger.info("Limpieza automática de archivos temporales iniciada")
-            current_time = time.time()
-            cleaned_count = 0
-            for filename in os.listdir(COMPRESSED_FOLDER):
-                file_path = os.path.join(COMPRESSED_FOLDER, filename)
-                if os.path.getctime(file_path) < (current_time - 3600):  # 1 hora
-                    os.remove(file_path)
-                    cleaned_count += 1
-            if cleaned_count > 0:
-                logger.info(f"Limpieza automática: Se limpiaron {cleaned_count} archivos temporales")
+            now = time.time()
+            orphan_sweep = now >= next_orphan_sweep
+            counts = run_cleanup(include_orphans=orphan_sweep)
+            evict_cache()
+            if orphan_sweep:
+                next_orphan_sweep = now + ORPHAN_SWEEP_INTERVAL_SECONDS
+            if sum(counts.values()) > 0:
+                logger.info(f"Limpieza automática: {counts}")
+            # Con un TTL fijo los resultados nuevos caducan después de los ya indexados,
+            # así que basta con dormir hasta la próxima caducidad conocida
+            wake_at = min(next_expiry() or wake_at, next_orphan_sweep, wake_at)
         except Exception as e:
+            ERRORS.labels(stage='cleanup').inc()
             logger.error(f"Error en limpieza automática: {str(e)}")
-        time.sleep(7200)  # Esperar 2 horas (ajusta a 7200 para producción)
+        time.sleep(max(wake_at - time.time(), 1))
+
+def start_background_threads():
+    """Lanzar los hilos de fondo del proceso: limpieza, publicación de la carga y workers del modo asíncrono"""
+    # Limpieza en cada proceso, incluso bajo Gunicorn (solo uno por nodo obtiene el lock)
+    threading.Thread(target=cleanup_files_periodically, daemon=True).start()
+    # Carga de cada worker en la base de estado, para la readiness del nodo
+    threading.Thread(target=publish_worker_load_periodically, daemon=True).start()
+    # Pool acotado de workers de Ghostscript para el modo asíncrono
+    for _ in range(COMPRESSION_WORKERS):
+        threading.Thread(target=compression_worker, daemon=True).start()
 
-# Lanzar el hilo de limpieza automática SIEMPRE, incluso bajo Gunicorn
-cleanup_thread = threading.Thread(target=cleanup_files_periodically, daemon=True)
-cleanup_thread.start()
+# Las pruebas (tests/conftest.py) importan la app sin hilos de fondo: no limpian ni publican en el estado real
+if os.environ.get('PDF_COMPRESSOR_BACKGROUND_THREADS', '1') != '0':
+    start_background_threads()
 
 @app.route('/openapi.yml')
 def openapi_spec():
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark del servicio de compresión
+- Tiempo de pared de compress_pdf con distinto número de workers (compresión paralela)
+- Latencia por petición del pool de Ghostscript frente a un proceso gs por petición
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import app
+
+
+def run_once(input_path, level, workers):
+    """Comprimir una copia del PDF con el número de workers indicado y devolver (segundos, bytes)"""
+    app.PARALLEL_WORKERS = workers
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_path = os.path.join(work_dir, 'input.pdf')
+        output_path = os.path.join(work_dir, 'output.pdf')
+        shutil.copyfile(input_path, source_path)
+        start = time.perf_counter()
+        app.compress_pdf(source_path, output_path, level)
+        elapsed = time.perf_counter() - start
+        return elapsed, os.path.getsize(output_path)
+
+
+def compare_gs_pool(input_path, level, runs):
+    """Comparar la latencia media del pool de Ghostscript con la de un proceso por petición"""
+    app.PARALLEL_ENABLED = False
+    app.GS_POOL_ENABLED = True
+    pool = app.get_gs_pool()
+    if pool is None:
+        print("❌ El pool de Ghostscript no está disponible (libgs no encontrada)")
+        sys.exit(1)
+
+    results = {}
+    for mode in ('subproceso', 'pool'):
+        app.gs_pool = pool if mode == 'pool' else None
+        app.GS_POOL_ENABLED = mode == 'pool'
+        run_once(input_path, level, 1)  # calentamiento
+        timings = [run_once(input_path, level, 1)[0] for _ in range(runs)]
+        results[mode] = sum(timings) / len(timings)
+
+    saving = results['subproceso'] - results['pool']
+    print(f"{'modo':>12} {'latencia media (ms)':>20}")
+    for mode, seconds in results.items():
+        print(f"{mode:>12} {seconds * 1000:>20.1f}")
+    print(f"✅ Ahorro por petición con el pool: {saving * 1000:.1f} ms "
+          f"({saving / results['subproceso'] * 100:.1f}%)")
+    pool.close()
+
+
+def main():
+    """Función principal del benchmark"""
+    parser = argparse.ArgumentParser(description='Benchmark del servicio de compresión de PDF')
+    parser.add_argument('pdf', help='PDF de entrada')
+    parser.add_argument('--level', type=int, default=2, choices=[1, 2, 3], help='Nivel de compresión')
+    parser.add_argument('--workers', default='1,2,4,8', help='Lista de workers separados por comas')
+    parser.add_argument('--chunk-pages', type=int, default=app.PARALLEL_CHUNK_PAGES,
+                        help='Páginas por bloque')
+    parser.add_argument('--repeat', type=int, default=1, help='Repeticiones por configuración (se toma la mejor)')
+    parser.add_argument('--compare-pool', action='store_true',
+                        help='Comparar el pool de Ghostscript con un proceso gs por petición')
+    parser.add_argument('--runs', type=int, default=20, help='Ejecuciones por modo en --compare-pool')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.pdf):
+        print(f"❌ Archivo no encontrado: {args.pdf}")
+        sys.exit(1)
+
+    if args.compare_pool:
+        print(f"🚀 Pool de Ghostscript vs subproceso: {args.pdf}, nivel {args.level}, {args.runs} ejecuciones")
+        print("=" * 50)
+        compare_gs_pool(args.pdf, args.level, args.runs)
+        return
+
+    # Forzar la división para cualquier tamaño; con 1 worker se usa un único proceso gs
+    app.PARALLEL_ENABLED = True
+    app.PARALLEL_MIN_SIZE_BYTES = 0
+    app.PARALLEL_MIN_PAGES = 0
+    app.PARALLEL_CHUNK_PAGES = args.chunk_pages
+
+    pages = app.count_pdf_pages(args.pdf)
+    size_mb = os.path.getsize(args.pdf) / (1024 * 1024)
+    print(f"🚀 Benchmark: {args.pdf} ({pages} páginas, {size_mb:.2f} MB), nivel {args.level}")
+    print(f"   {os.cpu_count()} CPUs, {args.chunk_pages} páginas por bloque")
+    print("=" * 50)
+    print(f"{'workers':>8} {'tiempo (s)':>12} {'speedup':>9} {'salida (MB)':>12}")
+
+    baseline = None
+    for workers in [int(value) for value in args.workers.split(',')]:
+        elapsed, output_size = min(run_once(args.pdf, args.level, workers) for _ in range(args.repeat))
+        if baseline is None:
+            baseline = elapsed
+        print(f"{workers:>8} {elapsed:>12.2f} {baseline / elapsed:>8.2f}x {output_size / (1024 * 1024):>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Compresión masiva de carpetas de PDFs, sin pasar por el servicio HTTP
+Recorre un árbol de directorios y comprime cada PDF con pdf_compression en un pool de procesos, replicando la
+estructura en la carpeta de salida. Cada archivo terminado se añade a un manifiesto (JSON Lines) que hace de
+punto de control: al relanzar el mismo trabajo se saltan los archivos ya hechos, y los que tienen el mismo
+contenido que otro ya comprimido con los mismos ajustes se enlazan a su resultado en lugar de comprimirse.
+
+Uso: python bulk_compress.py ENTRADA SALIDA [--level N | --profile NOMBRE] [--engine gs|images] [--workers N]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from pdf_compression import ENGINES, PdfCompressor, file_sha256, link_or_copy
+
+MANIFEST_NAME = '.bulk_manifest.jsonl'
+MB = 1024 * 1024
+# Trabajos encolados por worker: suficientes para no dejarlos ociosos sin cargar millones de futuros
+TASKS_PER_WORKER = 2
+PROGRESS_INTERVAL_SECONDS = 0.5
+
+_compressor = None
+
+
+def _init_worker(config):
+    """Crear el compresor de cada proceso del pool"""
+    global _compressor
+    _compressor = PdfCompressor.from_config(config)
+    # El paralelismo está en el número de archivos: el motor por imágenes usa un solo proceso por archivo
+    _compressor.image_engine_workers = 1
+
+
+def compress_file(input_path, output_path, level, profile, engine, keep_smaller):
+    """Comprimir un archivo en un proceso del pool; los errores se devuelven como texto (no todos se serializan)"""
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        outcome = _compressor.compress(input_path, output_path, level, profile, engine, keep_smaller)
+    except Exception as e:
+        return {'error': str(e) or e.__class__.__name__, 'seconds': round(time.perf_counter() - start, 3)}
+    outcome['seconds'] = round(time.perf_counter() - start, 3)
+    return outcome
+
+
+def find_pdfs(input_dir, exclude_dir=None):
+    """Rutas relativas de los PDFs del árbol, en orden estable (se omite la carpeta de salida si está dentro)"""
+    exclude_dir = os.path.realpath(exclude_dir) if exclude_dir else None
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs[:] = sorted(name for name in dirs
+                         if not name.startswith('.') and os.path.realpath(os.path.join(root, name)) != exclude_dir)
+        for name in sorted(files):
+            if name.lower().endswith('.pdf') and not name.startswith('.'):
+                paths.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return paths
+
+
+class Manifest:
+    """Punto de control: una línea JSON por archivo terminado, escrita y volcada al disco al terminarlo"""
+
+    def __init__(self, path):
+        self.path = path
+        # Última entrada de cada ruta relativa y entrada correcta de cada contenido (hash y ajustes)
+        self.by_path = {}
+        self.by_key = {}
+        if os.path.exists(path):
+            complete_size = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    complete_size += len(line)
+                    try:
+                        self._index(json.loads(line))
+                    except ValueError:
+                        continue
+            # Última línea a medias si el proceso se interrumpió mientras escribía: se descarta para que la
+            # siguiente entrada no se escriba a continuación en la misma línea
+            if os.path.getsize(path) > complete_size:
+                os.truncate(path, complete_size)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _index(self, entry):
+        self.by_path[entry['path']] = entry
+        if entry['status'] in ('done', 'duplicate'):
+            self.by_key[entry['key']] = entry
+
+    def is_done(self, relative_path, stat, settings):
+        """True si la ruta ya se comprimió con estos ajustes y no ha cambiado desde entonces (sin leerla)"""
+        entry = self.by_path.get(relative_path)
+        return (entry is not None and entry['status'] in ('done', 'duplicate') and entry['settings'] == settings
+                and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime)
+
+    def record(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self._index(entry)
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    """Barra de progreso en stderr: archivos terminados, MB/s de entrada y tiempo restante estimado"""
+
+    def __init__(self, total, enabled):
+        self.total = total
+        self.enabled = enabled
+        self.start = time.monotonic()
+        self._last = 0.0
+
+    def update(self, stats, force=False):
+        now = time.monotonic()
+        if not self.enabled or (not force and now - self._last < PROGRESS_INTERVAL_SECONDS):
+            return
+        self._last = now
+        finished = stats['finished']
+        elapsed = max(now - self.start, 1e-6)
+        rate = stats['compressed'] / elapsed
+        remaining = self.total - finished
+        eta = f"{remaining / rate:.0f} s" if rate and stats['compressed'] else '?'
+        filled = int(30 * finished / self.total) if self.total else 30
+        sys.stderr.write(f"\r[{'#' * filled}{'.' * (30 - filled)}] {finished}/{self.total} "
+                         f"{stats['compressed_bytes'] / MB / elapsed:.1f} MB/s, quedan {eta}   ")
+        sys.stderr.flush()
+
+    def close(self, stats):
+        if self.enabled:
+            self.update(stats, force=True)
+            sys.stderr.write('\n')
+
+
+def print_summary(stats, elapsed):
+    """Resumen final: archivos por resultado, reducción y rendimiento"""
+    saved = stats['bytes_in'] - stats['bytes_out']
+    saved_percent = saved / stats['bytes_in'] * 100 if stats['bytes_in'] else 0.0
+    print("=" * 50)
+    print(f"{'✅' if not stats['failed'] else '⚠️'} Compresión masiva terminada en {elapsed:.1f} s")
+    print(f"   Archivos: {stats['finished']} (comprimidos {stats['compressed']}, ya hechos {stats['skipped']}, "
+          f"duplicados {stats['duplicates']}, fallidos {stats['failed']})")
+    print(f"   Entrada: {stats['bytes_in'] / MB:.1f} MB → salida {stats['bytes_out'] / MB:.1f} MB "
+          f"({saved_percent:.1f}% menos)")
+    if elapsed > 0:
+        print(f"   Rendimiento: {stats['compressed'] / elapsed:.2f} archivos/s, "
+              f"{stats['compressed_bytes'] / MB / elapsed:.2f} MB/s de entrada")
+    if stats['compressed']:
+        print(f"   Tiempo medio por archivo: {stats['worker_seconds'] / stats['compressed']:.2f} s por worker")
+
+
+def run(args, config):
+    """Comprimir el árbol de entrada; devuelve las estadísticas"""
+    compressor = PdfCompressor.from_config(config)
+    settings = compressor.settings_key(args.level, args.profile, args.engine) + f":keep_smaller={args.keep_smaller}"
+    settings_digest = hashlib.sha256(settings.encode('utf-8')).hexdigest()[:16]
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output, MANIFEST_NAME))
+    paths = find_pdfs(args.input, args.output)
+    stats = {'finished': 0, 'compressed': 0, 'skipped': 0, 'duplicates': 0, 'failed': 0, 'bytes_in': 0,
+             'bytes_out': 0, 'compressed_bytes': 0, 'worker_seconds': 0.0}
+    progress = Progress(len(paths), args.progress)
+    # Archivos con el mismo contenido que uno en curso: se enlazan a su resultado cuando termina
+    waiting = {}
+
+    def finish(entry):
+        manifest.record(entry)
+        stats['finished'] += 1
+        if entry['status'] == 'failed':
+            stats['failed'] += 1
+        else:
+            stats['bytes_in'] += entry['original_size']
+            stats['bytes_out'] += entry['compressed_size']
+        progress.update(stats)
+
+    def link_duplicate(relative_path, stat, key, sha256, source):
+        output_path = os.path.join(args.output, relative_path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        link_or_copy(os.path.join(args.output, source['output']), output_path)
+        stats['duplicates'] += 1
+        finish({'path': relative_path, 'status': 'duplicate', 'key': key, 'sha256': sha256,
+                'settings': settings_digest, 'size': stat.st_size, 'mtime': stat.st_mtime, 'output': relative_path,
+                'duplicate_of': source['path'], 'original_size': source['original_size'],
+                'compressed_size': source['compressed_size'], 'winner': source['winner'],
+                'finished_at': time.time()})
+
+    def collect(future, task):
+        relative_path, stat, key, sha256 = task
+        outcome = future.result()
+        entry = {'path': relative_path, 'key': key, 'sha256': sha256, 'settings': settings_digest,
+                 'size': stat.st_size, 'mtime': stat.st_mtime, 'output': relative_path,
+                 'seconds': outcome['seconds'], 'finished_at': time.time()}
+        if 'error' in outcome:
+            entry.update(status='failed', error=outcome['error'])
+        else:
+            entry.update(status='done', original_size=outcome['original_size'],
+                         compressed_size=outcome['compressed_size'], winner=outcome['winner'],
+                         skipped=outcome['skipped'], usage=outcome['usage'])
+            stats['compressed'] += 1
+            stats['compressed_bytes'] += outcome['original_size']
+            stats['worker_seconds'] += outcome['seconds']
+        finish(entry)
+        for duplicate in waiting.pop(key, []):
+            if entry['status'] == 'done':
+                link_duplicate(*duplicate, key, sha256, entry)
+            else:
+                finish({**entry, 'path': duplicate[0], 'size': duplicate[1].st_size, 'mtime': duplicate[1].st_mtime,
+                        'output': duplicate[0]})
+
+    start = time.monotonic()
+    in_flight = {}
+    max_in_flight = args.workers * TASKS_PER_WORKER
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(config,)) as executor:
+        for relative_path in paths:
+            input_path = os.path.join(args.input, relative_path)
+            stat = os.stat(input_path)
+            if manifest.is_done(relative_path, stat, settings_digest) and \
+                    os.path.exists(os.path.join(args.output, relative_path)):
+                stats['skipped'] += 1
+                stats['finished'] += 1
+                progress.update(stats)
+                continue
+
+            sha256 = file_sha256(input_path)
+            key = hashlib.sha256(f"{sha256}:{settings}".encode('utf-8')).hexdigest()
+            done = manifest.by_key.get(key)
+            if done is not None and os.path.exists(os.path.join(args.output, done['output'])):
+                if done['output'] == relative_path:
+                    # Mismo archivo ya comprimido (solo cambió su fecha de modificación): se actualiza la entrada
+                    manifest.record({**done, 'mtime': stat.st_mtime, 'finished_at': time.time()})
+                    stats['skipped'] += 1
+                    stats['finished'] += 1
+                    progress.update(stats)
+                else:
+                    link_duplicate(relative_path, stat, key, sha256, done)
+                continue
+            if key in waiting:
+                waiting[key].append((relative_path, stat))
+                continue
+
+            waiting[key] = []
+            future = executor.submit(compress_file, input_path, os.path.join(args.output, relative_path),
+                                     args.level, args.profile, args.engine, args.keep_smaller)
+            in_flight[future] = (relative_path, stat, key, sha256)
+            while len(in_flight) >= max_in_flight:
+                completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    collect(future, in_flight.pop(future))
+
+        while in_flight:
+            completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                collect(future, in_flight.pop(future))
+
+    progress.close(stats)
+    manifest.close()
+    stats['elapsed'] = time.monotonic() - start
+    return stats
+
+
+def main():
+    """Función principal de la compresión masiva"""
+    parser = argparse.ArgumentParser(description='Compresión masiva de carpetas de PDFs')
+    parser.add_argument('input', help='Carpeta con los PDFs (se recorre recursivamente)')
+    parser.add_argument('output', help='Carpeta de salida (misma estructura que la de entrada)')
+    parser.add_argument('--level', type=int, default=2, choices=[1, 2, 3], help='Nivel de compresión')
+    parser.add_argument('--profile', help='Perfil de compresión de config.json (sustituye a --level)')
+    parser.add_argument('--engine', default='gs', choices=ENGINES, help='Motor de compresión')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Procesos de compresión')
+    parser.add_argument('--config', default='config.json',
+                        help='config.json con perfiles, límites de recursos y análisis previo')
+    parser.add_argument('--manifest', help=f'Manifiesto de punto de control (por defecto SALIDA/{MANIFEST_NAME})')
+    parser.add_argument('--keep-smaller', action=argparse.BooleanOptionalAction, default=None,
+                        help='No dejar nunca un resultado mayor que el original (por defecto keep_smaller de config.json)')
+    parser.add_argument('--progress', action=argparse.BooleanOptionalAction, default=sys.stderr.isatty(),
+                        help='Mostrar la barra de progreso (por defecto, si la salida de errores es un terminal)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.input):
+        print(f"❌ Carpeta no encontrada: {args.input}")
+        sys.exit(1)
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    if args.keep_smaller is None:
+        args.keep_smaller = config.get('keep_smaller', True)
+    try:
+        PdfCompressor.from_config(config).level(args.level, args.profile)
+    except ValueError as e:
+        print(f"❌ {str(e)}")
+        sys.exit(1)
+
+    print(f"🚀 Compresión masiva: {args.input} → {args.output} ({args.workers} procesos, motor {args.engine}, "
+          f"{'perfil ' + args.profile if args.profile else 'nivel ' + str(args.level)})")
+    stats = run(args, config)
+    print_summary(stats, stats['elapsed'])
+    sys.exit(1 if stats['failed'] else 0)
+
+
+if __name__ == "__main__":
+    main()
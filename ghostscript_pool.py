@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Pool de intérpretes Ghostscript persistentes
+Cada worker es un proceso de larga duración que carga libgs una sola vez y ejecuta
+trabajos uno tras otro a través de la API gsapi, evitando arrancar un proceso gs por petición.
+"""
+
+import ctypes
+import ctypes.util
+import multiprocessing
+import queue
+import resource
+import threading
+import time
+
+from resource_limits import current_peak_rss_mb, reset_peak_rss
+
+try:
+    from gevent import monkey as gevent_monkey
+    from gevent.select import select as gevent_select
+except ImportError:
+    gevent_monkey = None
+
+# Códigos de gsapi que indican una ejecución correcta
+GS_SUCCESS_CODES = (0, -101)  # 0 y gs_error_Quit
+
+GS_ARG_ENCODING_UTF8 = 1
+
+
+class GhostscriptCancelled(Exception):
+    """La ejecución de Ghostscript se canceló antes de terminar"""
+
+
+_STDIO_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_int)
+
+
+def load_libgs():
+    """Cargar la biblioteca compartida de Ghostscript"""
+    for name in (ctypes.util.find_library('gs'), 'libgs.so.10', 'libgs.so.9', 'libgs.so'):
+        if not name:
+            continue
+        try:
+            return ctypes.CDLL(name)
+        except OSError:
+            continue
+    raise OSError('No se encontró la biblioteca libgs')
+
+
+def run_gsapi(libgs, args, stdout_marks=None):
+    """Ejecutar una invocación de Ghostscript en una instancia gsapi nueva y devolver (código, stdout, stderr)
+
+    Con una lista en stdout_marks se añade (segundos desde el inicio, bytes de stdout escritos) en cada escritura.
+    """
+    stdout, stderr = [], []
+    start = time.perf_counter()
+    written = [0]
+
+    def make_writer(buffer):
+        def write(_handle, data, length):
+            buffer.append(ctypes.string_at(data, length))
+            if stdout_marks is not None and buffer is stdout:
+                written[0] += length
+                stdout_marks.append((round(time.perf_counter() - start, 3), written[0]))
+            return length
+        return _STDIO_CALLBACK(write)
+
+    def read_stdin(_handle, _data, _length):
+        return 0
+
+    # Mantener referencias a los callbacks mientras dure la instancia
+    callbacks = (_STDIO_CALLBACK(read_stdin), make_writer(stdout), make_writer(stderr))
+    instance = ctypes.c_void_p()
+    code = libgs.gsapi_new_instance(ctypes.byref(instance), None)
+    if code < 0:
+        return code, '', 'gsapi_new_instance falló'
+    try:
+        libgs.gsapi_set_stdio(instance, *callbacks)
+        libgs.gsapi_set_arg_encoding(instance, GS_ARG_ENCODING_UTF8)
+        argv = (ctypes.c_char_p * len(args))(*[arg.encode('utf-8') for arg in args])
+        code = libgs.gsapi_init_with_args(instance, len(args), argv)
+        exit_code = libgs.gsapi_exit(instance)
+        if code in GS_SUCCESS_CODES:
+            code = exit_code
+    finally:
+        libgs.gsapi_delete_instance(instance)
+    return code, b''.join(stdout).decode('utf-8', 'replace'), b''.join(stderr).decode('utf-8', 'replace')
+
+
+def wait_readable(conn, timeout):
+    """Esperar hasta timeout segundos a que haya datos en la conexión con un worker
+
+    Bajo el worker gevent de Gunicorn se espera con el select de gevent, que cede el control al resto
+    de conexiones del proceso en vez de bloquearlo mientras Ghostscript trabaja.
+    """
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('select'):
+        readable, _, _ = gevent_select([conn.fileno()], [], [], timeout)
+        return bool(readable)
+    return conn.poll(timeout)
+
+
+def _worker_loop(conn, limits=None):
+    """Bucle del proceso worker: recibe argumentos de gs y responde con el resultado y el uso de recursos"""
+    try:
+        libgs = load_libgs()
+        if limits is not None:
+            limits.apply_worker()
+    except OSError as e:
+        conn.send(('error', str(e)))
+        return
+    conn.send(('ready', None))
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            return
+        if args is None:
+            return
+        if limits is not None:
+            limits.start_cpu_budget()
+        reset_peak_rss()
+        start = time.perf_counter()
+        cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+        stdout_marks = []
+        code, stdout, stderr = run_gsapi(libgs, args, stdout_marks)
+        cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+        usage = {
+            'peak_rss_mb': current_peak_rss_mb(),
+            'cpu_seconds': round(cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime, 2),
+            'wall_seconds': round(time.perf_counter() - start, 2)
+        }
+        conn.send((code, stdout, stderr, usage, stdout_marks))
+
+
+class GhostscriptPool:
+    """Pool de procesos con Ghostscript cargado, reciclados tras max_jobs trabajos o ante cualquier error
+
+    Con limits (ResourceLimits), cada worker arranca con los límites de memoria, salida y prioridad, y cada
+    trabajo tiene su propio presupuesto de CPU; si un límite mata al worker se lanza GhostscriptLimitExceeded.
+    """
+
+    def __init__(self, size, max_jobs=200, limits=None):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.limits = limits
+        # Bajo gevent un fork copiaría el hub con todas las greenlets del worker (peticiones en curso, el bucle
+        # de Gunicorn...), que seguirían ejecutándose en el hijo: los workers se lanzan con spawn
+        gevent_patched = gevent_monkey is not None and gevent_monkey.is_module_patched('os')
+        self._context = multiprocessing.get_context('spawn' if gevent_patched else 'fork')
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {'jobs': 0, 'errors': 0, 'recycled': 0, 'total_seconds': 0.0}
+        for _ in range(size):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_loop, args=(child_conn, self.limits), daemon=True)
+        process.start()
+        child_conn.close()
+        wait_readable(parent_conn, None)
+        status, message = parent_conn.recv()
+        if status != 'ready':
+            process.join()
+            raise OSError(message)
+        return {'process': process, 'conn': parent_conn, 'jobs': 0}
+
+    def _stop_worker(self, worker):
+        try:
+            worker['conn'].send(None)
+        except (OSError, ValueError):
+            pass
+        worker['conn'].close()
+        worker['process'].join(timeout=1)
+        if worker['process'].is_alive():
+            worker['process'].kill()
+            worker['process'].join()
+
+    def _release(self, worker, healthy):
+        """Devolver un worker al pool, sustituyéndolo si debe reciclarse"""
+        if healthy and worker['jobs'] < self.max_jobs:
+            self._idle.put(worker)
+            return
+        self._stop_worker(worker)
+        with self._lock:
+            self._stats['recycled'] += 1
+        self._idle.put(self._start_worker())
+
+    def run(self, args, timeout=300, cancel_event=None, stdout_marks=None):
+        """Ejecutar Ghostscript con los argumentos dados; devuelve (código, stdout, stderr, uso de recursos)
+
+        Si cancel_event se activa durante la ejecución, el worker se descarta y se lanza GhostscriptCancelled.
+        Con una lista en stdout_marks se añaden los instantes de cada escritura en stdout (ver run_gsapi).
+        """
+        worker = self._idle.get()
+        healthy = False
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        try:
+            worker['conn'].send(list(args))
+            while not wait_readable(worker['conn'], 0.2 if cancel_event else timeout):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise GhostscriptCancelled()
+                if time.monotonic() >= deadline:
+                    raise TimeoutError('Timeout en el worker de Ghostscript')
+            code, stdout, stderr, usage, marks = worker['conn'].recv()
+            if stdout_marks is not None:
+                stdout_marks.extend(marks)
+            worker['jobs'] += 1
+            healthy = code in GS_SUCCESS_CODES
+            return code, stdout, stderr, usage
+        except EOFError:
+            worker['process'].join(timeout=1)
+            exitcode = worker['process'].exitcode
+            if self.limits is not None and exitcode is not None and exitcode < 0:
+                # Un exitcode negativo es la señal que mató al worker (SIGXCPU, SIGKILL...)
+                usage = {'peak_rss_mb': None, 'cpu_seconds': None,
+                         'wall_seconds': round(time.perf_counter() - start, 2)}
+                limit = self.limits.classify(-exitcode, None, '', usage)
+                if limit is not None:
+                    raise self.limits.exceeded(limit, usage)
+            raise OSError('El worker de Ghostscript terminó inesperadamente')
+        finally:
+            with self._lock:
+                self._stats['jobs'] += 1
+                self._stats['errors'] += 0 if healthy else 1
+                self._stats['total_seconds'] += time.perf_counter() - start
+            self._release(worker, healthy)
+
+    def stats(self):
+        """Estadísticas acumuladas del pool"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self.size
+        stats['avg_seconds'] = stats['total_seconds'] / stats['jobs'] if stats['jobs'] else 0.0
+        return stats
+
+    def close(self):
+        """Detener todos los workers"""
+        while True:
+            try:
+                self._stop_worker(self._idle.get_nowait())
+            except queue.Empty:
+                return
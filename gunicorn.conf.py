@@ -0,0 +1,32 @@
+"""
+Configuración de Gunicorn para el servicio de compresión de PDF
+"""
+
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = '0.0.0.0:5000'
+workers = 2
+# Workers gevent: cada conexión es una greenlet, así que las subidas y descargas lentas no ocupan un worker;
+# Ghostscript se ejecuta fuera del proceso y las esperas (planificador, subprocesos, pool) ceden el control
+worker_class = 'gevent'
+# Conexiones simultáneas por worker
+worker_connections = 2000
+# Las descargas se envían con sendfile(2) desde wsgi.file_wrapper (también los rangos, ver app.py)
+sendfile = True
+
+
+def on_starting(server):
+    """Vaciar el directorio de métricas multiproceso al arrancar el master"""
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Descartar los gauges 'live' de un worker que ha terminado"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Motor de compresión por imágenes, alternativo a Ghostscript
+Recorre los objetos del PDF y recomprime solo los XObject de imagen (submuestreo, JPEG con menos calidad y
+CCITT G4 para escaneos bitonales) en un pool de procesos, una imagen por tarea. Las imágenes idénticas se
+procesan una sola vez y se unifican; el resto del contenido se copia sin cambios.
+El servicio lo ejecuta como subproceso: python image_engine.py --level N entrada.pdf salida.pdf
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pikepdf
+    from PIL import Image
+except ImportError:
+    pikepdf = None
+
+from pdf_analyzer import DEFAULT_PAGE_SIZE, DOWNSAMPLE_THRESHOLD, LEVEL_COLOR_DPI, LEVEL_MONO_DPI
+
+# Calidad JPEG por nivel (/prepress, /ebook, /screen)
+LEVEL_JPEG_QUALITY = {1: 85, 2: 70, 3: 50}
+# En imágenes muy pequeñas la cabecera del nuevo formato se come la ganancia
+MIN_IMAGE_PIXELS = 32 * 32
+# Filtros que qpdf decodifica sin pérdida; el resto (JPX, JBIG2, CCITT) ya son compactos y no se tocan
+LOSSLESS_FILTERS = {'/FlateDecode', '/LZWDecode', '/RunLengthDecode', '/ASCIIHexDecode', '/ASCII85Decode'}
+COLOR_MODES = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}
+ICC_MODES = {1: 'L', 3: 'RGB'}
+
+
+def available():
+    """True si están instaladas las dependencias opcionales (pikepdf y Pillow)"""
+    return pikepdf is not None
+
+
+def _filters(image):
+    value = image.get('/Filter')
+    if value is None:
+        return []
+    if isinstance(value, pikepdf.Array):
+        return [str(name) for name in value]
+    return [str(value)]
+
+
+def _color_mode(image):
+    """Modo de Pillow del espacio de color, o None si no se admite (CMYK, Indexed, Lab...)"""
+    color_space = image.get('/ColorSpace')
+    if isinstance(color_space, pikepdf.Name):
+        return COLOR_MODES.get(str(color_space))
+    if isinstance(color_space, pikepdf.Array) and len(color_space) == 2 and color_space[0] == '/ICCBased':
+        return ICC_MODES.get(int(color_space[1].get('/N', 0)))
+    return None
+
+
+def _image_hash(image, raw):
+    """Hash del contenido codificado y de las claves que determinan cómo se interpreta"""
+    sha256 = hashlib.sha256(raw)
+    for key in ('/Filter', '/DecodeParms', '/Width', '/Height', '/BitsPerComponent', '/ColorSpace', '/Decode',
+                '/SMask', '/Mask', '/ImageMask'):
+        sha256.update(f'{key}={image.get(key)!r};'.encode('utf-8'))
+    return sha256.hexdigest()
+
+
+def _page_sizes(pdf):
+    """Tamaño de la primera página en la que aparece cada imagen, por objgen"""
+    sizes = {}
+    for page in pdf.pages:
+        box = [float(value) for value in page.mediabox]
+        size = (abs(box[2] - box[0]), abs(box[3] - box[1]))
+        xobjects = page.obj.get('/Resources', {}).get('/XObject', {})
+        for name in xobjects.keys():
+            sizes.setdefault(xobjects[name].objgen, size)
+    return sizes
+
+
+def _mask_objgens(pdf):
+    """Imágenes usadas como máscara (SMask o Mask): se dejan intactas para no degradar la transparencia"""
+    masks = set()
+    for obj in pdf.objects:
+        if isinstance(obj, pikepdf.Stream):
+            for key in ('/SMask', '/Mask'):
+                mask = obj.get(key)
+                if isinstance(mask, pikepdf.Stream):
+                    masks.add(mask.objgen)
+    return masks
+
+
+def build_task(image, raw, level, page_size):
+    """Datos de una imagen para recomprimirla en otro proceso, o None si no se debe tocar"""
+    if image.get('/ImageMask', False):
+        return None
+    width, height = int(image.Width), int(image.Height)
+    if width * height < MIN_IMAGE_PIXELS:
+        return None
+    bits = int(image.get('/BitsPerComponent', 8))
+    filters = _filters(image)
+    # Resolución efectiva suponiendo que la imagen ocupa la página (misma estimación que el análisis previo)
+    dpi = min(width / (max(page_size[0], 1) / 72), height / (max(page_size[1], 1) / 72))
+    target_dpi = LEVEL_MONO_DPI[level] if bits == 1 else LEVEL_COLOR_DPI[level]
+    scale = target_dpi / dpi if dpi > target_dpi * DOWNSAMPLE_THRESHOLD else 1.0
+
+    if bits == 1 and set(filters) <= LOSSLESS_FILTERS and _color_mode(image) in ('L', None):
+        return {'kind': 'bilevel', 'data': image.read_bytes(), 'width': width, 'height': height, 'scale': scale}
+    mode = _color_mode(image)
+    if bits != 8 or mode is None:
+        return None
+    if filters == ['/DCTDecode']:
+        return {'kind': 'jpeg', 'data': raw, 'width': width, 'height': height, 'mode': mode, 'scale': scale,
+                'quality': LEVEL_JPEG_QUALITY[level]}
+    if set(filters) <= LOSSLESS_FILTERS:
+        return {'kind': 'raw', 'data': image.read_bytes(), 'width': width, 'height': height, 'mode': mode,
+                'scale': scale, 'quality': LEVEL_JPEG_QUALITY[level]}
+    return None
+
+
+def _ccitt_g4(image):
+    """Codificar una imagen bitonal en CCITT G4 (a través de libtiff, en una sola tira)"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='TIFF', compression='group4', strip_size=2 ** 31 - 1)
+    tiff = Image.open(io.BytesIO(buffer.getvalue()))
+    offset, length = tiff.tag_v2[273][0], tiff.tag_v2[279][0]
+    return buffer.getvalue()[offset:offset + length]
+
+
+def recompress_image(task):
+    """Recomprimir una imagen (en un proceso del pool); devuelve (datos, filtro, ancho, alto, DecodeParms) o None"""
+    width, height = task['width'], task['height']
+    if task['kind'] == 'jpeg':
+        image = Image.open(io.BytesIO(task['data']))
+        if image.mode != task['mode']:
+            return None
+    elif task['kind'] == 'raw':
+        image = Image.frombytes(task['mode'], (width, height), task['data'])
+    else:
+        # Las filas de 1 bit del PDF están alineadas a byte, igual que el modo '1' de Pillow
+        image = Image.frombytes('1', (width, height), task['data'])
+
+    if task['scale'] < 1:
+        size = (max(1, round(width * task['scale'])), max(1, round(height * task['scale'])))
+        if task['kind'] == 'bilevel':
+            image = image.convert('L').resize(size, Image.BOX).point(lambda value: 255 if value >= 128 else 0, '1')
+        else:
+            image = image.resize(size, Image.LANCZOS)
+
+    if task['kind'] == 'bilevel':
+        # Pillow escribe el modo '1' con 0 = negro: las rachas "negras" de CCITT son los bits a 1
+        parameters = {'/K': -1, '/Columns': image.width, '/Rows': image.height, '/BlackIs1': True}
+        return _ccitt_g4(image), '/CCITTFaxDecode', image.width, image.height, parameters
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=task['quality'], optimize=True)
+    return buffer.getvalue(), '/DCTDecode', image.width, image.height, None
+
+
+def _replace_image(image, data, filter_name, width, height, parameters):
+    if '/DecodeParms' in image:
+        del image['/DecodeParms']
+    image.write(data, filter=pikepdf.Name(filter_name),
+                decode_parms=pikepdf.Dictionary(parameters) if parameters else None)
+    image.Width = width
+    image.Height = height
+    if filter_name == '/CCITTFaxDecode':
+        image.BitsPerComponent = 1
+
+
+def _unify_duplicates(pdf, canonical):
+    """Hacer que los recursos apunten a una única copia de cada imagen repetida; las demás no se guardan"""
+    for obj in pdf.objects:
+        if not isinstance(obj, (pikepdf.Dictionary, pikepdf.Stream)):
+            continue
+        resources = obj.get('/Resources')
+        xobjects = resources.get('/XObject') if isinstance(resources, pikepdf.Dictionary) else None
+        if not isinstance(xobjects, pikepdf.Dictionary):
+            continue
+        for name in list(xobjects.keys()):
+            target = canonical.get(xobjects[name].objgen)
+            if target is not None:
+                xobjects[name] = target
+
+
+def compress_images(input_path, output_path, level, workers=None):
+    """Recomprimir las imágenes de un PDF en paralelo y guardar el resultado; devuelve un resumen"""
+    start = time.perf_counter()
+    summary = {'images': 0, 'unique': 0, 'recompressed': 0, 'duplicates_merged': 0, 'bytes_saved': 0}
+    with pikepdf.open(input_path) as pdf:
+        page_sizes = _page_sizes(pdf)
+        masks = _mask_objgens(pdf)
+        groups = {}
+        for obj in pdf.objects:
+            if not isinstance(obj, pikepdf.Stream) or obj.get('/Subtype') != '/Image' or obj.objgen in masks:
+                continue
+            summary['images'] += 1
+            raw = obj.read_raw_bytes()
+            groups.setdefault(_image_hash(obj, raw), []).append((obj, raw))
+        summary['unique'] = len(groups)
+
+        # Una tarea por imagen distinta; las copias idénticas comparten el resultado
+        tasks = {}
+        for key, copies in groups.items():
+            image, raw = copies[0]
+            task = build_task(image, raw, level, page_sizes.get(image.objgen, DEFAULT_PAGE_SIZE))
+            if task is not None:
+                tasks[key] = task
+        if len(tasks) > 1 and (workers or os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = dict(zip(tasks, executor.map(recompress_image, tasks.values())))
+        else:
+            results = {key: recompress_image(task) for key, task in tasks.items()}
+
+        canonical = {}
+        for key, copies in groups.items():
+            image, raw = copies[0]
+            result = results.get(key)
+            # Solo se sustituye la imagen si el resultado es menor que el original codificado
+            if result is not None and len(result[0]) < len(raw):
+                _replace_image(image, *result)
+                summary['recompressed'] += 1
+                summary['bytes_saved'] += len(raw) - len(result[0])
+            for duplicate, _ in copies[1:]:
+                canonical[duplicate.objgen] = image
+        if canonical:
+            _unify_duplicates(pdf, canonical)
+            summary['duplicates_merged'] = len(canonical)
+
+        pdf.save(output_path, compress_streams=True, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def main():
+    """Punto de entrada como subproceso del servicio"""
+    parser = argparse.ArgumentParser(description='Recompresión de las imágenes de un PDF')
+    parser.add_argument('--level', type=int, choices=(1, 2, 3), default=2, help='Nivel de compresión')
+    parser.add_argument('--workers', type=int, help='Procesos para recomprimir imágenes (por defecto, número de CPUs)')
+    parser.add_argument('input', help='PDF de entrada')
+    parser.add_argument('output', help='PDF de salida')
+    args = parser.parse_args()
+
+    if not available():
+        print('El motor de imágenes necesita pikepdf y Pillow', file=sys.stderr)
+        sys.exit(2)
+    try:
+        summary = compress_images(args.input, args.output, args.level, args.workers)
+    except pikepdf.PdfError as e:
+        print(f'PDF no válido: {str(e)}', file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
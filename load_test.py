@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga y benchmark del servicio de compresión
+- Genera corpus sintéticos de PDFs (páginas, densidad de imágenes y tamaños distintos) de forma reproducible
+- Lanza peticiones concurrentes contra la app Flask (cliente de pruebas, sin red) con el gs local
+- Simula varios workers de Gunicorn multiplicando la capacidad del planificador y del pool de Ghostscript
+- Informa p50/p95/p99, archivos/s y MB/s por workers, nivel y concurrencia y guarda los resultados en JSON
+- Compara con una ejecución anterior para detectar regresiones entre commits
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+from scheduler import FairScheduler
+
+# Corpus por defecto: (nombre, páginas, imágenes por página, lado de la imagen en píxeles, filtro)
+# Intérpretes del pool de un único worker, antes de que configure_workers los multiplique
+BASE_GS_POOL_SIZE = app.GS_POOL_SIZE
+
+DEFAULT_CORPUS = [
+    ('texto_10p', 10, 0, 0, None),
+    ('escaneo_5p', 5, 1, 1600, 'FlateDecode'),
+    ('fotos_20p', 20, 2, 400, 'FlateDecode'),
+    ('sin_filtro_3p', 3, 1, 800, None),
+    ('largo_120p', 120, 1, 200, 'FlateDecode')
+]
+
+
+def synthetic_image(rng, side):
+    """Imagen RGB con bandas de color y ruido: se comprime como una foto escaneada, ni trivial ni aleatoria"""
+    noise_length = side * 3 // 2
+    rows = []
+    for row in range(side):
+        if row % 16 == 0:
+            band = (bytes(rng.randrange(256) for _ in range(3)) * side)[:side * 3]
+        line = bytearray(band)
+        offset = rng.randrange(side * 3 - noise_length + 1)
+        line[offset:offset + noise_length] = rng.randbytes(noise_length)
+        rows.append(bytes(line))
+    return b''.join(rows)
+
+
+def make_pdf(path, pages, images_per_page, image_side, image_filter, seed):
+    """Escribir un PDF válido con xref clásica; devuelve el tamaño en bytes"""
+    rng = random.Random(seed)
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None]
+    page_refs = []
+    for page in range(pages):
+        image_refs = []
+        for _ in range(images_per_page):
+            raw = synthetic_image(rng, image_side)
+            data = zlib.compress(raw, 6) if image_filter == 'FlateDecode' else raw
+            filter_entry = f' /Filter /{image_filter}' if image_filter else ''
+            objects.append(f'<< /Type /XObject /Subtype /Image /Width {image_side} /Height {image_side} '
+                           f'/ColorSpace /DeviceRGB /BitsPerComponent 8{filter_entry} '
+                           f'/Length {len(data)} >>\nstream\n'.encode() + data + b'\nendstream')
+            image_refs.append(len(objects))
+        text = ' '.join(f'Linea {line} de la pagina {page + 1}' for line in range(40))
+        content = [f'BT /F1 10 Tf 36 760 Td ({text[:90]}) Tj ET'.encode()]
+        for index, ref in enumerate(image_refs):
+            content.append(f'q 270 0 0 270 {36 + index * 280} 300 cm /Im{ref} Do Q'.encode())
+        stream = b'\n'.join(content)
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        content_ref = len(objects)
+        xobjects = ' '.join(f'/Im{ref} {ref} 0 R' for ref in image_refs)
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {content_ref} 0 R '
+                       f'/Resources << /Font << /F1 << /Type /Font /Subtype /Type1 /BaseFont /Helvetica >> >> '
+                       f'/XObject << {xobjects} >> >> >>'.encode())
+        page_refs.append(len(objects))
+    kids = ' '.join(f'{ref} 0 R' for ref in page_refs)
+    objects[1] = f'<< /Type /Pages /Kids [{kids}] /Count {pages} >>'.encode()
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref_offset = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        output += b'%010d 00000 n \n' % offset
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset)
+    with open(path, 'wb') as f:
+        f.write(output)
+    return len(output)
+
+
+def generate_corpus(corpus_dir, seed):
+    """Generar el corpus por defecto en corpus_dir; devuelve la lista de documentos"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = []
+    for index, (name, pages, images_per_page, image_side, image_filter) in enumerate(DEFAULT_CORPUS):
+        path = os.path.join(corpus_dir, f'{name}.pdf')
+        size = make_pdf(path, pages, images_per_page, image_side, image_filter, seed + index)
+        corpus.append({'name': name, 'path': path, 'pages': pages, 'size': size})
+    return corpus
+
+
+def percentile(values, percent):
+    """Percentil por rango más cercano de una lista ordenada"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+def configure_workers(workers):
+    """Dar a la app la capacidad de un nodo con workers procesos de Gunicorn
+
+    Cada worker tiene su propio planificador y su propio pool de Ghostscript, así que el nodo admite
+    workers veces las compresiones simultáneas de cada carril y workers veces los intérpretes del pool.
+    """
+    lanes = [dict(lane, concurrency=lane['concurrency'] * workers) for lane in app.SCHEDULER_LANES]
+    app.scheduler = FairScheduler(lanes, app.JOB_QUEUE_SIZE * workers)
+    with app.gs_pool_lock:
+        if app.gs_pool is not None:
+            app.gs_pool.close()
+            app.gs_pool = None
+        app.GS_POOL_SIZE = BASE_GS_POOL_SIZE * workers
+
+
+def run_scenario(client, corpus, level, concurrency, requests_count, engine='gs', workers=1):
+    """Lanzar requests_count peticiones con la concurrencia y el motor indicados y devolver las métricas"""
+    contents = [(document['name'], open(document['path'], 'rb').read()) for document in corpus]
+
+    def send(index):
+        name, data = contents[index % len(contents)]
+        start = time.perf_counter()
+        # Modo stream: el resultado no queda en disco entre peticiones
+        response = client.post('/compress?stream=1', data={'file': (io.BytesIO(data), f'{name}.pdf'),
+                                                           'level': str(level), 'engine': engine})
+        response.get_data()
+        output_size = int(response.headers.get('X-Compressed-Size', 0))
+        return time.perf_counter() - start, len(data), output_size, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(send, range(requests_count)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(seconds for seconds, _, _, status in outcomes if status == 200)
+    input_bytes = sum(size for _, size, _, status in outcomes if status == 200)
+    output_bytes = sum(size for _, _, size, status in outcomes if status == 200)
+    return {
+        'workers': workers,
+        'engine': engine,
+        'level': level,
+        'concurrency': concurrency,
+        'requests': requests_count,
+        'errors': sum(1 for _, _, _, status in outcomes if status != 200),
+        'wall_seconds': round(wall, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+        'files_per_second': round(len(latencies) / wall, 3),
+        'mb_per_second': round(input_bytes / (1024 * 1024) / wall, 3),
+        # Tamaño de salida respecto a la entrada, para comparar lo que comprime cada motor
+        'output_percent': round(output_bytes / input_bytes * 100, 1) if input_bytes else None
+    }
+
+
+def environment_info():
+    """Datos de la ejecución para poder comparar resultados entre commits"""
+    def output_of(command):
+        try:
+            return subprocess.run(command, capture_output=True, text=True, timeout=10).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    return {
+        'commit': output_of(['git', 'rev-parse', '--short', 'HEAD']),
+        'ghostscript': output_of(['gs', '--version']),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def compare_results(current, previous, max_regression):
+    """Comparar con una ejecución anterior; devuelve True si alguna configuración empeora más de max_regression %"""
+    # Los resultados anteriores a --engines son todos de Ghostscript y los anteriores a --workers, de un worker
+    previous_by_key = {(result.get('workers', 1), result.get('engine', 'gs'), result['level'], result['concurrency']): result
+                       for result in previous['results']}
+    regressed = False
+    print(f"\n📊 Comparación con {previous['environment'].get('commit')}")
+    print(f"{'workers':>7} {'motor':>6} {'nivel':>6} {'conc.':>6} {'p95 antes':>10} {'p95 ahora':>10} {'arch/s antes':>13} {'arch/s ahora':>13}")
+    for result in current['results']:
+        before = previous_by_key.get((result['workers'], result['engine'], result['level'], result['concurrency']))
+        if not before or not before['p95_ms'] or not result['p95_ms']:
+            continue
+        latency_change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+        throughput_change = ((before['files_per_second'] - result['files_per_second'])
+                             / before['files_per_second'] * 100) if before['files_per_second'] else 0
+        mark = ''
+        if latency_change > max_regression or throughput_change > max_regression:
+            regressed = True
+            mark = ' ❌'
+        print(f"{result['workers']:>7} {result['engine']:>6} {result['level']:>6} {result['concurrency']:>6} {before['p95_ms']:>10} {result['p95_ms']:>10} "
+              f"{before['files_per_second']:>13} {result['files_per_second']:>13}{mark}")
+    return regressed
+
+
+def main():
+    """Función principal de la prueba de carga"""
+    parser = argparse.ArgumentParser(description='Prueba de carga del servicio de compresión de PDF')
+    parser.add_argument('--levels', default='1,2,3', help='Niveles separados por comas')
+    parser.add_argument('--engines', default='gs', help='Motores separados por comas (gs, images)')
+    parser.add_argument('--workers', default='1',
+                        help='Workers de Gunicorn simulados separados por comas (multiplican la capacidad del nodo)')
+    parser.add_argument('--concurrency', default='1,4,8', help='Peticiones simultáneas separadas por comas')
+    parser.add_argument('--requests', type=int, default=20, help='Peticiones por configuración')
+    parser.add_argument('--corpus-dir', help='Carpeta del corpus (por defecto, una temporal)')
+    parser.add_argument('--seed', type=int, default=1234, help='Semilla del corpus sintético')
+    parser.add_argument('--output', default='load_test_results.json', help='Archivo JSON de resultados')
+    parser.add_argument('--compare', help='JSON de una ejecución anterior con el que comparar')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help='Empeoramiento máximo permitido en p95 o archivos/s (%%) al comparar')
+    parser.add_argument('--use-cache', action='store_true',
+                        help='No desactivar la caché de resultados (por defecto se desactiva)')
+    args = parser.parse_args()
+
+    if not shutil.which('gs'):
+        print("❌ Ghostscript no está instalado (se necesita un gs local)")
+        sys.exit(1)
+
+    engines = args.engines.split(',')
+    worker_counts = [int(value) for value in args.workers.split(',')]
+    if any(workers < 1 for workers in worker_counts):
+        print("❌ --workers necesita valores mayores que 0")
+        sys.exit(1)
+    if 'images' in engines and not app.IMAGE_ENGINE_ENABLED:
+        print("❌ El motor de imágenes no está disponible (se necesitan pikepdf y Pillow)")
+        sys.exit(1)
+
+    # Las peticiones repiten el mismo corpus: sin caché cada una ejecuta Ghostscript
+    if not args.use_cache:
+        app.CACHE_MAX_BYTES = 0
+    # Se mide el rendimiento con la concurrencia pedida: el control de admisión rechazaría el exceso con 503
+    app.ADMISSION_ENABLED = False
+    client = app.app.test_client()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus = generate_corpus(args.corpus_dir or os.path.join(temp_dir, 'corpus'), args.seed)
+        total_mb = sum(document['size'] for document in corpus) / (1024 * 1024)
+        print(f"🚀 Prueba de carga: {len(corpus)} documentos sintéticos ({total_mb:.2f} MB), "
+              f"{args.requests} peticiones por configuración")
+        print("=" * 50)
+        print(f"{'workers':>7} {'motor':>6} {'nivel':>6} {'conc.':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} "
+              f"{'arch/s':>8} {'MB/s':>8} {'salida %':>9} {'errores':>8}")
+
+        results = []
+        for workers in worker_counts:
+            configure_workers(workers)
+            for engine in engines:
+                for level in [int(value) for value in args.levels.split(',')]:
+                    for concurrency in [int(value) for value in args.concurrency.split(',')]:
+                        result = run_scenario(client, corpus, level, concurrency, args.requests, engine, workers)
+                        results.append(result)
+                        print(f"{workers:>7} {engine:>6} {level:>6} {concurrency:>6} {result['p50_ms']:>9} "
+                              f"{result['p95_ms']:>9} {result['p99_ms']:>9} {result['files_per_second']:>8} "
+                              f"{result['mb_per_second']:>8} {result['output_percent']:>9} {result['errors']:>8}")
+
+    report = {
+        'environment': environment_info(),
+        'parameters': {'requests': args.requests, 'seed': args.seed, 'cache': args.use_cache, 'engines': engines,
+                       'workers': worker_counts},
+        'corpus': [{key: document[key] for key in ('name', 'pages', 'size')} for document in corpus],
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Resultados guardados en {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f)
+        if compare_results(report, previous, args.max_regression):
+            print(f"❌ Regresión superior al {args.max_regression}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Análisis previo (pre-flight) de PDFs
+Lee solo la tabla xref, el trailer y las cabeceras de los objetos del archivo mapeado en memoria,
+sin renderizar ni descomprimir streams, para estimar cuánto puede ganar cada nivel de compresión.
+"""
+
+import mmap
+import os
+import re
+
+# Resolución objetivo de Ghostscript por nivel (/prepress, /ebook, /screen)
+LEVEL_COLOR_DPI = {1: 300, 2: 150, 3: 72}
+LEVEL_MONO_DPI = {1: 1200, 2: 300, 3: 300}
+# Ghostscript solo reduce imágenes que superan la resolución objetivo en este factor
+DOWNSAMPLE_THRESHOLD = 1.5
+# Ahorro estimado al pasar imágenes sin pérdida (Flate o sin filtro) a JPEG en cada nivel
+LOSSLESS_TO_JPEG_SAVING = {1: 0.3, 2: 0.5, 3: 0.6}
+# Ahorro estimado al comprimir streams que no tienen ningún filtro
+UNCOMPRESSED_STREAM_SAVING = 0.6
+# Ahorro estimado al crear un subconjunto de una fuente incrustada completa
+FONT_SUBSET_SAVING = 0.5
+
+LOSSY_FILTERS = {b'DCTDecode', b'JPXDecode', b'JBIG2Decode', b'CCITTFaxDecode'}
+
+HEADER_WINDOW = 4096
+DEFAULT_PAGE_SIZE = (612.0, 792.0)  # Carta, en puntos
+
+_OBJ_HEADER = re.compile(rb'(\d+)\s+(\d+)\s+obj\b')
+_XREF_SUBSECTION = re.compile(rb'\s*(\d+)\s+(\d+)[ \t]*\r?\n?')
+_STREAM_KEYWORD = re.compile(rb'\bstream\r?\n')
+_PREV = re.compile(rb'/Prev\s+(\d+)')
+_XREF_STM = re.compile(rb'/XRefStm\s')
+_IMAGE = re.compile(rb'/Subtype\s*/Image\b')
+_PAGE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+_FONT_DESCRIPTOR = re.compile(rb'/Type\s*/FontDescriptor\b')
+_FONT_FILE = re.compile(rb'/FontFile[23]?\s*(\d+)\s+\d+\s+R')
+_SUBSET_FONT_NAME = re.compile(rb'/FontName\s*/[A-Z]{6}\+')
+_MEDIABOX = re.compile(rb'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]')
+_FILTER = re.compile(rb'/Filter\s*(/[A-Za-z0-9]+|\[[^\]]*\])')
+_NAME = re.compile(rb'/([A-Za-z0-9]+)')
+
+
+def _direct_int(header, key):
+    """Valor entero directo de una clave del diccionario (None si falta o es una referencia indirecta)"""
+    match = re.search(rb'/' + key + rb'\s+(\d+)\b(?!\s+\d+\s+R)', header)
+    return int(match.group(1)) if match else None
+
+
+def _read_xref_table(mm):
+    """Leer las tablas xref clásicas (siguiendo /Prev); devuelve {número de objeto: offset}
+
+    Lanza ValueError si el archivo usa streams xref, que obligan a recorrer las cabeceras.
+    """
+    tail = mm[max(0, len(mm) - 2048):]
+    index = tail.rfind(b'startxref')
+    if index < 0:
+        raise ValueError('startxref no encontrado')
+    match = re.match(rb'startxref\s+(\d+)', tail[index:])
+    if not match:
+        raise ValueError('startxref no válido')
+
+    offsets = {}
+    offset = int(match.group(1))
+    visited = set()
+    while offset is not None and offset not in visited:
+        visited.add(offset)
+        if mm[offset:offset + 4] != b'xref':
+            raise ValueError('stream xref')
+        position = offset + 4
+        while True:
+            match = _XREF_SUBSECTION.match(mm, position)
+            if not match:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            position = match.end()
+            for number in range(first, first + count):
+                entry = mm[position:position + 20]
+                if len(entry) < 18 or entry[17:18] not in (b'n', b'f'):
+                    raise ValueError('entrada xref no válida')
+                if entry[17:18] == b'n' and number not in offsets:
+                    offsets[number] = int(entry[:10])
+                position += 20
+        trailer_start = mm.find(b'trailer', position, position + 64)
+        if trailer_start < 0:
+            raise ValueError('trailer no encontrado')
+        trailer = mm[trailer_start:trailer_start + HEADER_WINDOW]
+        trailer = trailer[:trailer.find(b'startxref')] if b'startxref' in trailer else trailer
+        if _XREF_STM.search(trailer):
+            raise ValueError('archivo híbrido con stream xref')
+        prev = _PREV.search(trailer)
+        offset = int(prev.group(1)) if prev else None
+    return offsets
+
+
+def _scan_object_offsets(mm):
+    """Localizar las cabeceras de objetos recorriendo el archivo (PDFs con streams xref o xref dañada)"""
+    offsets = {}
+    for match in _OBJ_HEADER.finditer(mm):
+        offsets[int(match.group(1))] = match.start()
+    return offsets
+
+
+def _image_dpi(image, page_size):
+    """Resolución efectiva estimada suponiendo que la imagen ocupa la página entera"""
+    page_width_in = max(page_size[0], 1) / 72
+    page_height_in = max(page_size[1], 1) / 72
+    # La menor de las dos proporciones: la imagen encaja en la página manteniendo su aspecto
+    return min(image['width'] / page_width_in, image['height'] / page_height_in)
+
+
+def analyze_pdf(path):
+    """Analizar un PDF sin renderizarlo y estimar la ganancia de cada nivel de compresión"""
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        try:
+            offsets = _read_xref_table(mm)
+            xref = 'table'
+        except (ValueError, IndexError):
+            offsets = _scan_object_offsets(mm)
+            xref = 'scan'
+
+        numbers_by_offset = {offset: number for number, offset in offsets.items()}
+        sorted_offsets = sorted(set(offsets.values())) + [file_size]
+        next_offset = {offset: sorted_offsets[index + 1] for index, offset in enumerate(sorted_offsets[:-1])}
+
+        images, page_sizes, filters = [], [], {}
+        fonts = {'embedded': 0, 'not_embedded': 0, 'embedded_not_subset': 0}
+        full_font_files = set()
+        stream_lengths = {}
+        uncompressed_stream_bytes = 0
+        for offset in sorted_offsets[:-1]:
+            window = mm[offset:min(offset + HEADER_WINDOW, file_size)]
+            stream = _STREAM_KEYWORD.search(window)
+            end = window.find(b'endobj')
+            header_end = min(position for position in (stream.start() if stream else -1, end, len(window))
+                             if position >= 0)
+            header = window[:header_end]
+
+            if _PAGE.search(header):
+                mediabox = _MEDIABOX.search(header)
+                if mediabox:
+                    x0, y0, x1, y1 = (float(value) for value in mediabox.groups())
+                    page_sizes.append((abs(x1 - x0), abs(y1 - y0)))
+                else:
+                    page_sizes.append(None)
+            if _FONT_DESCRIPTOR.search(header):
+                font_file = _FONT_FILE.search(header)
+                fonts['embedded' if font_file else 'not_embedded'] += 1
+                if font_file and not _SUBSET_FONT_NAME.search(header):
+                    fonts['embedded_not_subset'] += 1
+                    full_font_files.add(int(font_file.group(1)))
+            if not stream or (end >= 0 and end < stream.start()):
+                continue
+
+            length = _direct_int(header, b'Length')
+            if length is None:
+                length = max(next_offset[offset] - (offset + stream.end()), 0)
+            filter_match = _FILTER.search(header)
+            stream_filters = _NAME.findall(filter_match.group(1)) if filter_match else []
+            for name in stream_filters:
+                filters[name.decode('ascii')] = filters.get(name.decode('ascii'), 0) + 1
+            if not stream_filters:
+                uncompressed_stream_bytes += length
+            if offset in numbers_by_offset:
+                stream_lengths[numbers_by_offset[offset]] = length
+
+            if _IMAGE.search(header):
+                images.append({
+                    'width': _direct_int(header, b'Width') or 0,
+                    'height': _direct_int(header, b'Height') or 0,
+                    'bits': _direct_int(header, b'BitsPerComponent') or 8,
+                    'filters': set(stream_filters),
+                    'bytes': length
+                })
+
+    known_sizes = [size for size in page_sizes if size]
+    page_size = sorted(known_sizes)[len(known_sizes) // 2] if known_sizes else DEFAULT_PAGE_SIZE
+    for image in images:
+        image['dpi'] = _image_dpi(image, page_size)
+
+    full_font_bytes = sum(stream_lengths.get(number, 0) for number in full_font_files)
+    predicted_gain = {}
+    for level in (1, 2, 3):
+        saving = uncompressed_stream_bytes * UNCOMPRESSED_STREAM_SAVING + full_font_bytes * FONT_SUBSET_SAVING
+        for image in images:
+            target = LEVEL_MONO_DPI[level] if image['bits'] == 1 else LEVEL_COLOR_DPI[level]
+            size_after = image['bytes']
+            if image['dpi'] > target * DOWNSAMPLE_THRESHOLD:
+                size_after *= (target / image['dpi']) ** 2
+            if image['bits'] > 1 and not image['filters'] & LOSSY_FILTERS:
+                size_after *= 1 - LOSSLESS_TO_JPEG_SAVING[level]
+            # Los streams sin filtro ya se contaron arriba
+            if image['filters']:
+                saving += image['bytes'] - size_after
+        predicted_gain[str(level)] = round(min(saving / file_size * 100, 100.0), 2) if file_size else 0.0
+
+    image_dpis = sorted(image['dpi'] for image in images)
+    return {
+        'xref': xref,
+        'objects': len(offsets),
+        'pages': len(page_sizes),
+        'images': len(images),
+        'image_bytes': sum(image['bytes'] for image in images),
+        'max_image_dpi': round(image_dpis[-1]) if image_dpis else None,
+        'median_image_dpi': round(image_dpis[len(image_dpis) // 2]) if image_dpis else None,
+        'filters': filters,
+        'fonts': fonts,
+        'uncompressed_stream_bytes': uncompressed_stream_bytes,
+        'predicted_gain_percent': predicted_gain
+    }
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+Biblioteca de compresión de PDFs, independiente del servicio
+Construye las líneas de comandos de Ghostscript (niveles y perfiles) y del motor por imágenes y las ejecuta
+como subprocesos con los límites de recursos, recogiendo su uso de CPU y memoria. Importarla no tiene efectos
+secundarios: no lee config.json, no crea carpetas ni arranca hilos. La usan el servicio (app.py) y la
+compresión masiva de carpetas (bulk_compress.py).
+"""
+
+import hashlib
+import json
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+from werkzeug.utils import secure_filename
+
+from ghostscript_pool import GhostscriptCancelled
+from image_engine import LEVEL_JPEG_QUALITY
+from pdf_analyzer import LEVEL_COLOR_DPI, LEVEL_MONO_DPI, analyze_pdf
+from resource_limits import ResourceLimits, rusage_summary
+
+try:
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    gevent_monkey = None
+
+LEVEL_PDFSETTINGS = {1: '/prepress', 2: '/ebook', 3: '/screen'}
+
+# Opciones admitidas en un perfil: tipo y rango válido
+PROFILE_OPTIONS = {
+    'level': (int, 1, 3),
+    'image_dpi': (int, 10, 2400),
+    'mono_image_dpi': (int, 10, 2400),
+    'jpeg_quality': (int, 1, 100),
+    'grayscale': (bool, None, None),
+    'subset_fonts': (bool, None, None),
+    'compress_streams': (bool, None, None),
+    'rendering_threads': (int, 1, 64),
+    'description': (str, None, None)
+}
+
+ENGINES = ('gs', 'images')
+IMAGE_ENGINE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_engine.py')
+DEFAULT_TIMEOUT_SECONDS = 300
+CHUNK_SIZE = 1024 * 1024
+
+
+class CompressionError(Exception):
+    """Ghostscript o el motor por imágenes terminaron con error"""
+
+
+class CompressionInputError(CompressionError):
+    """El motor rechazó la entrada (PDF dañado, cifrado...): terminó con error sin que lo matara una señal ni
+    superara un límite de recursos"""
+
+
+def validate_profile(name, settings):
+    """Comprobar un perfil de config.json; devuelve la lista de errores"""
+    errors = []
+    if not isinstance(name, str) or not name or secure_filename(name) != name or name in ('1', '2', '3'):
+        errors.append(f"nombre de perfil no válido: {name!r}")
+    if not isinstance(settings, dict):
+        return errors + [f"el perfil {name!r} debe ser un objeto"]
+    for option, value in settings.items():
+        if option not in PROFILE_OPTIONS:
+            errors.append(f"opción desconocida en el perfil {name!r}: {option}")
+            continue
+        expected, minimum, maximum = PROFILE_OPTIONS[option]
+        # bool es subclase de int: se exige el tipo exacto
+        if type(value) is not expected:
+            errors.append(f"{name}.{option} debe ser de tipo {expected.__name__}")
+        elif minimum is not None and not minimum <= value <= maximum:
+            errors.append(f"{name}.{option} debe estar entre {minimum} y {maximum}")
+    return errors
+
+
+def build_ghostscript_args(level, settings=None):
+    """Argumentos de Ghostscript de un nivel o perfil, sin salida ni entrada: (antes de la salida, después)"""
+    settings = settings or {}
+    compatibility = '1.5' if settings.get('compress_streams') else '1.4'
+    prefix = ['gs', '-sDEVICE=pdfwrite', f'-dCompatibilityLevel={compatibility}',
+              f'-dPDFSETTINGS={LEVEL_PDFSETTINGS[level]}', '-dNOPAUSE', '-dQUIET', '-dBATCH']
+    suffix = []
+    if 'image_dpi' in settings:
+        for kind in ('Color', 'Gray'):
+            prefix += [f'-dDownsample{kind}Images=true', f'-d{kind}ImageDownsampleType=/Bicubic',
+                       f'-d{kind}ImageResolution={settings["image_dpi"]}']
+    if 'mono_image_dpi' in settings:
+        prefix += ['-dDownsampleMonoImages=true', f'-dMonoImageResolution={settings["mono_image_dpi"]}']
+    if 'jpeg_quality' in settings:
+        # pdfwrite no tiene un parámetro de calidad: se fija el QFactor de DCTEncode (0.15 ≈ 100, 2.35 ≈ 0)
+        qfactor = round(0.15 + (100 - settings['jpeg_quality']) / 100 * 2.2, 2)
+        image_dict = f'<< /QFactor {qfactor} /Blend 1 /HSamples [2 1 1 2] /VSamples [2 1 1 2] >>'
+        for kind in ('Color', 'Gray'):
+            prefix += [f'-dAutoFilter{kind}Images=false', f'-s{kind}ImageFilter=/DCTEncode']
+        suffix = ['-c', f'<< /ColorImageDict {image_dict} /GrayImageDict {image_dict} >> setdistillerparams', '-f']
+    if settings.get('grayscale'):
+        prefix += ['-sColorConversionStrategy=Gray', '-dProcessColorModel=/DeviceGray']
+    if 'subset_fonts' in settings:
+        prefix.append(f'-dSubsetFonts={str(settings["subset_fonts"]).lower()}')
+    if 'compress_streams' in settings:
+        value = str(settings['compress_streams']).lower()
+        prefix += [f'-dWriteObjStms={value}', f'-dWriteXRefStm={value}']
+    if 'rendering_threads' in settings:
+        prefix.append(f'-dNumRenderingThreads={settings["rendering_threads"]}')
+    return tuple(prefix), tuple(suffix)
+
+
+def build_arguments(profiles):
+    """Argumentos de Ghostscript por nivel (1, 2, 3) y por nombre de perfil (perfiles ya validados)"""
+    arguments = {level: build_ghostscript_args(level) for level in LEVEL_PDFSETTINGS}
+    for name, settings in profiles.items():
+        arguments[name] = build_ghostscript_args(settings.get('level', 2), settings)
+    return arguments
+
+
+def image_engine_command(level, input_path, output_path, workers=None):
+    """Línea de comandos del motor por imágenes (un subproceso con su propio pool de procesos)"""
+    command = [sys.executable, IMAGE_ENGINE_SCRIPT, '--level', str(level)]
+    if workers:
+        command += ['--workers', str(workers)]
+    return command + [input_path, output_path]
+
+
+def file_sha256(path):
+    """SHA-256 del contenido de un archivo, leído por bloques"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_or_copy(source_path, target_path):
+    """Crear un enlace duro o copiar si el sistema de archivos no lo permite"""
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+
+def output_size(command):
+    """Tamaño del archivo de salida de una invocación de Ghostscript, o None si no existe"""
+    for arg in command:
+        if arg.startswith('-sOutputFile='):
+            try:
+                return os.path.getsize(arg.split('=', 1)[1])
+            except OSError:
+                return None
+    return None
+
+
+class ForkedProcess:
+    """Proceso lanzado a través de un proceso intermedio que lo espera con os.wait4 y envía por una tubería
+    su estado y su uso de recursos; pid es el del comando, no el del intermedio"""
+
+    def __init__(self, intermediate_pid, pipe):
+        self.pid = None
+        self.intermediate_pid = intermediate_pid
+        self.returncode = None
+        self._pipe = pipe
+        self._buffer = b''
+
+    def read_message(self):
+        """Siguiente mensaje del proceso intermedio, o None si aún no ha llegado (tubería no bloqueante)"""
+        while b'\n' not in self._buffer:
+            try:
+                data = os.read(self._pipe, 4096)
+            except BlockingIOError:
+                return None
+            if not data:
+                raise ChildProcessError(f'El proceso intermedio de {self.pid} terminó sin informar')
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return json.loads(line)
+
+    def wait4(self):
+        """Como os.wait4(pid, os.WNOHANG): (0, 0, None) mientras el comando siga en ejecución"""
+        message = self.read_message()
+        if message is None:
+            return 0, 0, None
+        os.close(self._pipe)
+        self.reap_intermediate()
+        return self.pid, message['status'], resource.struct_rusage(message['rusage'])
+
+    def reap_intermediate(self):
+        """Recoger al proceso intermedio, que termina justo después de informar (si gevent no lo ha hecho ya)"""
+        try:
+            gevent_monkey.get_original('os', 'waitpid')(self.intermediate_pid, 0)
+        except ChildProcessError:
+            pass
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def fork_exec(command, stdout, stderr, preexec_fn=None):
+    """Lanzar un comando sin que gevent pueda recoger su estado
+
+    Cualquier Popen de gevent (también los de bibliotecas, como ctypes.util.find_library) activa un watcher
+    de SIGCHLD que recoge a todos los hijos del proceso antes que os.wait4. Por eso el comando lo lanza un
+    proceso intermedio (fork original, sin gevent) que lo espera él mismo y envía el resultado por una tubería.
+    """
+    fork = gevent_monkey.get_original('os', 'fork')
+    report_read, report_write = os.pipe2(os.O_CLOEXEC)
+    intermediate_pid = fork()
+    if intermediate_pid == 0:
+        # Proceso intermedio: solo llamadas al sistema hasta terminar (los demás descriptores no son heredables)
+        try:
+            exec_read, exec_write = os.pipe2(os.O_CLOEXEC)
+            pid = fork()
+            if pid == 0:
+                try:
+                    os.dup2(stdout.fileno(), 1)
+                    os.dup2(stderr.fileno(), 2)
+                    if preexec_fn is not None:
+                        preexec_fn()
+                    os.execvp(command[0], command)
+                except OSError as e:
+                    os.write(exec_write, str(e.errno).encode())
+                finally:
+                    os._exit(127)
+            os.close(exec_write)
+            # La tubería de exec se cierra sin datos si exec tuvo éxito
+            error = os.read(exec_read, 32)
+            if error:
+                os.wait4(pid, 0)
+                os.write(report_write, json.dumps({'error': int(error)}).encode() + b'\n')
+            else:
+                os.write(report_write, json.dumps({'pid': pid}).encode() + b'\n')
+                _, status, rusage = os.wait4(pid, 0)
+                os.write(report_write, json.dumps({'status': status, 'rusage': list(rusage)}).encode() + b'\n')
+        finally:
+            os._exit(0)
+    os.close(report_write)
+    process = ForkedProcess(intermediate_pid, report_read)
+    # El primer mensaje llega en cuanto el comando arranca (o falla exec)
+    message = process.read_message()
+    os.set_blocking(report_read, False)
+    if 'error' in message:
+        os.close(report_read)
+        process.reap_intermediate()
+        errno = message['error']
+        raise (FileNotFoundError if errno == 2 else OSError)(errno, os.strerror(errno), command[0])
+    process.pid = message['pid']
+    return process
+
+
+def spawn_process(command, stdout, stderr, preexec_fn=None):
+    """Lanzar un comando como proceso hijo; bajo gevent con fork_exec para no perder su estado y su uso
+    de recursos"""
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('os'):
+        return fork_exec(command, stdout, stderr, preexec_fn)
+    return subprocess.Popen(command, stdout=stdout, stderr=stderr, preexec_fn=preexec_fn)
+
+
+def wait_process(process, timeout=DEFAULT_TIMEOUT_SECONDS, cancel_event=None, on_poll=None):
+    """Esperar a que termine un proceso recogiendo su uso de recursos con os.wait4
+
+    on_poll se llama en cada comprobación mientras el proceso sigue en marcha. Devuelve (estado de wait,
+    rusage, motivo de parada: None, 'cancelled' o 'timeout').
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    reason = None
+    while True:
+        if isinstance(process, ForkedProcess):
+            pid, status, rusage = process.wait4()
+        else:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if on_poll is not None:
+            on_poll()
+        if reason is None:
+            if cancel_event is not None and cancel_event.is_set():
+                reason = 'cancelled'
+            elif time.monotonic() >= deadline:
+                reason = 'timeout'
+            if reason is not None:
+                process.kill()
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    # El proceso ya se recogió con wait4: evitar que Popen intente esperarlo de nuevo
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return status, rusage, reason
+
+
+def execute(command, limits=None, timeout=DEFAULT_TIMEOUT_SECONDS, cancel_event=None, stdout_marks=None):
+    """Ejecutar un comando como subproceso con los límites de recursos (ResourceLimits)
+
+    Devuelve un diccionario con code (negativo si lo mató una señal), signal, stdout, stderr, usage (pico de
+    memoria, CPU y tiempo de pared) y reason (None, 'cancelled' o 'timeout'). Lanza FileNotFoundError si el
+    ejecutable no existe. Con una lista en stdout_marks se añade (segundos desde el inicio, bytes de stdout
+    escritos) cada vez que crece la salida, con la resolución de la espera (hasta 0,1 s).
+    """
+    start = time.perf_counter()
+    # La salida va a archivos temporales: así el proceso se puede esperar con wait4 sin bloquear las tuberías
+    with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+        def mark_output():
+            # Ghostscript vacía stdout tras cada mensaje: el tamaño del archivo sigue a sus líneas "Page N"
+            size = os.fstat(stdout_file.fileno()).st_size
+            if not stdout_marks or size > stdout_marks[-1][1]:
+                stdout_marks.append((round(time.perf_counter() - start, 3), size))
+
+        process = spawn_process(command, stdout_file, stderr_file, limits.apply if limits is not None else None)
+        status, rusage, reason = wait_process(process, timeout, cancel_event,
+                                              mark_output if stdout_marks is not None else None)
+        if stdout_marks is not None:
+            mark_output()
+        usage = rusage_summary(rusage, time.perf_counter() - start)
+        stdout_file.seek(0)
+        stderr_file.seek(0)
+        stdout = stdout_file.read().decode('utf-8', 'replace')
+        stderr = stderr_file.read().decode('utf-8', 'replace')
+    return {'code': process.returncode, 'signal': os.WTERMSIG(status) if os.WIFSIGNALED(status) else None,
+            'stdout': stdout, 'stderr': stderr, 'usage': usage, 'reason': reason}
+
+
+def keep_smaller_result(input_path, output_path, original_size, move=False):
+    """Sustituir la salida por el original si la compresión no lo redujo; devuelve el ganador
+    ('compressed' u 'original')
+
+    Con move el original se mueve en lugar de copiarse (cuando la entrada ya no se necesita).
+    """
+    if os.path.getsize(output_path) < original_size:
+        return 'compressed'
+    if move:
+        os.replace(input_path, output_path)
+    else:
+        shutil.copyfile(input_path, output_path)
+    return 'original'
+
+
+class PdfCompressor:
+    """Compresión de archivos con los niveles, perfiles, motores y límites de config.json
+
+    El servicio usa una instancia para construir las líneas de comandos, las claves de caché y la decisión del
+    análisis previo, y ejecuta los comandos con su pool y sus métricas. compress() no usa caché ni el pool de
+    Ghostscript: cada compresión es un subproceso. Una instancia se puede usar desde varios hilos.
+    """
+
+    def __init__(self, profiles=None, limits=None, timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                 image_engine_workers=None, preflight_min_gain_percent=None):
+        self.profiles = profiles or {}
+        errors = [error for name, settings in self.profiles.items() for error in validate_profile(name, settings)]
+        if errors:
+            raise ValueError(f"Perfiles no válidos: {'; '.join(errors)}")
+        self.arguments = build_arguments(self.profiles)
+        self.limits = limits
+        self.timeout_seconds = timeout_seconds
+        self.image_engine_workers = image_engine_workers
+        # Con un mínimo, el análisis previo evita ejecutar Ghostscript cuando no hay ganancia esperable
+        self.preflight_min_gain_percent = preflight_min_gain_percent
+
+    @classmethod
+    def from_config(cls, config):
+        """Crear el compresor con las mismas secciones de config.json que usa el servicio"""
+        preflight_config = config.get('preflight', {})
+        return cls(profiles=config.get('profiles', {}),
+                   limits=ResourceLimits.from_config(config.get('ghostscript_limits', {})),
+                   image_engine_workers=config.get('image_engine', {}).get('workers'),
+                   preflight_min_gain_percent=(preflight_config.get('min_gain_percent', 5)
+                                               if preflight_config.get('enabled', True) else None))
+
+    def level(self, level=2, profile=None):
+        """Nivel efectivo: el base del perfil si se indica uno"""
+        if profile is None:
+            return level
+        if profile not in self.profiles:
+            raise ValueError(f"Perfil desconocido: {profile}")
+        return self.profiles[profile].get('level', 2)
+
+    def ghostscript_command(self, level, input_path, output_path, profile=None):
+        """Línea de comandos de Ghostscript para un nivel o, si se indica, un perfil con nombre"""
+        key = profile if profile is not None else level
+        if key not in self.arguments:
+            raise ValueError(f"Nivel o perfil de compresión {key} no válido")
+        prefix, suffix = self.arguments[key]
+        return [*prefix, '-sOutputFile=' + output_path, *suffix, input_path]
+
+    def command(self, input_path, output_path, level=2, profile=None, engine='gs'):
+        """Línea de comandos del motor indicado"""
+        if engine == 'images':
+            return image_engine_command(self.level(level, profile), input_path, output_path,
+                                        self.image_engine_workers)
+        if engine != 'gs':
+            raise ValueError(f"Motor desconocido: {engine}. Disponibles: {', '.join(ENGINES)}")
+        return self.ghostscript_command(level, input_path, output_path, profile)
+
+    def settings_key(self, level=2, profile=None, engine='gs'):
+        """Texto que identifica los ajustes de compresión (para claves de caché y puntos de control)"""
+        level = self.level(level, profile)
+        if engine == 'images':
+            return f"images:{LEVEL_JPEG_QUALITY[level]}:{LEVEL_COLOR_DPI[level]}:{LEVEL_MONO_DPI[level]}"
+        return ' '.join(self.ghostscript_command(level, '{input}', '{output}', profile))
+
+    def run(self, command, cancel_event=None):
+        """Ejecutar una línea de comandos del motor y devolver el resultado de execute()
+
+        Lanza GhostscriptCancelled, TimeoutError, GhostscriptLimitExceeded si el fallo se debe a un límite de
+        recursos, CompressionInputError si el motor rechazó la entrada y CompressionError si lo mató una señal.
+        """
+        try:
+            result = execute(command, self.limits, self.timeout_seconds, cancel_event)
+        except FileNotFoundError:
+            raise CompressionError(f"{command[0]} no está instalado")
+        if result['reason'] == 'cancelled':
+            raise GhostscriptCancelled()
+        if result['reason'] == 'timeout':
+            raise TimeoutError(f"La compresión superó {self.timeout_seconds} s")
+        if result['code'] != 0:
+            if self.limits is not None:
+                limit = self.limits.classify(result['signal'], result['code'], result['stderr'], result['usage'],
+                                             output_size(command))
+                if limit is not None:
+                    raise self.limits.exceeded(limit, result['usage'])
+            error = CompressionError if result['signal'] is not None else CompressionInputError
+            raise error(f"Error al comprimir PDF (código {result['code']}): {result['stderr'].strip()}")
+        return result
+
+    def should_skip(self, input_path, level, profile=None, engine='gs', analysis=None):
+        """True si el análisis previo estima una ganancia menor que preflight_min_gain_percent
+
+        Solo se aplica a los niveles de Ghostscript: la estimación es la de gs. analysis es el resultado de
+        analyze_pdf si ya se hizo; si no, se analiza input_path.
+        """
+        if self.preflight_min_gain_percent is None or profile is not None or engine != 'gs':
+            return False
+        if analysis is None:
+            try:
+                analysis = analyze_pdf(input_path)
+            except (OSError, ValueError):
+                return False
+        return analysis['predicted_gain_percent'][str(level)] < self.preflight_min_gain_percent
+
+    def compress(self, input_path, output_path, level=2, profile=None, engine='gs', keep_smaller=True,
+                 cancel_event=None):
+        """Comprimir input_path en output_path y devolver un resumen
+
+        El resumen incluye original_size, compressed_size, winner ('compressed' u 'original'), skipped,
+        level, profile, engine y usage (None si no se ejecutó el motor). La salida se escribe en un temporal
+        junto a output_path y se renombra al terminar, así que nunca queda un resultado a medias. Con
+        keep_smaller, si el motor no reduce el archivo el resultado es una copia del original.
+        """
+        level = self.level(level, profile)
+        original_size = os.path.getsize(input_path)
+        outcome = {'original_size': original_size, 'winner': 'compressed', 'skipped': False, 'level': level,
+                   'profile': profile, 'engine': engine, 'usage': None}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), prefix='.compress_',
+                                        suffix='.pdf')
+        os.close(fd)
+        try:
+            if self.should_skip(input_path, level, profile, engine):
+                outcome.update(skipped=True, winner='original')
+                shutil.copyfile(input_path, tmp_path)
+            else:
+                result = self.run(self.command(input_path, tmp_path, level, profile, engine), cancel_event)
+                outcome['usage'] = result['usage']
+                if keep_smaller:
+                    outcome['winner'] = keep_smaller_result(input_path, tmp_path, original_size)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        outcome['compressed_size'] = os.path.getsize(output_path)
+        return outcome
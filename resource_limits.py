@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Límites de recursos para las ejecuciones de Ghostscript
+Memoria (RLIMIT_AS), tiempo de CPU (RLIMIT_CPU), tamaño de los archivos escritos (RLIMIT_FSIZE) y
+prioridad de CPU (nice) y de E/S (ioprio), aplicados desde Python al proceso que ejecuta Ghostscript.
+"""
+
+import ctypes
+import math
+import os
+import platform
+import resource
+import signal
+
+# ioprio_set(2) no tiene envoltorio en Python: número de syscall por arquitectura
+_IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# Mensajes de Ghostscript cuando no puede reservar memoria
+_MEMORY_ERRORS = ('VMerror', 'Out of memory', 'Cannot allocate memory')
+# Código gsapi de VMerror
+GS_VMERROR = -25
+# Fracción de memory_mb a partir de la cual el pico de memoria residente de una ejecución fallida
+# se atribuye al límite de memoria
+MEMORY_NEAR_LIMIT_FRACTION = 0.9
+
+LIMIT_NAMES = {'memory': 'memoria', 'cpu': 'tiempo de CPU', 'output_size': 'tamaño de salida'}
+
+# Símbolos ya cargados en el proceso (libc incluida): find_library lanzaría un subproceso al importar el módulo
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _libc = None
+
+
+class GhostscriptLimitExceeded(Exception):
+    """Ghostscript superó uno de los límites de recursos configurados"""
+
+    def __init__(self, limit, limit_value, usage):
+        self.limit = limit
+        self.limit_value = limit_value
+        self.usage = usage
+        super().__init__(f'Ghostscript superó el límite de {LIMIT_NAMES[limit]} ({limit_value})')
+
+    def details(self):
+        """Datos del límite superado para las respuestas JSON"""
+        return {'limit': self.limit, 'limit_value': self.limit_value, 'usage': self.usage}
+
+
+class ResourceLimits:
+    """Límites de una ejecución de Ghostscript; None desactiva cada límite"""
+
+    def __init__(self, memory_mb=None, cpu_seconds=None, output_size_mb=None, nice=None,
+                 ionice_class=None, ionice_level=None):
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.output_size_mb = output_size_mb
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+
+    @classmethod
+    def from_config(cls, limits_config):
+        """Crear los límites a partir de la sección ghostscript_limits de config.json"""
+        return cls(memory_mb=limits_config.get('memory_mb'),
+                   cpu_seconds=limits_config.get('cpu_seconds'),
+                   output_size_mb=limits_config.get('output_size_mb'),
+                   nice=limits_config.get('nice'),
+                   ionice_class=limits_config.get('ionice_class'),
+                   ionice_level=limits_config.get('ionice_level'))
+
+    def limit_value(self, limit):
+        """Valor legible de un límite"""
+        return {'memory': f'{self.memory_mb}MB', 'cpu': f'{self.cpu_seconds}s',
+                'output_size': f'{self.output_size_mb}MB'}[limit]
+
+    def apply(self):
+        """Aplicar todos los límites al proceso actual (preexec_fn de subprocess)
+
+        Solo hace llamadas al sistema: se ejecuta entre fork y exec.
+        """
+        self.apply_worker()
+        if self.cpu_seconds:
+            # El límite blando envía SIGXCPU; el duro (unos segundos después) SIGKILL
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_seconds, self.cpu_seconds + 5))
+
+    def apply_worker(self):
+        """Aplicar los límites que no dependen del trabajo: memoria, salida y prioridad (workers del pool)"""
+        if self.memory_mb:
+            memory_bytes = self.memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+        if self.output_size_mb:
+            output_bytes = self.output_size_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_FSIZE, (output_bytes, output_bytes))
+        if self.nice:
+            os.nice(self.nice)
+        self.apply_io_priority()
+
+    def apply_io_priority(self):
+        """Fijar la prioridad de E/S del proceso actual (equivalente a ionice -c CLASE -n NIVEL)"""
+        syscall_number = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if self.ionice_class is None or _libc is None or syscall_number is None:
+            return
+        priority = (self.ionice_class << IOPRIO_CLASS_SHIFT) | (self.ionice_level or 0)
+        _libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, priority)
+
+    def start_cpu_budget(self):
+        """Límite de CPU para el siguiente trabajo de un proceso de larga duración (pool)
+
+        RLIMIT_CPU cuenta el tiempo acumulado del proceso, así que se desplaza con lo ya consumido.
+        """
+        if not self.cpu_seconds:
+            return
+        used = resource.getrusage(resource.RUSAGE_SELF)
+        soft_limit = math.ceil(used.ru_utime + used.ru_stime + self.cpu_seconds)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, resource.RLIM_INFINITY))
+
+    def classify(self, stop_signal, code, stderr, usage, output_bytes=None):
+        """Determinar qué límite provocó el fallo de una ejecución, o None si no fue un límite"""
+        if stop_signal == signal.SIGXCPU:
+            return 'cpu'
+        if (self.cpu_seconds and stop_signal == signal.SIGKILL
+                and (usage.get('cpu_seconds') or 0) >= self.cpu_seconds):
+            return 'cpu'
+        if stop_signal == signal.SIGXFSZ:
+            return 'output_size'
+        if (self.output_size_mb and output_bytes is not None and code != 0
+                and output_bytes >= self.output_size_mb * 1024 * 1024):
+            return 'output_size'
+        if self.memory_mb and (code == GS_VMERROR or any(message in stderr for message in _MEMORY_ERRORS)):
+            return 'memory'
+        # Un SIGSEGV o SIGABRT sin pico de memoria cerca del límite es un fallo normal de Ghostscript
+        peak_rss_mb = usage.get('peak_rss_mb')
+        if (self.memory_mb and stop_signal is not None and peak_rss_mb is not None
+                and peak_rss_mb >= self.memory_mb * MEMORY_NEAR_LIMIT_FRACTION):
+            return 'memory'
+        return None
+
+    def exceeded(self, limit, usage):
+        """Excepción estructurada para un límite superado"""
+        return GhostscriptLimitExceeded(limit, self.limit_value(limit), usage)
+
+
+def rusage_summary(rusage, wall_seconds):
+    """Pico de memoria residente y CPU de una ejecución a partir de un struct rusage"""
+    return {
+        # En Linux ru_maxrss está en KB
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 2),
+        'wall_seconds': round(wall_seconds, 2)
+    }
+
+
+def reset_peak_rss():
+    """Reiniciar el pico de memoria residente del proceso actual (VmHWM); False si el kernel no lo permite"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def current_peak_rss_mb():
+    """Pico de memoria residente del proceso actual desde el último reinicio, en MB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
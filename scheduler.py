@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Planificador de compresiones con carriles por coste y reparto equitativo entre clientes
+Cada carril (por tamaño y páginas de la entrada) tiene su propio límite de compresiones simultáneas;
+dentro de un carril los clientes se atienden por turnos, una compresión cada vez.
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class SchedulerTimeout(Exception):
+    """La petición no obtuvo turno dentro del tiempo máximo de espera"""
+
+
+class Ticket:
+    """Petición de turno: una compresión síncrona (event) o un trabajo encolado (task)"""
+
+    def __init__(self, client, lane, task=None):
+        self.client = client
+        self.lane = lane
+        self.task = task
+        self.granted = False
+        self.created_at = time.monotonic()
+
+
+class FairScheduler:
+    """Carriles con límite de concurrencia y colas por cliente atendidas en round-robin
+
+    Las compresiones síncronas esperan su turno con slot(); los trabajos encolados con submit() los
+    recogen los workers con next_task() cuando su carril tiene hueco.
+    """
+
+    def __init__(self, lanes, max_queued):
+        self.lanes = lanes
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._running = {lane['name']: 0 for lane in lanes}
+        # carril -> cliente -> tickets pendientes; el orden de los clientes es el turno
+        self._waiting = {lane['name']: OrderedDict() for lane in lanes}
+        self._ready = deque()
+        self._idle_workers = 0
+        self._queued = 0
+
+    def lane_for(self, size_bytes, pages=None):
+        """Carril más barato que admite la entrada; el último carril admite cualquier coste"""
+        for lane in self.lanes:
+            max_bytes = lane.get('max_size_mb')
+            max_pages = lane.get('max_pages')
+            if max_bytes is not None and size_bytes > max_bytes * 1024 * 1024:
+                continue
+            if max_pages is not None and pages is not None and pages > max_pages:
+                continue
+            return lane['name']
+        return self.lanes[-1]['name']
+
+    def _dispatch(self):
+        """Conceder turnos mientras haya hueco; se llama con el lock tomado"""
+        granted = False
+        for lane in self.lanes:
+            name = lane['name']
+            waiting = self._waiting[name]
+            skipped = []
+            while waiting and self._running[name] < lane['concurrency']:
+                client, tickets = waiting.popitem(last=False)
+                ticket = tickets[0]
+                if ticket.task is not None and not self._idle_workers:
+                    # No hay worker libre para el trabajo: el cliente conserva su turno
+                    skipped.append((client, tickets))
+                    if not any(pending[0].task is None for pending in waiting.values()):
+                        break
+                    continue
+                tickets.popleft()
+                if tickets:
+                    waiting[client] = tickets
+                self._running[name] += 1
+                ticket.granted = True
+                granted = True
+                if ticket.task is not None:
+                    self._idle_workers -= 1
+                    self._queued -= 1
+                    self._ready.append(ticket)
+            # Los clientes saltados vuelven al principio, conservando su turno
+            for client, tickets in reversed(skipped):
+                waiting[client] = tickets
+                waiting.move_to_end(client, last=False)
+        if granted:
+            self._cond.notify_all()
+
+    def _enqueue(self, ticket):
+        tickets = self._waiting[ticket.lane].get(ticket.client)
+        if tickets is None:
+            self._waiting[ticket.lane][ticket.client] = deque([ticket])
+        else:
+            tickets.append(ticket)
+
+    def _withdraw(self, ticket):
+        tickets = self._waiting[ticket.lane].get(ticket.client)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._waiting[ticket.lane][ticket.client]
+
+    @contextmanager
+    def slot(self, client, lane, timeout=None):
+        """Esperar turno en el carril para una compresión síncrona; lanza SchedulerTimeout si no llega"""
+        ticket = Ticket(client, lane)
+        with self._cond:
+            self._enqueue(ticket)
+            self._dispatch()
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not ticket.granted:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._withdraw(ticket)
+                    raise SchedulerTimeout(f'Sin turno en el carril {lane} tras {timeout} s')
+                self._cond.wait(remaining)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def submit(self, task, client, lane, timeout=0):
+        """Encolar un trabajo; con timeout=0 lanza queue.Full de inmediato si la cola está llena"""
+        with self._cond:
+            deadline = time.monotonic() + timeout if timeout else None
+            while self._queued >= self.max_queued:
+                remaining = deadline - time.monotonic() if deadline else 0
+                if remaining <= 0:
+                    raise queue.Full()
+                self._cond.wait(remaining)
+            self._queued += 1
+            self._enqueue(Ticket(client, lane, task))
+            self._dispatch()
+
+    def next_task(self):
+        """Bloquear hasta que un trabajo encolado obtenga turno; el worker debe llamar a release() al terminar"""
+        with self._cond:
+            self._idle_workers += 1
+            self._dispatch()
+            while not self._ready:
+                self._cond.wait()
+            return self._ready.popleft()
+
+    def release(self, lane):
+        """Liberar el hueco de una compresión terminada"""
+        with self._cond:
+            self._running[lane] -= 1
+            self._dispatch()
+            # Puede haber hueco en la cola para submit() bloqueados
+            self._cond.notify_all()
+
+    def qsize(self):
+        """Trabajos encolados que aún no han empezado"""
+        with self._cond:
+            return self._queued
+
+    def stats(self):
+        """Compresiones en curso y peticiones en espera por carril"""
+        with self._cond:
+            return {lane['name']: {'running': self._running[lane['name']],
+                                   'waiting': sum(len(tickets) for tickets in self._waiting[lane['name']].values()),
+                                   'clients': len(self._waiting[lane['name']]),
+                                   'concurrency': lane['concurrency']}
+                    for lane in self.lanes}
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Almacenamiento de los resultados comprimidos
+LocalStorage los deja en la carpeta local (un solo nodo), deduplicados por contenido: cada file_id es un enlace
+duro a un blob con nombre SHA-256, así que resultados idénticos ocupan el disco una sola vez. S3Storage los sube a
+un bucket compatible con S3 (AWS, MinIO, Ceph...) para que cualquier réplica detrás del balanceador pueda servir
+un file_id, con subida multiparte, un pool de conexiones y una caché local de lectura para las descargas
+frecuentes.
+"""
+
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Datos del resultado que viajan con el objeto para que otra réplica lo sirva sin consultar su índice
+METADATA_FIELDS = ('filename', 'level', 'original_size', 'compressed_size', 'created_at', 'expires_at', 'sha256')
+MB = 1024 * 1024
+DAY_SECONDS = 24 * 3600
+
+
+def _metadata_name(field):
+    """Nombre del metadato x-amz-meta-*: sin guiones bajos, que algunos proxies y servidores descartan"""
+    return field.replace('_', '-')
+
+
+class StorageError(Exception):
+    """El backend de almacenamiento no está disponible o está mal configurado"""
+
+
+class LocalStorage:
+    """Resultados en una carpeta local; la ubicación de cada resultado es su ruta
+
+    Con deduplicate, la ruta de cada resultado es un enlace duro a .blobs/<sha256>.pdf: las descargas y sendfile
+    siguen usando la ruta del file_id, pero el contenido se guarda una vez. Las referencias de cada blob son las
+    filas del índice con su hash; quien borra la última llama a release_blob.
+    """
+
+    # Otra réplica no puede ver estos archivos: solo sirve el nodo que los generó
+    shared = False
+
+    def __init__(self, folder, deduplicate=True):
+        self.folder = folder
+        self.deduplicate = deduplicate
+        self.blob_folder = os.path.join(folder, '.blobs')
+        os.makedirs(folder, exist_ok=True)
+        if deduplicate:
+            os.makedirs(self.blob_folder, exist_ok=True)
+
+    def put(self, file_id, path, metadata):
+        """Guardar el resultado de path; devuelve su ubicación (la compresión ya lo escribe en la carpeta)"""
+        target = os.path.join(self.folder, os.path.basename(path))
+        if os.path.abspath(path) != os.path.abspath(target):
+            shutil.move(path, target)
+        if self.deduplicate and metadata.get('sha256'):
+            self._link_blob(target, metadata['sha256'])
+        return target
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_folder, f'{sha256}.pdf')
+
+    def _link_blob(self, target, sha256):
+        """Convertir target en un enlace al blob de su contenido, creando el blob si es el primero"""
+        blob_path = self.blob_path(sha256)
+        # Dos intentos: el blob puede desaparecer entre ver que existe y enlazarlo si se libera a la vez
+        for _ in range(2):
+            try:
+                os.link(target, blob_path)
+                return
+            except FileExistsError:
+                pass
+            # Ya hay un resultado idéntico: target pasa a compartir su contenido y su copia se libera
+            link_path = f'{target}.link'
+            try:
+                # Un acierto de la caché puede ser ya el mismo archivo que el blob
+                if os.path.samefile(blob_path, target):
+                    return
+                os.link(blob_path, link_path)
+                os.replace(link_path, target)
+                return
+            except FileNotFoundError:
+                continue
+
+    def release_blob(self, sha256):
+        """Eliminar el blob de un contenido sin referencias; los enlaces que queden (caché) conservan sus datos"""
+        if not self.deduplicate:
+            return False
+        try:
+            os.remove(self.blob_path(sha256))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def head(self, file_id):
+        """Metadatos de un resultado guardado por otra réplica (nunca hay en almacenamiento local)"""
+        return None
+
+    def fetch(self, location, mtime=None):
+        """Ruta local desde la que servir un resultado, o None si ya no existe"""
+        return location if os.path.exists(location) else None
+
+    def delete(self, location):
+        """Eliminar un resultado; devuelve False si ya no existía"""
+        try:
+            os.remove(location)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def cache_size(self):
+        return 0
+
+
+class S3Storage:
+    """Resultados en un bucket compatible con S3 con caché local de lectura
+
+    La ubicación de cada resultado es s3://bucket/prefijo/file_id. Las copias locales de la caché conservan
+    como mtime el instante de creación del resultado (Last-Modified igual en todas las réplicas) y como atime
+    el del último uso, que decide el desalojo.
+    """
+
+    shared = True
+    # Cada file_id es un objeto propio con sus metadatos: otra réplica debe poder servirlo por su clave
+    deduplicate = False
+
+    def __init__(self, bucket, prefix='results/', endpoint_url=None, region=None, addressing_style=None,
+                 max_pool_connections=50, multipart_threshold_mb=8, multipart_chunksize_mb=8,
+                 transfer_concurrency=4, cache_folder='/tmp/storage_cache', cache_max_mb=200):
+        if boto3 is None:
+            raise StorageError('El almacenamiento S3 necesita boto3')
+        if not bucket:
+            raise StorageError('storage.bucket es obligatorio con el backend s3')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_folder = cache_folder
+        self.cache_max_bytes = (cache_max_mb or 0) * MB
+        # Las credenciales se toman de la cadena habitual de boto3 (variables AWS_*, perfil, rol)
+        client_config = Config(max_pool_connections=max_pool_connections,
+                               retries={'max_attempts': 5, 'mode': 'standard'},
+                               s3={'addressing_style': addressing_style or ('path' if endpoint_url else 'auto')})
+        # El cliente es seguro entre hilos: uno por proceso comparte el pool de conexiones
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region, config=client_config)
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold_mb * MB,
+                                              multipart_chunksize=multipart_chunksize_mb * MB,
+                                              max_concurrency=transfer_concurrency)
+        self._evict_lock = threading.Lock()
+        os.makedirs(cache_folder, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, storage_config):
+        """Crear el backend a partir de la sección storage de config.json"""
+        return cls(bucket=os.environ.get('STORAGE_BUCKET') or storage_config.get('bucket'),
+                   prefix=storage_config.get('prefix', 'results/'),
+                   endpoint_url=os.environ.get('STORAGE_ENDPOINT_URL') or storage_config.get('endpoint_url'),
+                   region=storage_config.get('region'),
+                   addressing_style=storage_config.get('addressing_style'),
+                   max_pool_connections=storage_config.get('max_pool_connections', 50),
+                   multipart_threshold_mb=storage_config.get('multipart_threshold_mb', 8),
+                   multipart_chunksize_mb=storage_config.get('multipart_chunksize_mb', 8),
+                   transfer_concurrency=storage_config.get('transfer_concurrency', 4),
+                   cache_folder=storage_config.get('cache_folder', '/tmp/storage_cache'),
+                   cache_max_mb=storage_config.get('cache_max_mb', 200))
+
+    def _key(self, file_id):
+        return f'{self.prefix}{file_id}'
+
+    def _split(self, location):
+        """(bucket, clave) de una ubicación s3://"""
+        bucket, _, key = location[len('s3://'):].partition('/')
+        return bucket, key
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_folder, os.path.basename(key))
+
+    def check(self):
+        """Comprobar al arrancar que el bucket existe y es accesible"""
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except ClientError as e:
+            raise StorageError(f'No se puede acceder al bucket {self.bucket}: {str(e)}')
+
+    def ensure_lifecycle_rule(self, ttl_seconds):
+        """Crear o actualizar la regla de ciclo de vida que expira los objetos de prefix pasado ttl_seconds
+
+        La limpieza de cada nodo solo borra los resultados de su propio índice; la regla borra también los de
+        réplicas que ya no existen. S3 cuenta la caducidad en días enteros, así que un objeto puede seguir en
+        el bucket hasta un día después de su expires_at (/download ya no lo sirve). Las demás reglas del
+        bucket se conservan. Devuelve los días de la regla.
+        """
+        days = max(math.ceil(ttl_seconds / DAY_SECONDS), 1)
+        rule = {'ID': f'pdf-compressor-expiration:{self.prefix}', 'Filter': {'Prefix': self.prefix},
+                'Status': 'Enabled', 'Expiration': {'Days': days},
+                'AbortIncompleteMultipartUpload': {'DaysAfterInitiation': 1}}
+        try:
+            try:
+                rules = self.client.get_bucket_lifecycle_configuration(Bucket=self.bucket)['Rules']
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'NoSuchLifecycleConfiguration':
+                    raise
+                rules = []
+            current = next((existing for existing in rules if existing.get('ID') == rule['ID']), None)
+            if current is None or current.get('Expiration') != rule['Expiration'] or current.get('Status') != 'Enabled':
+                rules = [existing for existing in rules if existing.get('ID') != rule['ID']] + [rule]
+                self.client.put_bucket_lifecycle_configuration(Bucket=self.bucket,
+                                                               LifecycleConfiguration={'Rules': rules})
+        except ClientError as e:
+            raise StorageError(f'No se puede configurar el ciclo de vida del bucket {self.bucket}: {str(e)}')
+        return days
+
+    def put(self, file_id, path, metadata):
+        """Subir el resultado (multiparte si es grande) y dejarlo en la caché local: suele descargarse enseguida"""
+        key = self._key(file_id)
+        self.client.upload_file(path, self.bucket, key, Config=self.transfer_config, ExtraArgs={
+            'ContentType': 'application/pdf',
+            'Metadata': {_metadata_name(field): str(metadata[field])
+                         for field in METADATA_FIELDS if metadata.get(field) is not None}
+        })
+        cache_path = self._cache_path(key)
+        shutil.move(path, cache_path)
+        os.utime(cache_path, (time.time(), metadata['created_at']))
+        self.evict_cache()
+        return f's3://{self.bucket}/{key}'
+
+    def head(self, file_id):
+        """Metadatos de un resultado guardado por cualquier réplica, o None si no existe"""
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._key(file_id))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        metadata = {field: response.get('Metadata', {}).get(_metadata_name(field)) for field in METADATA_FIELDS}
+        if metadata['expires_at'] is None:
+            return None
+        return {
+            'file_id': file_id,
+            'path': f's3://{self.bucket}/{self._key(file_id)}',
+            'filename': metadata.get('filename'),
+            'level': int(metadata['level'] or 0),
+            'original_size': int(metadata['original_size'] or response['ContentLength']),
+            'compressed_size': int(metadata['compressed_size'] or response['ContentLength']),
+            'created_at': float(metadata['created_at'] or response['LastModified'].timestamp()),
+            'expires_at': float(metadata['expires_at']),
+            'sha256': metadata['sha256']
+        }
+
+    def fetch(self, location, mtime=None):
+        """Ruta local desde la que servir un resultado, descargándolo a la caché si no está; None si no existe"""
+        bucket, key = self._split(location)
+        cache_path = self._cache_path(key)
+        now = time.time()
+        try:
+            os.utime(cache_path, (now, os.stat(cache_path).st_mtime))
+            return cache_path
+        except FileNotFoundError:
+            pass
+        # Descarga a un temporal y rename: peticiones simultáneas del mismo resultado no ven archivos a medias
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_folder, prefix='.download_')
+        os.close(fd)
+        try:
+            self.client.download_file(bucket, key, tmp_path, Config=self.transfer_config)
+        except ClientError as e:
+            os.remove(tmp_path)
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        os.utime(tmp_path, (now, mtime if mtime is not None else now))
+        os.replace(tmp_path, cache_path)
+        self.evict_cache()
+        return cache_path
+
+    def delete(self, location):
+        """Eliminar un resultado del bucket y de la caché local"""
+        bucket, key = self._split(location)
+        self.client.delete_object(Bucket=bucket, Key=key)
+        try:
+            os.remove(self._cache_path(key))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def release_blob(self, sha256):
+        return False
+
+    def cache_size(self):
+        """Bytes ocupados por la caché local"""
+        return sum(size for _, _, size in self._cache_entries())
+
+    def _cache_entries(self):
+        entries = []
+        with os.scandir(self.cache_folder) as scan:
+            for entry in scan:
+                try:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        stat = entry.stat()
+                        entries.append((stat.st_atime, entry.path, stat.st_size))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def evict_cache(self):
+        """Eliminar las copias locales usadas hace más tiempo hasta respetar cache_max_mb"""
+        with self._evict_lock:
+            entries = sorted(self._cache_entries())
+            total_size = sum(size for _, _, size in entries)
+            for _, path, size in entries:
+                if total_size <= self.cache_max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+
+def storage_from_config(storage_config, local_folder):
+    """Backend configurado en la sección storage de config.json (local por defecto)"""
+    backend = storage_config.get('backend', 'local')
+    if backend == 'local':
+        return LocalStorage(local_folder, deduplicate=storage_config.get('deduplicate', True))
+    if backend == 's3':
+        return S3Storage.from_config(storage_config)
+    raise StorageError(f'storage.backend debe ser local o s3, no {backend}')
@@ -4,13 +4,65 @@ Script de prueba para el servicio de compresión de PDF
 """
 
 import requests
+import hashlib
+import hmac
+import io
+import json
 import os
 import sys
+import threading
 import time
+import uuid
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 # Configuración
 BASE_URL = "http://localhost:5000"
 TEST_PDF_PATH = "test.pdf"  # Cambiar por la ruta de tu PDF de prueba
+# Host con el que el servicio alcanza el servidor de callbacks de la prueba (host.docker.internal desde Docker)
+CALLBACK_HOST = os.environ.get("CALLBACK_HOST", "127.0.0.1")
+# Debe coincidir con el WEBHOOK_SECRET del servicio para comprobar la firma
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Token de /admin, si el servicio tiene ADMIN_TOKEN
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# Intérprete de Ghostscript que debe usar el servicio: pool (con libgs) o process (sin pool); sin valor no se exige
+EXPECTED_GS_INTERPRETER = os.environ.get("EXPECTED_GS_INTERPRETER")
+# Con FAIL_ON_SKIP=1 las pruebas omitidas (función desactivada en el servicio) cuentan como fallidas
+FAIL_ON_SKIP = os.environ.get("FAIL_ON_SKIP") == "1"
+
+# Resultado de una prueba que no se pudo comprobar con la configuración del servicio: ni superada ni fallida
+SKIPPED = object()
+
+def skip(reason):
+    """Informar de por qué se omite una prueba y devolver SKIPPED"""
+    print(f"⏭️  Omitida: {reason}")
+    return SKIPPED
+
+def minimal_pdf(text, compressed=True):
+    """PDF de una página con solo texto
+
+    Con el stream ya comprimido el análisis previo no espera ganancia. Sin comprimir, Ghostscript lo comprime,
+    pero en un PDF tan pequeño lo que añade (metadatos, recursos) suele pesar más que lo que ahorra.
+    """
+    stream = f"BT /F1 12 Tf 72 770 Td ({text}) Tj ET".encode('ascii')
+    filters = b""
+    if compressed:
+        stream, filters = zlib.compress(stream), b" /Filter /FlateDecode"
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R >>",
+               b"<< /Length %d%s >>\nstream\n%s\nendstream" % (len(stream), filters, stream)]
+    content = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(content))
+        content += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(content)
+    content += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    content += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    content += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return content
 
 def test_health_check():
     """Probar el endpoint de health check"""
@@ -28,6 +80,34 @@ def test_health_check():
         print("❌ No se puede conectar al servicio. ¿Está ejecutándose?")
         return False
 
+def test_readiness():
+    """Probar los endpoints de liveness y readiness"""
+    print("🚦 Probando liveness y readiness...")
+    try:
+        response = requests.get(f"{BASE_URL}/health/live")
+        if response.status_code != 200:
+            print(f"❌ Liveness falló: {response.status_code}")
+            return False
+        
+        response = requests.get(f"{BASE_URL}/health/ready")
+        if response.status_code not in (200, 503):
+            print(f"❌ Readiness respondió {response.status_code}")
+            return False
+        state = response.json()
+        if (response.status_code == 200) != (state['status'] == 'ready'):
+            print(f"❌ El código {response.status_code} no coincide con el estado {state['status']}")
+            return False
+        checks = state['checks']
+        print(f"✅ Readiness: {state['status']} {state['reasons'] or ''}")
+        print(f"   Compresiones: {checks['compressions']['running']}/{checks['compressions']['capacity']}, "
+              f"cola: {checks['queue']['queued']}/{checks['queue']['capacity']}")
+        print(f"   Ghostscript: {checks['ghostscript']['failures']} fallos de {checks['ghostscript']['runs']} "
+              f"ejecuciones recientes")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar la readiness: {str(e)}")
+        return False
+
 def test_compress_pdf(level=1):
     """Probar la compresión de PDF"""
     if not os.path.exists(TEST_PDF_PATH):
@@ -63,6 +143,605 @@ def test_compress_pdf(level=1):
         print(f"❌ Error al comprimir: {str(e)}")
         return None
 
+def test_compress_pdf_async(level=2, timeout=120):
+    """Probar la compresión asíncrona y el seguimiento del trabajo"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return None
+    
+    print(f"⏳ Probando compresión asíncrona con nivel {level}...")
+    
+    try:
+        with open(TEST_PDF_PATH, 'rb') as f:
+            files = {'file': (TEST_PDF_PATH, f, 'application/pdf')}
+            data = {'level': str(level)}
+            response = requests.post(f"{BASE_URL}/compress?async=1", files=files, data=data)
+        
+        if response.status_code == 429:
+            print(f"⚠️  Cola llena, Retry-After: {response.headers.get('Retry-After')}")
+            return None
+        if response.status_code != 202:
+            print(f"❌ Error al encolar: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return None
+        
+        job = response.json()
+        print(f"   Trabajo encolado: {job['job_id']}")
+        
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = requests.get(f"{BASE_URL}{job['status_url']}").json()
+            if status['status'] == 'done':
+                print("✅ Compresión asíncrona exitosa")
+                print(f"   Ratio de compresión: {status['compression_ratio_percent']}%")
+                return status['file_id']
+            if status['status'] == 'failed':
+                print(f"❌ El trabajo falló: {status.get('error')}")
+                return None
+            time.sleep(0.5)
+        
+        print("❌ Timeout esperando el trabajo asíncrono")
+        return None
+        
+    except Exception as e:
+        print(f"❌ Error en compresión asíncrona: {str(e)}")
+        return None
+
+def test_compress_batch(level=2, copies=3):
+    """Probar la compresión por lotes"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+    
+    print(f"📦 Probando compresión por lotes con {copies} archivos...")
+    
+    try:
+        with open(TEST_PDF_PATH, 'rb') as f:
+            content = f.read()
+        files = [('file', (f"lote_{i}.pdf", content, 'application/pdf')) for i in range(copies)]
+        files.append(('file', ('no_es_pdf.txt', b'texto', 'text/plain')))
+        response = requests.post(f"{BASE_URL}/compress/batch", files=files, data={'level': str(level)})
+        
+        if response.status_code != 200:
+            print(f"❌ Error en lote: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            manifest = json.loads(archive.read('manifest.json'))
+        print("✅ Lote procesado")
+        print(f"   Correctos: {manifest['done']}, fallidos: {manifest['failed']}")
+        return manifest['done'] == copies and manifest['failed'] == 1
+        
+    except Exception as e:
+        print(f"❌ Error en lote: {str(e)}")
+        return False
+
+def test_compress_stream(level=2):
+    """Probar el modo stream: el PDF comprimido llega en la respuesta y no queda ningún resultado guardado"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    print(f"🌊 Probando modo stream con nivel {level}...")
+    try:
+        results_before = requests.get(f"{BASE_URL}/storage/stats").json()['results']
+        with open(TEST_PDF_PATH, 'rb') as f:
+            response = requests.post(f"{BASE_URL}/compress?stream=1", files={'file': (TEST_PDF_PATH, f, 'application/pdf')},
+                                     data={'level': str(level)})
+        if response.status_code != 200:
+            print(f"❌ Error en compresión: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        if response.headers.get('Content-Type') != 'application/pdf' or not response.content.startswith(b'%PDF'):
+            print(f"❌ La respuesta no es un PDF: {response.headers.get('Content-Type')}")
+            return False
+        if len(response.content) != int(response.headers['X-Compressed-Size']):
+            print(f"❌ Se recibieron {len(response.content)} bytes, X-Compressed-Size indica "
+                  f"{response.headers['X-Compressed-Size']}")
+            return False
+        results_after = requests.get(f"{BASE_URL}/storage/stats").json()['results']
+        if results_after != results_before:
+            print(f"❌ El modo stream dejó resultados guardados: {results_before} -> {results_after}")
+            return False
+        print("✅ PDF recibido en la respuesta")
+        print(f"   Tamaño original: {response.headers['X-Original-Size']} bytes, "
+              f"comprimido: {response.headers['X-Compressed-Size']} bytes "
+              f"({response.headers['X-Compression-Ratio-Percent']}%)")
+        print(f"   Caché: {response.headers['X-Cached']}, omitida: {response.headers['X-Compression-Skipped']}")
+        return True
+    except Exception as e:
+        print(f"❌ Error en modo stream: {str(e)}")
+        return False
+
+def test_target_size(fraction=0.6):
+    """Probar que target_size_mb converge al nivel de más calidad que cumple el objetivo y, si ninguno lo
+    cumple, devuelve el más pequeño"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    original_mb = os.path.getsize(TEST_PDF_PATH) / (1024 * 1024)
+    print(f"🎯 Probando target_size_mb con el {int(fraction * 100)}% del original...")
+    if original_mb < 1:
+        # Los tamaños de la respuesta están redondeados a centésimas de MB
+        return skip("el PDF de prueba es demasiado pequeño (< 1 MB) para comparar los tamaños de cada nivel")
+    try:
+        # Un objetivo alcanzable y otro imposible
+        for target_size_mb, reachable in ((original_mb * fraction, True), (original_mb / 1000, False)):
+            with open(TEST_PDF_PATH, 'rb') as f:
+                response = requests.post(f"{BASE_URL}/compress", files={'file': (TEST_PDF_PATH, f, 'application/pdf')},
+                                         data={'target_size_mb': str(target_size_mb), 'keep_smaller': '0'})
+            if response.status_code != 200:
+                print(f"❌ Error en compresión: {response.status_code}")
+                print(f"   Respuesta: {response.text}")
+                return False
+            result = response.json()
+            done = {c['level']: c['compressed_size_mb'] for c in result['candidates'] if c['status'] == 'done'}
+            meeting = [level for level, size in sorted(done.items()) if size <= target_size_mb + 0.01]
+            if result['target_met']:
+                if not meeting or result['level'] != meeting[0]:
+                    print(f"❌ Nivel {result['level']} elegido, el de más calidad bajo el objetivo es {meeting[:1]}")
+                    return False
+            elif reachable and meeting:
+                print(f"❌ Objetivo no cumplido aunque los niveles {meeting} lo alcanzan")
+                return False
+            elif done[result['level']] != min(done.values()):
+                print(f"❌ Sin cumplir el objetivo debería devolverse el nivel más pequeño, no el {result['level']}")
+                return False
+            print(f"✅ Objetivo de {round(target_size_mb, 4)} MB: nivel {result['level']} "
+                  f"({'cumple' if result['target_met'] else 'no cumple'})")
+            for candidate in result['candidates']:
+                print(f"   Nivel {candidate['level']}: {candidate['status']} {candidate['compressed_size_mb']} MB")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar target_size_mb: {str(e)}")
+        return False
+
+def test_preflight_skip(level=3):
+    """Probar que el análisis previo omite la compresión de un PDF sin nada que ganar y sirve el original"""
+    print("🩺 Probando el análisis previo con un PDF de solo texto...")
+    content = minimal_pdf(f"preflight {time.time()}")
+    try:
+        response = requests.post(f"{BASE_URL}/compress", files={'file': ('solo_texto.pdf', content, 'application/pdf')},
+                                 data={'level': str(level)})
+        if response.status_code != 200:
+            print(f"❌ Error en compresión: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        result = response.json()
+        if result['analysis'] is None:
+            return skip("el análisis previo está desactivado en el servicio (preflight.enabled)")
+        if not result['skipped'] or result['winner'] != 'original':
+            print(f"❌ La compresión no se omitió: skipped={result['skipped']}, winner={result['winner']}")
+            return False
+        response = requests.get(f"{BASE_URL}/download/{result['file_id']}")
+        if response.status_code != 200 or response.content != content:
+            print("❌ La descarga no es el PDF original")
+            return False
+        print("✅ Compresión omitida, se sirve el original")
+        print(f"   Ganancia estimada: {result['analysis']['predicted_gain_percent']}")
+        print(f"   {result['message']}")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar el análisis previo: {str(e)}")
+        return False
+
+def test_keep_smaller(level=1):
+    """Probar keep_smaller: si la salida de Ghostscript es mayor que la subida se sirve el original"""
+    print("📏 Probando keep_smaller con un PDF pequeño sin comprimir...")
+    content = minimal_pdf(' '.join([f"nunca crece {time.time()}"] * 20), compressed=False)
+    try:
+        responses = {}
+        for keep_smaller in ('0', '1'):
+            response = requests.post(f"{BASE_URL}/compress?stream=1",
+                                     files={'file': ('nunca_crece.pdf', content, 'application/pdf')},
+                                     data={'level': str(level), 'keep_smaller': keep_smaller})
+            if response.status_code != 200:
+                print(f"❌ Error en compresión: {response.status_code}")
+                print(f"   Respuesta: {response.text}")
+                return False
+            if response.headers['X-Compression-Skipped'] == 'true':
+                return skip("el análisis previo omitió la compresión, keep_smaller no interviene")
+            responses[keep_smaller] = response
+        
+        plain, kept = responses['0'], responses['1']
+        original_size = int(plain.headers['X-Original-Size'])
+        grown_size = int(plain.headers['X-Compressed-Size'])
+        if plain.headers['X-Winner'] != 'compressed':
+            print(f"❌ Sin keep_smaller debería servirse la salida de Ghostscript, no {plain.headers['X-Winner']}")
+            return False
+        if int(kept.headers['X-Compressed-Size']) > original_size:
+            print(f"❌ Con keep_smaller el resultado creció: {original_size} -> {kept.headers['X-Compressed-Size']} bytes")
+            return False
+        if grown_size > original_size and (kept.headers['X-Winner'] != 'original' or kept.content != content):
+            print("❌ La salida de Ghostscript es mayor pero no se sirvió el original")
+            return False
+        print(f"   Original: {original_size} bytes, salida de Ghostscript: {grown_size} bytes, "
+              f"servido con keep_smaller: {kept.headers['X-Compressed-Size']} bytes ({kept.headers['X-Winner']})")
+        if grown_size <= original_size:
+            return skip("Ghostscript redujo el PDF, keep_smaller no tuvo que conservar el original")
+        print("✅ Ghostscript hizo crecer el PDF y se sirvió el original")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar keep_smaller: {str(e)}")
+        return False
+
+def test_fair_share(level=2, burst=8, timeout=300):
+    """Probar el reparto por turnos dentro de un carril: el trabajo de un segundo cliente no espera a que
+    terminen todos los que el primero encoló antes"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    print(f"⚖️  Probando reparto equitativo: {burst} trabajos del cliente A y uno del cliente B...")
+    try:
+        with open(TEST_PDF_PATH, 'rb') as f:
+            content = f.read()
+        jobs = {}
+        # Subidas distintas para que no las sirva la caché
+        for i, client in enumerate(['cliente-a'] * burst + ['cliente-b']):
+            response = requests.post(f"{BASE_URL}/compress?async=1", headers={'X-API-Key': f"prueba-{client}"},
+                                     files={'file': (f"{client}_{i}.pdf", content + f"\n% {time.time()} {i}\n".encode('ascii'),
+                                                     'application/pdf')},
+                                     data={'level': str(level)})
+            if response.status_code in (429, 503):
+                print(f"⚠️  Trabajo {i} rechazado ({response.status_code}), el nodo está saturado")
+                continue
+            if response.status_code != 202:
+                print(f"❌ Error al encolar: {response.status_code}")
+                print(f"   Respuesta: {response.text}")
+                return False
+            jobs[response.json()['job_id']] = client
+        b_jobs = [job_id for job_id, client in jobs.items() if client == 'cliente-b']
+        if not b_jobs:
+            print("❌ No se pudo encolar el trabajo del cliente B")
+            return False
+        
+        finished = {}
+        deadline = time.time() + timeout
+        while len(finished) < len(jobs) and time.time() < deadline:
+            for job_id in jobs:
+                if job_id not in finished:
+                    status = requests.get(f"{BASE_URL}/jobs/{job_id}").json()['status']
+                    if status in ('done', 'failed'):
+                        finished[job_id] = time.time()
+            time.sleep(0.2)
+        if len(finished) < len(jobs):
+            print("❌ Timeout esperando los trabajos")
+            return False
+        
+        b_finished = finished[b_jobs[0]]
+        a_after_b = sum(1 for job_id, client in jobs.items() if client == 'cliente-a' and finished[job_id] > b_finished)
+        if a_after_b == 0:
+            if len(set(round(t, 1) for t in finished.values())) == 1:
+                return skip("los trabajos terminaron demasiado rápido para observar el orden; usa un PDF más pesado")
+            print("❌ El trabajo del cliente B esperó a que terminaran todos los del cliente A")
+            return False
+        print("✅ El cliente B obtuvo turno antes de que el cliente A vaciara su cola")
+        print(f"   Trabajos de A terminados después del de B: {a_after_b} de {len(jobs) - 1}")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar el reparto equitativo: {str(e)}")
+        return False
+
+def test_callback(level=2, timeout=120):
+    """Probar la notificación por callback_url con un servidor HTTP local que hace de destinatario"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+    
+    print("📨 Probando notificación por callback_url...")
+    received = []
+    
+    class CallbackHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            received.append((dict(self.headers), body))
+            self.send_response(200)
+            self.end_headers()
+        
+        def log_message(self, *args):
+            pass
+    
+    server = HTTPServer(('0.0.0.0', 0), CallbackHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    callback_url = f"http://{CALLBACK_HOST}:{server.server_port}/callback"
+    
+    try:
+        with open(TEST_PDF_PATH, 'rb') as f:
+            files = {'file': (TEST_PDF_PATH, f, 'application/pdf')}
+            data = {'level': str(level), 'callback_url': callback_url}
+            response = requests.post(f"{BASE_URL}/compress?async=1", files=files, data=data)
+        
+        if response.status_code == 400 and 'no permitido' in response.json()['error']:
+            # Sin allowed_hosts el servicio solo notifica a direcciones públicas
+            return skip(f"el servicio no admite callbacks a {CALLBACK_HOST}; añádelo a webhooks.allowed_hosts")
+        if response.status_code != 202:
+            print(f"❌ Error al encolar: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        job_id = response.json()['job_id']
+        
+        deadline = time.time() + timeout
+        while not received and time.time() < deadline:
+            time.sleep(0.5)
+        if not received:
+            print("❌ No se recibió la notificación")
+            return False
+        
+        headers, body = received[0]
+        payload = json.loads(body)
+        if payload['event'] != 'compression.completed' or payload['file_id'] != job_id:
+            print(f"❌ Notificación inesperada: {payload}")
+            return False
+        if WEBHOOK_SECRET:
+            expected = hmac.new(WEBHOOK_SECRET.encode('utf-8'), f"{headers['X-Webhook-Timestamp']}.".encode('utf-8') + body,
+                                hashlib.sha256).hexdigest()
+            if headers.get('X-Webhook-Signature') != f"sha256={expected}":
+                print("❌ Firma HMAC no válida")
+                return False
+            print("   Firma HMAC válida")
+        print("✅ Notificación recibida")
+        print(f"   Ratio de compresión: {payload['compression_ratio_percent']}%")
+        print(f"   Intento: {headers['X-Webhook-Attempt']}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Error en callback: {str(e)}")
+        return False
+    finally:
+        server.shutdown()
+
+def test_trace(level=2):
+    """Probar la traza detallada y su registro entre las compresiones lentas"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+    
+    request_id = f"test-{int(time.time())}"
+    print(f"🔎 Probando traza con X-Request-ID {request_id}...")
+    try:
+        with open(TEST_PDF_PATH, 'rb') as f:
+            response = requests.post(f"{BASE_URL}/compress?trace=1", headers={'X-Request-ID': request_id},
+                                     files={'file': (TEST_PDF_PATH, f, 'application/pdf')},
+                                     data={'level': str(level)})
+        if response.status_code != 200:
+            print(f"❌ Error en compresión: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        if response.headers.get('X-Request-ID') != request_id:
+            print(f"❌ X-Request-ID no coincide: {response.headers.get('X-Request-ID')}")
+            return False
+        trace = response.json()['trace']
+        print("✅ Traza recibida")
+        print(f"   Duración: {trace['duration_ms']} ms")
+        for span in trace['spans']:
+            print(f"   {span['name']}: {span['duration_ms']} ms")
+        
+        headers = {'X-Admin-Token': ADMIN_TOKEN} if ADMIN_TOKEN else {}
+        response = requests.get(f"{BASE_URL}/admin/slow-jobs", headers=headers)
+        if response.status_code != 200:
+            print(f"❌ Error al consultar /admin/slow-jobs: {response.status_code}")
+            return False
+        slow_jobs = response.json()['slow_jobs']
+        recorded = any(job['request_id'] == request_id for job in slow_jobs)
+        print(f"✅ Compresiones lentas: {len(slow_jobs)} (esta petición {'incluida' if recorded else 'no incluida'})")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar la traza: {str(e)}")
+        return False
+
+def test_ghostscript_pool(level=1):
+    """Probar con qué intérprete se ejecutó Ghostscript: el pool de gsapi o, sin libgs, un proceso por petición"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    print("🔁 Probando el pool de intérpretes Ghostscript...")
+    try:
+        interpreters = []
+        # Subidas distintas para que no las sirva la caché ni las omita el análisis previo
+        for i in range(2):
+            with open(TEST_PDF_PATH, 'rb') as f:
+                content = f.read() + f"\n% pool {time.time()} {i}\n".encode('ascii')
+            response = requests.post(f"{BASE_URL}/compress?trace=1&keep_smaller=0",
+                                     files={'file': (f"pool_{i}.pdf", content, 'application/pdf')},
+                                     data={'level': str(level)})
+            if response.status_code != 200:
+                print(f"❌ Error en compresión: {response.status_code}")
+                print(f"   Respuesta: {response.text}")
+                return False
+            result = response.json()
+            spans = [span for span in result['trace']['spans'] if span['name'] == 'ghostscript']
+            if not spans and not result['skipped']:
+                print("❌ La traza no incluye la ejecución de Ghostscript")
+                return False
+            interpreters.extend(span['interpreter'] for span in spans)
+        if not interpreters:
+            return skip("el análisis previo omitió las compresiones, Ghostscript no llegó a ejecutarse")
+        if not set(interpreters) <= {'pool', 'process'}:
+            print(f"❌ Intérprete desconocido en la traza: {interpreters}")
+            return False
+        # Con el motor gs todas las ejecuciones, también los fragmentos de la compresión paralela, pasan por
+        # run_ghostscript con el pool: solo se ejecutan como proceso si el pool no está disponible
+        if len(set(interpreters)) > 1:
+            print(f"❌ Ejecuciones en el pool y como proceso en las mismas compresiones: {interpreters}")
+            return False
+        if EXPECTED_GS_INTERPRETER and interpreters[0] != EXPECTED_GS_INTERPRETER:
+            print(f"❌ Ghostscript se ejecutó como '{interpreters[0]}' y se esperaba '{EXPECTED_GS_INTERPRETER}'")
+            return False
+        if 'pool' in interpreters:
+            print("✅ Ghostscript ejecutado en el pool de intérpretes")
+        else:
+            print("✅ Ghostscript ejecutado como proceso independiente (pool desactivado o libgs no disponible)")
+        print(f"   Ejecuciones en el pool: {interpreters.count('pool')}, "
+              f"como proceso: {interpreters.count('process')}")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar el pool de Ghostscript: {str(e)}")
+        return False
+
+def test_profiles():
+    """Probar los perfiles de compresión: listado, uso de un perfil configurado y rechazo de combinaciones no válidas"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    print("🎛️  Probando perfiles de compresión...")
+    try:
+        response = requests.get(f"{BASE_URL}/profiles")
+        if response.status_code != 200:
+            print(f"❌ Error al consultar /profiles: {response.status_code}")
+            return False
+        profiles = response.json()['profiles']
+        print(f"   Perfiles: {', '.join(sorted(profiles)) or 'ninguno'}")
+        
+        invalid = [({'profile': 'perfil_inexistente'}, 'perfil desconocido')]
+        if profiles:
+            profile = sorted(profiles)[0]
+            invalid += [({'profile': profile, 'target_size_mb': '1'}, 'perfil con target_size_mb'),
+                        ({'profile': profile, 'engine': 'images'}, 'perfil con el motor de imágenes')]
+        for data, description in invalid:
+            with open(TEST_PDF_PATH, 'rb') as f:
+                response = requests.post(f"{BASE_URL}/compress", files={'file': (TEST_PDF_PATH, f, 'application/pdf')},
+                                         data=data)
+            if response.status_code != 400:
+                print(f"❌ Se esperaba 400 con {description}: {response.status_code}")
+                return False
+            print(f"   {description}: 400 ({response.json()['error']})")
+        if not profiles:
+            print("✅ Perfil desconocido rechazado (no hay perfiles configurados)")
+            return True
+        
+        with open(TEST_PDF_PATH, 'rb') as f:
+            response = requests.post(f"{BASE_URL}/compress", files={'file': (TEST_PDF_PATH, f, 'application/pdf')},
+                                     data={'profile': profile})
+        if response.status_code != 200:
+            print(f"❌ Error en compresión con el perfil {profile}: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        result = response.json()
+        if result['profile'] != profile or not result['compressed_filename'].startswith(f"compressed_{profile}_"):
+            print(f"❌ El resultado no corresponde al perfil {profile}: {result['profile']}, {result['compressed_filename']}")
+            return False
+        print(f"✅ Compresión con el perfil {profile}")
+        print(f"   {result['message']}")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar los perfiles: {str(e)}")
+        return False
+
+def test_image_engine(level=2):
+    """Probar el motor de recompresión de imágenes (engine=images) y el rechazo de un motor desconocido"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    print(f"🖼️  Probando el motor de imágenes con nivel {level}...")
+    try:
+        with open(TEST_PDF_PATH, 'rb') as f:
+            response = requests.post(f"{BASE_URL}/compress", files={'file': (TEST_PDF_PATH, f, 'application/pdf')},
+                                     data={'level': str(level), 'engine': 'motor_inexistente'})
+        if response.status_code != 400:
+            print(f"❌ Se esperaba 400 con un motor desconocido: {response.status_code}")
+            return False
+        
+        with open(TEST_PDF_PATH, 'rb') as f:
+            response = requests.post(f"{BASE_URL}/compress", files={'file': (TEST_PDF_PATH, f, 'application/pdf')},
+                                     data={'level': str(level), 'engine': 'images'})
+        if response.status_code == 400:
+            return skip(f"motor de imágenes no disponible: {response.json()['error']}")
+        if response.status_code != 200:
+            print(f"❌ Error en compresión: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        result = response.json()
+        if result['engine'] != 'images':
+            print(f"❌ La compresión no usó el motor de imágenes: {result['engine']}")
+            return False
+        print("✅ Compresión con el motor de imágenes")
+        print(f"   Tamaño original: {result['original_size_mb']} MB, comprimido: {result['compressed_size_mb']} MB "
+              f"({result['compression_ratio_percent']}%)")
+        print(f"   {result['message']}")
+        return test_download(result['file_id'])
+    except Exception as e:
+        print(f"❌ Error al probar el motor de imágenes: {str(e)}")
+        return False
+
+def test_deduplication(level=3):
+    """Probar que dos subidas idénticas con distinto nombre comparten el resultado almacenado"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+    
+    print("🧬 Probando deduplicación de resultados...")
+    try:
+        for name in ('plantilla_a.pdf', 'plantilla_b.pdf'):
+            with open(TEST_PDF_PATH, 'rb') as f:
+                response = requests.post(f"{BASE_URL}/compress", files={'file': (name, f, 'application/pdf')},
+                                         data={'level': str(level)})
+            if response.status_code != 200:
+                print(f"❌ Error en compresión: {response.status_code}")
+                return False
+        
+        response = requests.get(f"{BASE_URL}/storage/stats")
+        if response.status_code != 200:
+            print(f"❌ Error al consultar /storage/stats: {response.status_code}")
+            return False
+        stats = response.json()
+        if stats['deduplicate'] and stats['shared_contents'] < 1:
+            print("❌ Los resultados idénticos no comparten contenido")
+            return False
+        print("✅ Estadísticas del almacenamiento")
+        print(f"   Resultados: {stats['results']}, contenidos únicos: {stats['unique_contents']}")
+        print(f"   Lógico: {stats['logical_size_mb']} MB, en disco: {stats['stored_size_mb']} MB "
+              f"(ahorro {stats['saved_percent']}%)")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar la deduplicación: {str(e)}")
+        return False
+
+def test_cache(level=2):
+    """Probar que una subida repetida se sirve desde la caché de resultados"""
+    print(f"🗃️  Probando caché de resultados con nivel {level}...")
+    # Sin comprimir, para que el análisis previo no omita la compresión; distinto en cada ejecución, para que
+    # la primera subida no la sirva la caché
+    content = minimal_pdf(' '.join([f"cache {time.time()}"] * 20), compressed=False)
+    try:
+        before = requests.get(f"{BASE_URL}/cache/stats").json()
+        if before['max_size_mb'] == 0:
+            return skip("la caché de resultados está desactivada en el servicio (cache_max_size_mb)")
+        results = []
+        for _ in range(2):
+            response = requests.post(f"{BASE_URL}/compress", files={'file': ('cache.pdf', content, 'application/pdf')},
+                                     data={'level': str(level)})
+            if response.status_code != 200:
+                print(f"❌ Error en compresión: {response.status_code}")
+                print(f"   Respuesta: {response.text}")
+                return False
+            results.append(response.json())
+        if results[0]['cached']:
+            print("❌ La primera subida se sirvió desde la caché")
+            return False
+        if results[0]['skipped']:
+            return skip("el análisis previo omitió la compresión, la caché no interviene")
+        if not results[1]['cached']:
+            print("❌ La segunda subida idéntica no se sirvió desde la caché")
+            return False
+
+        after = requests.get(f"{BASE_URL}/cache/stats").json()
+        if after['hits'] <= before['hits']:
+            print(f"❌ Los aciertos de la caché no aumentaron: {before['hits']} -> {after['hits']}")
+            return False
+        print("✅ Segunda subida servida desde la caché")
+        print(f"   Aciertos: {after['hits']}, fallos: {after['misses']} ({after['hit_ratio_percent']}%)")
+        print(f"   Entradas: {after['entries']}, {after['size_mb']} MB de {after['max_size_mb']} MB")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar la caché: {str(e)}")
+        return False
+
 def test_download(file_id):
     """Probar la descarga del archivo comprimido"""
     if not file_id:
@@ -89,6 +768,124 @@ def test_download(file_id):
         print(f"❌ Error en descarga: {str(e)}")
         return False
 
+def test_index_lookup(file_id):
+    """Probar la búsqueda en el índice de resultados: un file_id registrado se encuentra y uno desconocido da 404"""
+    if not file_id:
+        print("❌ No hay file_id para buscar en el índice")
+        return False
+
+    print("🗂️  Probando búsqueda en el índice de resultados...")
+    try:
+        response = requests.head(f"{BASE_URL}/download/{file_id}")
+        if response.status_code != 200:
+            print(f"❌ El resultado {file_id} no está en el índice: {response.status_code}")
+            return False
+        unknown_id = str(uuid.uuid4())
+        response = requests.get(f"{BASE_URL}/download/{unknown_id}")
+        if response.status_code != 404:
+            print(f"❌ Un file_id desconocido debería dar 404: {response.status_code}")
+            return False
+        print("✅ Índice consultado")
+        print(f"   {file_id}: encontrado, {unknown_id}: 404")
+        return True
+    except Exception as e:
+        print(f"❌ Error al consultar el índice: {str(e)}")
+        return False
+
+def upload_unique(level, tag):
+    """Comprimir una copia de TEST_PDF_PATH con un comentario final distinto (no la sirve la caché ni se deduplica)"""
+    with open(TEST_PDF_PATH, 'rb') as f:
+        content = f.read() + f"\n% {tag} {time.time()}\n".encode('ascii')
+    return requests.post(f"{BASE_URL}/compress", files={'file': (f"{tag}.pdf", content, 'application/pdf')},
+                         data={'level': str(level), 'keep_smaller': '0'})
+
+def test_expiry(level=1, max_wait=30):
+    """Probar la caducidad de los resultados: la descarga se cachea como mucho hasta que caduca y después da 404"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    print("⌛ Probando la caducidad de los resultados...")
+    try:
+        ttl = requests.get(f"{BASE_URL}/storage/stats").json()['result_ttl_seconds']
+        response = upload_unique(level, 'caducidad')
+        if response.status_code != 200:
+            print(f"❌ Error en compresión: {response.status_code}")
+            print(f"   Respuesta: {response.text}")
+            return False
+        file_id = response.json()['file_id']
+        response = requests.head(f"{BASE_URL}/download/{file_id}")
+        max_age = int(response.headers['Cache-Control'].split('max-age=')[1].split(',')[0])
+        if response.status_code != 200 or max_age > ttl:
+            print(f"❌ Descarga {response.status_code} con max-age={max_age}, la caducidad es de {ttl} s")
+            return False
+        print(f"✅ Descarga cacheable {max_age} s de {ttl} s de caducidad")
+        if ttl > max_wait:
+            return skip(f"la caducidad ({ttl} s) es demasiado larga para esperarla (máximo {max_wait} s); "
+                        "arranca el servicio con una result_ttl_seconds corta")
+        
+        time.sleep(ttl + 1)
+        response = requests.get(f"{BASE_URL}/download/{file_id}")
+        if response.status_code != 404:
+            print(f"❌ El resultado caducado sigue disponible: {response.status_code}")
+            return False
+        cleanup = requests.post(f"{BASE_URL}/cleanup").json()
+        print(f"✅ Resultado caducado tras {ttl} s: 404")
+        print(f"   Limpieza: {cleanup['expired']} caducados, {cleanup['evicted']} desalojados")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar la caducidad: {str(e)}")
+        return False
+
+def test_disk_quota(level=1, max_uploads=20):
+    """Probar la cuota de disco: al superarla se desaloja el resultado más antiguo y la ocupación vuelve a la cuota"""
+    if not os.path.exists(TEST_PDF_PATH):
+        print(f"❌ Archivo de prueba no encontrado: {TEST_PDF_PATH}")
+        return False
+
+    print("💾 Probando la cuota de disco de los resultados...")
+    try:
+        stats = requests.get(f"{BASE_URL}/storage/stats").json()
+        if stats['max_disk_mb'] is None:
+            return skip("la cuota de disco está desactivada en el servicio (cleanup.max_disk_mb)")
+        
+        file_ids = []
+        uploaded_mb = 0
+        evicted = False
+        for i in range(max_uploads):
+            response = upload_unique(level, f"cuota_{i}")
+            if response.status_code != 200:
+                print(f"❌ Error en compresión: {response.status_code}")
+                print(f"   Respuesta: {response.text}")
+                return False
+            result = response.json()
+            file_ids.append(result['file_id'])
+            uploaded_mb += result['compressed_size_mb']
+            if requests.head(f"{BASE_URL}/download/{file_ids[0]}").status_code == 404:
+                evicted = True
+                break
+        
+        stats = requests.get(f"{BASE_URL}/storage/stats").json()
+        if stats['stored_size_mb'] > stats['max_disk_mb']:
+            print(f"❌ Ocupación por encima de la cuota: {stats['stored_size_mb']} de {stats['max_disk_mb']} MB")
+            return False
+        if not evicted:
+            if uploaded_mb > stats['max_disk_mb']:
+                print(f"❌ Se subieron {round(uploaded_mb, 2)} MB sin desalojar el resultado más antiguo")
+                return False
+            print(f"✅ Ocupación dentro de la cuota: {stats['stored_size_mb']} de {stats['max_disk_mb']} MB")
+            return skip(f"{max_uploads} resultados ({round(uploaded_mb, 2)} MB) no bastan para superar la cuota; "
+                        "arranca el servicio con una max_disk_mb menor")
+        if requests.head(f"{BASE_URL}/download/{file_ids[-1]}").status_code != 200:
+            print("❌ Se desalojó el resultado recién registrado")
+            return False
+        print(f"✅ Cuota superada tras {len(file_ids)} resultados: se desalojó el más antiguo ({stats['eviction']})")
+        print(f"   Ocupación: {stats['stored_size_mb']} de {stats['max_disk_mb']} MB")
+        return True
+    except Exception as e:
+        print(f"❌ Error al probar la cuota de disco: {str(e)}")
+        return False
+
 def test_cleanup():
     """Probar la limpieza de archivos temporales"""
     print("🧹 Probando limpieza de archivos temporales...")
@@ -113,6 +910,13 @@ def main():
     """Función principal de pruebas"""
     print("🚀 Iniciando pruebas del servicio de compresión de PDF")
     print("=" * 50)
+    results = []
+
+    def run(test, *args):
+        """Ejecutar una prueba y anotar su resultado"""
+        outcome = test(*args)
+        results.append((test.__name__, outcome))
+        return outcome
     
     # Verificar que el servicio esté ejecutándose
     if not test_health_check():
@@ -120,25 +924,101 @@ def main():
         print("   Comando para ejecutar: docker-compose up --build")
         sys.exit(1)
     
+    run(test_readiness)
+    
     print("\n" + "=" * 50)
     
     # Probar compresión con diferentes niveles
     for level in [1, 2, 3]:
         print(f"\n📊 Probando nivel de compresión {level}")
-        file_id = test_compress_pdf(level)
+        file_id = run(test_compress_pdf, level)
         
         if file_id:
             # Probar descarga
-            test_download(file_id)
+            run(test_download, file_id)
         
         print("-" * 30)
     
+    # Probar compresión asíncrona
+    print("\n⏳ Probando modo asíncrono")
+    file_id = run(test_compress_pdf_async)
+    if file_id:
+        run(test_download, file_id)
+        run(test_index_lookup, file_id)
+    
+    # Probar perfiles de compresión
+    print("\n🎛️  Probando perfiles")
+    run(test_profiles)
+
+    # Probar motor de imágenes
+    print("\n🖼️  Probando motor de imágenes")
+    run(test_image_engine)
+
+    # Probar tamaño objetivo
+    print("\n🎯 Probando target_size_mb")
+    run(test_target_size)
+
+    # Probar análisis previo
+    print("\n🩺 Probando análisis previo")
+    run(test_preflight_skip)
+
+    # Probar keep_smaller
+    print("\n📏 Probando keep_smaller")
+    run(test_keep_smaller)
+
+    # Probar modo stream
+    print("\n🌊 Probando modo stream")
+    run(test_compress_stream)
+
+    # Probar reparto equitativo entre clientes
+    print("\n⚖️  Probando reparto equitativo")
+    run(test_fair_share)
+
+    # Probar notificación por callback
+    print("\n📨 Probando callback_url")
+    run(test_callback)
+    
+    # Probar trazas
+    print("\n🔎 Probando trazas")
+    run(test_trace)
+    
+    # Probar compresión por lotes
+    print("\n📦 Probando compresión por lotes")
+    run(test_compress_batch)
+    
+    # Probar pool de intérpretes Ghostscript
+    print("\n🔁 Probando pool de intérpretes Ghostscript")
+    run(test_ghostscript_pool)
+
+    # Probar caché de resultados
+    print("\n🗃️  Probando caché de resultados")
+    run(test_cache)
+
+    # Probar deduplicación
+    print("\n🧬 Probando deduplicación")
+    run(test_deduplication)
+    
+    # Probar caducidad y cuota de disco
+    print("\n⌛ Probando caducidad y cuota de disco")
+    run(test_expiry)
+    run(test_disk_quota)
+    
     # Probar limpieza
     print("\n🧹 Probando limpieza de archivos")
-    test_cleanup()
+    run(test_cleanup)
     
     print("\n" + "=" * 50)
-    print("✅ Pruebas completadas")
+    # Las pruebas devuelven True o un file_id si se superan y False o None si fallan
+    skipped = [name for name, outcome in results if outcome is SKIPPED]
+    failed = [name for name, outcome in results if outcome is not SKIPPED and not outcome]
+    passed = len(results) - len(skipped) - len(failed)
+    print(f"Pruebas completadas: ✅ {passed} superadas, ❌ {len(failed)} fallidas, ⏭️  {len(skipped)} omitidas")
+    if failed:
+        print(f"   Fallidas: {', '.join(failed)}")
+    if skipped:
+        print(f"   Omitidas: {', '.join(skipped)}")
+    if failed or (skipped and FAIL_ON_SKIP):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,47 @@
+"""
+Configuración común de las pruebas sin servicio en marcha
+
+app.py lee config.json del directorio actual al importarse, así que las pruebas se ejecutan desde la raíz
+del repositorio. La app se importa sin hilos de fondo y, en cada prueba, con la base de estado y las carpetas
+en un directorio temporal: las pruebas no tocan el estado de un servicio que esté en marcha en la misma máquina.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Sin limpieza, publicación de la carga ni workers asíncronos al importar app.py
+os.environ['PDF_COMPRESSOR_BACKGROUND_THREADS'] = '0'
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(monkeypatch, tmp_path_factory):
+    """Base de estado, carpetas y almacenamiento de app.py en un directorio temporal (si alguna prueba importó la app)"""
+    service = sys.modules.get('app')
+    if service is None:
+        yield None
+        return
+    from storage import LocalStorage
+
+    # Directorio propio de cada prueba, aparte de su tmp_path
+    state_dir = tmp_path_factory.mktemp('servicio')
+    folders = {name: str(state_dir / name) for name in ('uploads', 'compressed', 'jobs')}
+    cache_folder = os.path.join(folders['compressed'], '.cache')
+    for folder in (*folders.values(), cache_folder):
+        os.makedirs(folder)
+    monkeypatch.setattr(service, 'UPLOAD_FOLDER', folders['uploads'])
+    monkeypatch.setattr(service, 'COMPRESSED_FOLDER', folders['compressed'])
+    monkeypatch.setattr(service, 'JOBS_FOLDER', folders['jobs'])
+    monkeypatch.setattr(service, 'CACHE_FOLDER', cache_folder)
+    monkeypatch.setattr(service, 'STATE_DB', str(state_dir / 'pdf_compressor.db'))
+    monkeypatch.setattr(service, 'CLEANUP_LOCK_FILE', str(state_dir / 'cleanup.lock'))
+    monkeypatch.setattr(service, 'storage', LocalStorage(folders['compressed'],
+                                                         deduplicate=service.storage.deduplicate))
+    service.init_db()
+    yield service
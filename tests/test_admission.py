@@ -0,0 +1,170 @@
+"""
+Pruebas de la readiness y el control de admisión: umbrales, carga sumada entre workers y tasa de fallos de
+Ghostscript compartida en la base de estado
+"""
+
+import json
+import time
+from contextlib import closing
+
+import pytest
+
+import app as service
+from admission import AdmissionController, sum_lane_stats
+from pdf_compression import CompressionInputError
+from resource_limits import GhostscriptLimitExceeded
+
+FOLDERS = {'tmp': '/tmp'}
+OTHER_PID = 2 ** 22 + 7  # pid que no es de este proceso
+
+
+def lane(running=0, waiting=0, concurrency=2, clients=0):
+    return {'running': running, 'waiting': waiting, 'clients': clients, 'concurrency': concurrency}
+
+
+# AdmissionController
+
+def test_ready_when_idle():
+    state = AdmissionController().evaluate({'small': lane()}, 0, 10, FOLDERS, (0, 0))
+    assert state['ready'] is True
+    assert state['reasons'] == []
+
+
+def test_capacity_only_when_every_lane_is_saturated():
+    controller = AdmissionController(max_waiting_per_slot=1)
+    lanes = {'small': lane(running=2, waiting=2), 'large': lane(running=1)}
+    assert controller.evaluate(lanes, 0, 10, FOLDERS, (0, 0))['ready'] is True
+    # La admisión de una petición comprueba solo su carril
+    assert controller.evaluate(lanes, 0, 10, FOLDERS, (0, 0), lane='small')['reasons'] == ['capacity']
+    assert controller.evaluate(lanes, 0, 10, FOLDERS, (0, 0), lane='large')['ready'] is True
+    lanes['large'] = lane(running=2, waiting=2)
+    assert controller.evaluate(lanes, 0, 10, FOLDERS, (0, 0))['reasons'] == ['capacity']
+
+
+def test_queue_and_disk():
+    controller = AdmissionController(max_queue_percent=50, min_free_disk_mb=10 ** 9)
+    state = controller.evaluate({'small': lane()}, 5, 10, FOLDERS, (0, 0))
+    assert state['reasons'] == ['queue', 'disk']
+    assert state['checks']['disk']['folders']['tmp']['ok'] is False
+
+
+def test_ghostscript_failures_need_minimum_runs():
+    controller = AdmissionController(failure_min_runs=10, max_failure_percent=50)
+    assert controller.evaluate({'small': lane()}, 0, 10, FOLDERS, (9, 9))['ready'] is True
+    state = controller.evaluate({'small': lane()}, 0, 10, FOLDERS, (10, 5))
+    assert state['reasons'] == ['ghostscript_failures']
+    assert state['checks']['ghostscript']['failure_percent'] == 50.0
+    assert controller.evaluate({'small': lane()}, 0, 10, FOLDERS, (10, 4))['ready'] is True
+
+
+def test_sum_lane_stats():
+    total = sum_lane_stats([{'small': lane(running=1, waiting=1)},
+                            {'small': lane(running=2), 'large': lane(concurrency=1)}])
+    assert total == {'small': lane(running=3, waiting=1, concurrency=4), 'large': lane(concurrency=1)}
+
+
+# Estado del nodo en la base compartida
+
+@pytest.fixture
+def other_worker():
+    """Carga publicada por otro worker del nodo con el carril pequeño saturado"""
+    lanes = {name: dict(stats, running=stats['concurrency'], waiting=stats['concurrency'] * 10)
+             for name, stats in service.scheduler.stats().items()}
+
+    def publish(updated_at=None):
+        with closing(service.db_connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO worker_load (pid, updated_at, lanes, queued, queue_capacity) '
+                         'VALUES (?, ?, ?, ?, ?)', (OTHER_PID, updated_at or time.time(), json.dumps(lanes), 3, 8))
+
+    return publish
+
+
+def test_node_load_sums_workers(other_worker):
+    other_worker()
+
+    lanes, queued, queue_capacity, webhooks_pending, workers = service.node_load()
+
+    # Este proceso (sin compresiones en curso) y el otro worker
+    assert workers == 2
+    assert queued == 3
+    assert queue_capacity == service.JOB_QUEUE_SIZE + 8
+    for name, stats in service.scheduler.stats().items():
+        assert lanes[name]['concurrency'] == stats['concurrency'] * 2
+        assert lanes[name]['running'] == stats['concurrency']
+
+
+def test_node_load_ignores_stale_workers(other_worker):
+    other_worker(time.time() - service.WORKER_LOAD_STALE_SECONDS - 1)
+    service.node_load()
+
+    with closing(service.db_connect()) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM worker_load WHERE pid = ?', (OTHER_PID,)).fetchone()[0] == 0
+
+
+def test_readiness_is_the_same_from_every_worker(other_worker):
+    other_worker()
+    state = service.readiness()
+    # La otra mitad del nodo está libre: el nodo sigue listo aunque un worker esté saturado
+    assert 'capacity' not in state['reasons']
+    assert state['workers'] == 2
+    response = service.app.test_client().get('/health/ready')
+    assert response.get_json()['checks']['compressions']['capacity'] == state['checks']['compressions']['capacity']
+
+
+# Qué cuenta como fallo de Ghostscript
+
+def test_ghostscript_runs_are_shared():
+    service.record_ghostscript_run(True)
+    service.record_ghostscript_run(False)
+    assert service.ghostscript_runs() == (2, 1)
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """(ejecuciones, fallos) que anota run_ghostscript ante el resultado simulado de una ejecución"""
+    def measure(outcome):
+        recorded = []
+
+        def fake_execute(command, cancel_event=None, use_pool=True):
+            if isinstance(outcome, BaseException):
+                raise outcome
+            return outcome
+        monkeypatch.setattr(service, 'execute_ghostscript', fake_execute)
+        monkeypatch.setattr(service, 'record_ghostscript_run', recorded.append)
+        try:
+            service.run_ghostscript(['gs'])
+        except BaseException:
+            pass
+        return len(recorded), recorded.count(False)
+    return measure
+
+
+def test_success_counts_as_run(runs):
+    assert runs('') == (1, 0)
+
+
+def test_node_failures_count(runs):
+    assert runs(Exception('Timeout al comprimir el PDF')) == (1, 1)
+    assert runs(GhostscriptLimitExceeded('memory', '512MB', {})) == (1, 1)
+    assert runs(Exception('Error al comprimir PDF (Ghostscript terminó por la señal 11): ')) == (1, 1)
+
+
+def test_input_errors_and_cancellations_do_not_count(runs):
+    assert runs(CompressionInputError('Error al comprimir PDF: /syntaxerror')) == (0, 0)
+    assert runs(service.GhostscriptCancelled()) == (0, 0)
+
+
+def test_subprocess_exit_without_signal_is_an_input_error(monkeypatch):
+    monkeypatch.setattr(service, 'get_gs_pool', lambda: None)
+    monkeypatch.setattr(service, 'execute', lambda *args: {
+        'code': 1, 'signal': None, 'stdout': '', 'stderr': 'Error: /syntaxerror in pdfopen', 'reason': None,
+        'usage': {'peak_rss_mb': 10.0, 'cpu_seconds': 0.1, 'wall_seconds': 0.1}})
+    with pytest.raises(CompressionInputError):
+        service.execute_ghostscript(['gs', '-sOutputFile=/tmp/no-existe.pdf', 'in.pdf'])
+
+    monkeypatch.setattr(service, 'execute', lambda *args: {
+        'code': -11, 'signal': 11, 'stdout': '', 'stderr': '', 'reason': None,
+        'usage': {'peak_rss_mb': 10.0, 'cpu_seconds': 0.1, 'wall_seconds': 0.1}})
+    with pytest.raises(Exception, match='señal 11') as error:
+        service.execute_ghostscript(['gs', '-sOutputFile=/tmp/no-existe.pdf', 'in.pdf'])
+    assert not isinstance(error.value, CompressionInputError)
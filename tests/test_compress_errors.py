@@ -0,0 +1,56 @@
+"""
+Pruebas de los errores de /compress: fallos antes y después de aceptar la subida
+"""
+
+import io
+
+import pytest
+
+import app as service
+
+
+@pytest.fixture
+def client():
+    return service.app.test_client()
+
+
+@pytest.fixture
+def notifications(monkeypatch):
+    """Notificaciones que se programarían para callback_url"""
+    sent = []
+    monkeypatch.setattr(service.webhook_sender, 'enqueue', lambda *args: sent.append(args))
+    return sent
+
+
+def compress(client, **data):
+    data = {'file': (io.BytesIO(b'%PDF-1.4\n%%EOF\n'), 'prueba.pdf'), 'level': '2', **data}
+    return client.post('/compress', data=data, content_type='multipart/form-data')
+
+
+def test_failure_before_accepting_the_upload_is_json(client, monkeypatch, notifications):
+    def broken_readiness(lane=None):
+        raise RuntimeError('base de estado no disponible')
+    monkeypatch.setattr(service, 'ADMISSION_ENABLED', True)
+    monkeypatch.setattr(service, 'readiness', broken_readiness)
+
+    response = compress(client, callback_url='https://example.com/webhook')
+
+    assert response.status_code == 500
+    assert response.is_json
+    assert 'base de estado no disponible' in response.get_json()['error']
+    # Sin file_id no hay trabajo que notificar
+    assert notifications == []
+
+
+def test_failure_saving_the_upload_is_json(client, monkeypatch, notifications):
+    def broken_save(file, path):
+        raise OSError('disco lleno')
+    monkeypatch.setattr(service, 'save_upload', broken_save)
+
+    response = compress(client, callback_url='https://example.com/webhook')
+
+    assert response.status_code == 500
+    assert response.get_json()['error'] == 'Error al procesar el archivo: disco lleno'
+    file_id, url, payload = notifications[0]
+    assert url == 'https://example.com/webhook'
+    assert payload['event'] == 'compression.failed' and payload['file_id'] == file_id
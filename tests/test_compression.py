@@ -0,0 +1,323 @@
+"""
+Pruebas de PdfCompressor y de bulk_compress.py con un ejecutor simulado en lugar de Ghostscript
+"""
+
+import argparse
+import json
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import bulk_compress
+import pdf_compression
+from pdf_compression import CompressionError, PdfCompressor
+from resource_limits import GhostscriptLimitExceeded, ResourceLimits
+
+USAGE = {'peak_rss_mb': 50.0, 'cpu_seconds': 0.1, 'wall_seconds': 0.1}
+
+
+class FakeExecutor:
+    """Sustituto de pdf_compression.execute: escribe como salida una fracción de la entrada"""
+
+    def __init__(self, fraction=0.5, code=0, stop_signal=None, stderr='', reason=None):
+        self.fraction = fraction
+        self.code = code
+        self.stop_signal = stop_signal
+        self.stderr = stderr
+        self.reason = reason
+        self.commands = []
+
+    def __call__(self, command, limits=None, timeout=None, cancel_event=None, stdout_marks=None):
+        self.commands.append(command)
+        output_path = next(arg[len('-sOutputFile='):] for arg in command if arg.startswith('-sOutputFile='))
+        with open(command[-1], 'rb') as f:
+            data = f.read()
+        with open(output_path, 'wb') as f:
+            f.write(data[:int(len(data) * self.fraction)] if self.fraction <= 1 else data * int(self.fraction))
+        return {'code': self.code, 'signal': self.stop_signal, 'stdout': '', 'stderr': self.stderr,
+                'usage': dict(USAGE), 'reason': self.reason}
+
+    @property
+    def inputs(self):
+        return sorted(os.path.basename(command[-1]) for command in self.commands)
+
+
+@pytest.fixture
+def executor(monkeypatch):
+    fake = FakeExecutor()
+    monkeypatch.setattr(pdf_compression, 'execute', fake)
+    return fake
+
+
+def write_pdf(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n' + content * 100)
+    return path
+
+
+def analysis(gain):
+    return {'predicted_gain_percent': {'1': gain, '2': gain, '3': gain}}
+
+
+# PdfCompressor
+
+def test_compress_replaces_output_atomically(executor, tmp_path):
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+    output_path = str(tmp_path / 'out.pdf')
+
+    outcome = PdfCompressor().compress(input_path, output_path, level=3)
+
+    assert outcome['winner'] == 'compressed'
+    assert outcome['skipped'] is False
+    assert outcome['usage'] == USAGE
+    assert outcome['compressed_size'] == os.path.getsize(input_path) // 2
+    assert '-dPDFSETTINGS=/screen' in executor.commands[0]
+    assert sorted(os.listdir(tmp_path)) == ['in.pdf', 'out.pdf']
+
+
+def test_compress_keeps_smaller_original(executor, tmp_path):
+    executor.fraction = 2
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+    output_path = str(tmp_path / 'out.pdf')
+
+    outcome = PdfCompressor().compress(input_path, output_path)
+
+    assert outcome['winner'] == 'original'
+    with open(input_path, 'rb') as original, open(output_path, 'rb') as result:
+        assert original.read() == result.read()
+    assert os.path.exists(input_path)
+
+
+def test_compress_without_keep_smaller_returns_larger_output(executor, tmp_path):
+    executor.fraction = 2
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+
+    outcome = PdfCompressor().compress(input_path, str(tmp_path / 'out.pdf'), keep_smaller=False)
+
+    assert outcome['winner'] == 'compressed'
+    assert outcome['compressed_size'] == os.path.getsize(input_path) * 2
+
+
+def test_compress_skipped_by_preflight(executor, tmp_path, monkeypatch):
+    monkeypatch.setattr(pdf_compression, 'analyze_pdf', lambda path: analysis(2.0))
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+
+    outcome = PdfCompressor(preflight_min_gain_percent=5).compress(input_path, str(tmp_path / 'out.pdf'))
+
+    assert outcome['skipped'] is True
+    assert outcome['winner'] == 'original'
+    assert outcome['usage'] is None
+    assert outcome['compressed_size'] == os.path.getsize(input_path)
+    assert executor.commands == []
+
+
+def test_should_skip():
+    compressor = PdfCompressor(profiles={'archivo': {'level': 2, 'image_dpi': 150}}, preflight_min_gain_percent=5)
+    assert compressor.should_skip('x.pdf', 2, analysis=analysis(4.9)) is True
+    assert compressor.should_skip('x.pdf', 2, analysis=analysis(5.0)) is False
+    # La estimación es la de los niveles de Ghostscript: no vale para perfiles ni para el motor por imágenes
+    assert compressor.should_skip('x.pdf', 2, profile='archivo', analysis=analysis(0)) is False
+    assert compressor.should_skip('x.pdf', 2, engine='images', analysis=analysis(0)) is False
+    assert PdfCompressor().should_skip('x.pdf', 2, analysis=analysis(0)) is False
+
+
+def test_should_skip_analyzes_the_input(tmp_path, monkeypatch):
+    compressor = PdfCompressor(preflight_min_gain_percent=5)
+    monkeypatch.setattr(pdf_compression, 'analyze_pdf', lambda path: analysis(1.0))
+    assert compressor.should_skip('x.pdf', 1) is True
+
+    def unreadable(path):
+        raise ValueError('no es un PDF')
+    # Un PDF que no se puede analizar se comprime igualmente
+    monkeypatch.setattr(pdf_compression, 'analyze_pdf', unreadable)
+    assert compressor.should_skip('x.pdf', 1) is False
+
+
+def test_compress_error_leaves_no_output(executor, tmp_path):
+    executor.code, executor.stderr = 1, 'Error: /syntaxerror in pdfopen'
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+
+    with pytest.raises(CompressionError, match='syntaxerror'):
+        PdfCompressor().compress(input_path, str(tmp_path / 'out.pdf'))
+
+    assert os.listdir(tmp_path) == ['in.pdf']
+
+
+def test_compress_memory_limit(executor, tmp_path):
+    executor.code, executor.stderr = 1, 'GPL Ghostscript: VMerror'
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+    compressor = PdfCompressor(limits=ResourceLimits(memory_mb=512))
+
+    with pytest.raises(GhostscriptLimitExceeded) as error:
+        compressor.compress(input_path, str(tmp_path / 'out.pdf'))
+    assert error.value.limit == 'memory'
+
+
+def test_compress_crash_is_not_a_limit(executor, tmp_path):
+    executor.code, executor.stop_signal = -signal.SIGSEGV, signal.SIGSEGV
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+    compressor = PdfCompressor(limits=ResourceLimits(memory_mb=512))
+
+    with pytest.raises(CompressionError):
+        compressor.compress(input_path, str(tmp_path / 'out.pdf'))
+
+
+def test_compress_timeout(executor, tmp_path):
+    executor.reason = 'timeout'
+    input_path = write_pdf(str(tmp_path / 'in.pdf'), b'datos')
+
+    with pytest.raises(TimeoutError):
+        PdfCompressor(timeout_seconds=5).compress(input_path, str(tmp_path / 'out.pdf'))
+    assert os.listdir(tmp_path) == ['in.pdf']
+
+
+def test_profile_validation():
+    with pytest.raises(ValueError, match='Perfiles no válidos'):
+        PdfCompressor(profiles={'roto': {'level': 7}})
+    with pytest.raises(ValueError, match='Perfil desconocido'):
+        PdfCompressor().level(2, 'no-existe')
+
+
+# bulk_compress.py
+
+CONFIG = {'preflight': {'enabled': False}}
+
+
+@pytest.fixture
+def bulk(executor, tmp_path, monkeypatch):
+    """Ejecutar bulk_compress.run con hilos en lugar de procesos, para que usen el ejecutor simulado"""
+    monkeypatch.setattr(bulk_compress, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    input_dir, output_dir = str(tmp_path / 'entrada'), str(tmp_path / 'salida')
+    os.makedirs(input_dir)
+
+    def run(**options):
+        args = argparse.Namespace(input=input_dir, output=output_dir, level=2, profile=None, engine='gs',
+                                  keep_smaller=True, workers=2, manifest=None, progress=False)
+        vars(args).update(options)
+        return bulk_compress.run(args, CONFIG)
+
+    run.input_dir, run.output_dir = input_dir, output_dir
+    run.manifest_path = os.path.join(output_dir, bulk_compress.MANIFEST_NAME)
+    return run
+
+
+def manifest_entries(bulk):
+    with open(bulk.manifest_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_bulk_compresses_tree(bulk, executor):
+    write_pdf(os.path.join(bulk.input_dir, 'a.pdf'), b'a')
+    write_pdf(os.path.join(bulk.input_dir, 'sub', 'b.pdf'), b'b')
+
+    stats = bulk()
+
+    assert stats['compressed'] == 2 and stats['failed'] == 0
+    assert executor.inputs == ['a.pdf', 'b.pdf']
+    assert os.path.exists(os.path.join(bulk.output_dir, 'sub', 'b.pdf'))
+    assert sorted(entry['path'] for entry in manifest_entries(bulk)) == ['a.pdf', os.path.join('sub', 'b.pdf')]
+
+
+def test_bulk_resumes_from_manifest(bulk, executor):
+    for name in ('a', 'b', 'c'):
+        write_pdf(os.path.join(bulk.input_dir, f'{name}.pdf'), name.encode())
+    bulk()
+    # Interrupción: la última línea quedó a medias y c.pdf no llegó a registrarse
+    with open(bulk.manifest_path, encoding='utf-8') as f:
+        lines = f.readlines()
+    entry_c = next(index for index, line in enumerate(lines) if json.loads(line)['path'] == 'c.pdf')
+    del lines[entry_c]
+    with open(bulk.manifest_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+        f.write('{"path": "c.pdf", "sta')
+    executor.commands.clear()
+
+    stats = bulk()
+
+    assert executor.inputs == ['c.pdf']
+    assert stats['skipped'] == 2 and stats['compressed'] == 1
+
+    executor.commands.clear()
+    stats = bulk()
+    assert executor.commands == []
+    assert stats['skipped'] == 3
+
+
+def test_bulk_recompresses_changed_files_and_skips_touched_ones(bulk, executor):
+    path_a = write_pdf(os.path.join(bulk.input_dir, 'a.pdf'), b'a')
+    path_b = write_pdf(os.path.join(bulk.input_dir, 'b.pdf'), b'b')
+    bulk()
+    executor.commands.clear()
+    write_pdf(path_a, b'nuevo contenido')
+    stat_b = os.stat(path_b)
+    os.utime(path_b, (stat_b.st_atime, stat_b.st_mtime + 10))
+
+    stats = bulk()
+
+    assert executor.inputs == ['a.pdf']
+    assert stats['compressed'] == 1 and stats['skipped'] == 1
+    # La fecha nueva queda en el manifiesto: la siguiente vez no hace falta leer b.pdf
+    latest_b = [entry for entry in manifest_entries(bulk) if entry['path'] == 'b.pdf'][-1]
+    assert latest_b['mtime'] == os.stat(path_b).st_mtime
+
+
+def test_bulk_settings_change_recompresses(bulk, executor):
+    write_pdf(os.path.join(bulk.input_dir, 'a.pdf'), b'a')
+    bulk(level=2)
+    executor.commands.clear()
+
+    stats = bulk(level=3)
+
+    assert executor.inputs == ['a.pdf']
+    assert stats['compressed'] == 1
+
+
+def test_bulk_links_identical_inputs(bulk, executor):
+    write_pdf(os.path.join(bulk.input_dir, 'a.pdf'), b'mismo')
+    write_pdf(os.path.join(bulk.input_dir, 'copia', 'a.pdf'), b'mismo')
+    write_pdf(os.path.join(bulk.input_dir, 'z.pdf'), b'mismo')
+    write_pdf(os.path.join(bulk.input_dir, 'otro.pdf'), b'otro')
+
+    stats = bulk()
+
+    assert len(executor.commands) == 2
+    assert stats['compressed'] == 2 and stats['duplicates'] == 2
+    first = os.stat(os.path.join(bulk.output_dir, 'a.pdf'))
+    for duplicate in (os.path.join('copia', 'a.pdf'), 'z.pdf'):
+        assert os.path.samefile(os.path.join(bulk.output_dir, duplicate), os.path.join(bulk.output_dir, 'a.pdf'))
+    assert first.st_nlink == 3
+    statuses = {entry['path']: entry['status'] for entry in manifest_entries(bulk)}
+    assert sorted(statuses.values()) == ['done', 'done', 'duplicate', 'duplicate']
+
+
+def test_bulk_links_inputs_done_in_a_previous_run(bulk, executor):
+    write_pdf(os.path.join(bulk.input_dir, 'a.pdf'), b'mismo')
+    bulk()
+    executor.commands.clear()
+    write_pdf(os.path.join(bulk.input_dir, 'nuevo.pdf'), b'mismo')
+
+    stats = bulk()
+
+    assert executor.commands == []
+    assert stats['duplicates'] == 1 and stats['skipped'] == 1
+    assert manifest_entries(bulk)[-1]['duplicate_of'] == 'a.pdf'
+
+
+def test_bulk_failures_propagate_to_duplicates(bulk, executor):
+    executor.code, executor.stderr = 1, 'Error: /syntaxerror'
+    write_pdf(os.path.join(bulk.input_dir, 'a.pdf'), b'roto')
+    write_pdf(os.path.join(bulk.input_dir, 'b.pdf'), b'roto')
+
+    stats = bulk()
+
+    assert len(executor.commands) == 1
+    assert stats['failed'] == 2
+    assert all(entry['status'] == 'failed' for entry in manifest_entries(bulk))
+
+    # Los fallidos se reintentan en la siguiente ejecución
+    executor.code, executor.stderr = 0, ''
+    stats = bulk()
+    assert stats['compressed'] == 1 and stats['duplicates'] == 1
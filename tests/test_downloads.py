@@ -0,0 +1,169 @@
+"""
+Pruebas de /download: peticiones condicionales (If-None-Match, If-Modified-Since, If-Range) y rangos
+"""
+
+import os
+import uuid
+
+import pytest
+from werkzeug.http import http_date
+
+import app as service
+
+CONTENT = bytes(range(256)) * 8  # 2048 bytes
+SIZE = len(CONTENT)
+
+
+@pytest.fixture
+def client():
+    return service.app.test_client()
+
+
+@pytest.fixture
+def result():
+    """Resultado registrado en el índice (temporal, ver conftest.py) con un contenido conocido"""
+    file_id = str(uuid.uuid4())
+    output_path = os.path.join(service.COMPRESSED_FOLDER, f'{file_id}_prueba.pdf')
+    with open(output_path, 'wb') as f:
+        f.write(CONTENT)
+    service.register_result(file_id, output_path, 2, SIZE * 2, SIZE)
+    return dict(service.lookup_result(file_id))
+
+
+def download(client, result, **headers):
+    return client.get(f"/download/{result['file_id']}", headers=headers)
+
+
+def test_full_download(client, result):
+    response = download(client, result)
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.headers['ETag'] == f"\"{result['sha256']}\""
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_suffix_range(client, result):
+    response = download(client, result, Range='bytes=-500')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {SIZE - 500}-{SIZE - 1}/{SIZE}'
+    assert response.data == CONTENT[-500:]
+
+
+def test_suffix_range_longer_than_file(client, result):
+    response = download(client, result, Range=f'bytes=-{SIZE * 2}')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-{SIZE - 1}/{SIZE}'
+    assert response.data == CONTENT
+
+
+def test_overlapping_ranges_are_merged(client, result):
+    response = download(client, result, Range='bytes=0-99,50-199,200-299')
+    assert response.status_code == 206
+    assert response.headers['Content-Type'] == 'application/pdf'
+    assert response.headers['Content-Range'] == f'bytes 0-299/{SIZE}'
+    assert response.data == CONTENT[:300]
+
+
+def test_unordered_ranges_with_suffix(client, result):
+    response = download(client, result, Range=f'bytes=1500-1599,-{SIZE - 1000},0-9')
+    assert response.status_code == 206
+    boundary = response.headers['Content-Type'].split('boundary=')[1]
+    parts = response.data.split(f'--{boundary}'.encode('ascii'))[1:-1]
+    assert [part.split(b'\r\n\r\n', 1)[1] for part in parts] == [CONTENT[:10] + b'\r\n',
+                                                                 CONTENT[1000:] + b'\r\n']
+
+
+def test_malformed_range_sends_full_file(client, result):
+    response = download(client, result, Range='bytes=100-50')
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_unsatisfiable_range(client, result):
+    response = download(client, result, Range=f'bytes={SIZE}-{SIZE + 100}')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{SIZE}'
+
+
+def test_multipart_byteranges(client, result):
+    response = download(client, result, Range='bytes=0-9,100-149,-20')
+    assert response.status_code == 206
+    content_type = response.headers['Content-Type']
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    boundary = content_type.split('boundary=')[1]
+    body = response.data
+    assert int(response.headers['Content-Length']) == len(body)
+
+    parts = body.split(f'--{boundary}'.encode('ascii'))
+    assert parts[0] == b''
+    assert parts[-1] == b'--\r\n'
+    expected = [(0, 10), (100, 150), (SIZE - 20, SIZE)]
+    assert len(parts[1:-1]) == len(expected)
+    for part, (start, stop) in zip(parts[1:-1], expected):
+        head, data = part.split(b'\r\n\r\n', 1)
+        assert f'Content-Range: bytes {start}-{stop - 1}/{SIZE}'.encode('ascii') in head
+        assert b'Content-Type: application/pdf' in head
+        assert data == CONTENT[start:stop] + b'\r\n'
+
+
+def test_too_many_ranges_send_full_file(client, result):
+    ranges = ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(service.DOWNLOAD_MAX_RANGES + 1))
+    response = download(client, result, Range=f'bytes={ranges}')
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_if_range_with_current_etag(client, result):
+    response = download(client, result, Range='bytes=0-9', **{'If-Range': f"\"{result['sha256']}\""})
+    assert response.status_code == 206
+    assert response.data == CONTENT[:10]
+
+
+def test_if_range_with_stale_etag(client, result):
+    response = download(client, result, Range='bytes=0-9', **{'If-Range': '"version-anterior"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_if_range_with_stale_date(client, result):
+    stale = http_date(os.stat(result['path']).st_mtime - 3600)
+    response = download(client, result, Range='bytes=0-9', **{'If-Range': stale})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_if_none_match(client, result):
+    response = download(client, result, **{'If-None-Match': f"\"{result['sha256']}\""})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == f"\"{result['sha256']}\""
+
+
+def test_if_none_match_weak_comparison(client, result):
+    response = download(client, result, **{'If-None-Match': f"\"otro\", W/\"{result['sha256']}\""})
+    assert response.status_code == 304
+
+
+def test_if_none_match_stale(client, result):
+    response = download(client, result, **{'If-None-Match': '"version-anterior"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_if_modified_since(client, result):
+    last_modified = download(client, result).headers['Last-Modified']
+    response = download(client, result, **{'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+
+
+def test_if_modified_since_older(client, result):
+    older = http_date(os.stat(result['path']).st_mtime - 3600)
+    response = download(client, result, **{'If-Modified-Since': older})
+    assert response.status_code == 200
+
+
+def test_if_none_match_takes_precedence(client, result):
+    last_modified = download(client, result).headers['Last-Modified']
+    response = download(client, result, **{'If-None-Match': '"version-anterior"',
+                                            'If-Modified-Since': last_modified})
+    assert response.status_code == 200
@@ -0,0 +1,76 @@
+"""
+Pruebas de /metrics: agregación entre workers en modo multiproceso y gauges con el total del nodo
+"""
+
+import json
+import subprocess
+import sys
+import time
+from contextlib import closing
+
+import pytest
+from prometheus_client.parser import text_string_to_metric_families
+
+import app as service
+
+OTHER_PID = 999999
+
+# Un worker de Gunicorn que registra un error en el directorio multiproceso compartido
+WORKER_SCRIPT = """
+from prometheus_client import Counter
+Counter('pdf_errors_total', 'Errores por etapa', ['stage']).labels(stage='compress').inc()
+"""
+
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+            for family in text_string_to_metric_families(response.get_data(as_text=True))
+            for sample in family.samples}
+
+
+@pytest.fixture
+def multiproc_dir(monkeypatch, tmp_path):
+    """Directorio multiproceso con las métricas de dos workers que ya escribieron en él"""
+    for _ in range(2):
+        subprocess.run([sys.executable, '-c', WORKER_SCRIPT], check=True,
+                       env={'PROMETHEUS_MULTIPROC_DIR': str(tmp_path)})
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def other_worker():
+    """Carga publicada por otro worker del nodo: compresiones en curso, cola y webhooks pendientes"""
+    lanes = {name: dict(stats, running=1, waiting=2) for name, stats in service.scheduler.stats().items()}
+    with closing(service.db_connect()) as conn, conn:
+        conn.execute('INSERT INTO worker_load (pid, updated_at, lanes, queued, queue_capacity, webhooks_pending) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', (OTHER_PID, time.time(), json.dumps(lanes), 3, 8, 4))
+    return lanes
+
+
+def test_counters_are_summed_across_workers(multiproc_dir):
+    metrics = scrape(service.app.test_client())
+    assert metrics[('pdf_errors_total', (('stage', 'compress'),))] == 2
+
+
+def test_gauges_report_the_whole_node(multiproc_dir, other_worker):
+    metrics = scrape(service.app.test_client())
+
+    assert metrics[('pdf_job_queue_depth', ())] == service.scheduler.qsize() + 3
+    assert metrics[('pdf_webhooks_pending', ())] == service.webhook_sender.pending() + 4
+    for lane, stats in service.scheduler.stats().items():
+        assert metrics[('pdf_scheduler_running', (('lane', lane),))] == stats['running'] + 1
+        assert metrics[('pdf_scheduler_waiting', (('lane', lane),))] == stats['waiting'] + 2
+
+
+def test_stale_workers_are_not_counted(multiproc_dir, other_worker):
+    with closing(service.db_connect()) as conn, conn:
+        conn.execute('UPDATE worker_load SET updated_at = ? WHERE pid = ?',
+                     (time.time() - service.WORKER_LOAD_STALE_SECONDS - 1, OTHER_PID))
+
+    metrics = scrape(service.app.test_client())
+
+    assert metrics[('pdf_job_queue_depth', ())] == service.scheduler.qsize()
+    assert metrics[('pdf_webhooks_pending', ())] == service.webhook_sender.pending()
@@ -0,0 +1,154 @@
+"""
+Pruebas de S3Storage contra un S3 simulado con moto
+"""
+
+import os
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from storage import S3Storage
+
+BUCKET = 'pdf-results'
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def storage(s3, tmp_path):
+    return S3Storage(BUCKET, region='us-east-1', cache_folder=str(tmp_path / 'cache'), cache_max_mb=1)
+
+
+def write_result(folder, name, size=1000):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def metadata(created_at=None, ttl=3600, **fields):
+    created_at = created_at or time.time()
+    return dict({'filename': 'resultado.pdf', 'level': 2, 'original_size': 5000, 'compressed_size': 1000,
+                 'created_at': created_at, 'expires_at': created_at + ttl, 'sha256': 'a' * 64}, **fields)
+
+
+def test_put_uploads_with_metadata_and_keeps_a_cached_copy(s3, storage, tmp_path):
+    path = write_result(str(tmp_path), 'resultado.pdf')
+    with open(path, 'rb') as f:
+        content = f.read()
+    created_at = time.time() - 60
+
+    location = storage.put('id-1', path, metadata(created_at))
+
+    assert location == f's3://{BUCKET}/results/id-1'
+    obj = s3.get_object(Bucket=BUCKET, Key='results/id-1')
+    assert obj['Body'].read() == content
+    assert obj['ContentType'] == 'application/pdf'
+    assert obj['Metadata']['compressed-size'] == '1000'
+    assert obj['Metadata']['sha256'] == 'a' * 64
+    # El archivo de trabajo pasa a la caché local con el instante de creación como mtime
+    assert not os.path.exists(path)
+    cache_path = os.path.join(storage.cache_folder, 'id-1')
+    assert os.stat(cache_path).st_mtime == pytest.approx(created_at)
+
+
+def test_head_returns_the_metadata_of_any_replica(storage, tmp_path):
+    created_at = time.time()
+    storage.put('id-1', write_result(str(tmp_path), 'a.pdf'), metadata(created_at))
+
+    result = storage.head('id-1')
+
+    assert result == {'file_id': 'id-1', 'path': f's3://{BUCKET}/results/id-1', 'filename': 'resultado.pdf',
+                      'level': 2, 'original_size': 5000, 'compressed_size': 1000,
+                      'created_at': pytest.approx(created_at), 'expires_at': pytest.approx(created_at + 3600),
+                      'sha256': 'a' * 64}
+
+
+def test_head_missing_or_foreign_object(s3, storage):
+    assert storage.head('no-existe') is None
+    # Un objeto subido por otro medio no tiene caducidad: no es un resultado
+    s3.put_object(Bucket=BUCKET, Key='results/ajeno', Body=b'%PDF')
+    assert storage.head('ajeno') is None
+
+
+def test_fetch_uses_the_cache_and_downloads_on_miss(storage, tmp_path):
+    path = write_result(str(tmp_path), 'a.pdf')
+    with open(path, 'rb') as f:
+        content = f.read()
+    created_at = time.time() - 120
+    location = storage.put('id-1', path, metadata(created_at))
+    cache_path = os.path.join(storage.cache_folder, 'id-1')
+
+    assert storage.fetch(location, created_at) == cache_path
+
+    # Otra réplica: sin copia local se descarga a la caché conservando el mtime del resultado
+    os.remove(cache_path)
+    assert storage.fetch(location, created_at) == cache_path
+    with open(cache_path, 'rb') as f:
+        assert f.read() == content
+    assert os.stat(cache_path).st_mtime == pytest.approx(created_at)
+    assert not [name for name in os.listdir(storage.cache_folder) if name.startswith('.download_')]
+
+
+def test_fetch_missing_object(storage):
+    assert storage.fetch(f's3://{BUCKET}/results/no-existe') is None
+    assert os.listdir(storage.cache_folder) == []
+
+
+def test_delete_removes_object_and_cached_copy(s3, storage, tmp_path):
+    location = storage.put('id-1', write_result(str(tmp_path), 'a.pdf'), metadata())
+
+    assert storage.delete(location) is True
+
+    assert s3.list_objects_v2(Bucket=BUCKET).get('KeyCount') == 0
+    assert not os.path.exists(os.path.join(storage.cache_folder, 'id-1'))
+    assert storage.head('id-1') is None
+
+
+def test_evict_cache_removes_least_recently_used(storage, tmp_path):
+    now = time.time()
+    for index in range(3):
+        storage.put(f'id-{index}', write_result(str(tmp_path), f'{index}.pdf', 300 * 1024), metadata())
+        os.utime(os.path.join(storage.cache_folder, f'id-{index}'), (now - 100 + index, now))
+    # id-0 se usa de nuevo: pasa a ser la copia más reciente
+    storage.fetch(f's3://{BUCKET}/results/id-0')
+    storage.put('id-3', write_result(str(tmp_path), '3.pdf', 300 * 1024), metadata())
+
+    assert sorted(os.listdir(storage.cache_folder)) == ['id-0', 'id-2', 'id-3']
+    assert storage.cache_size() <= 1 * MB
+    # El objeto desalojado sigue en el bucket
+    assert storage.fetch(f's3://{BUCKET}/results/id-1') is not None
+
+
+def test_lifecycle_rule_matches_result_ttl(s3, storage):
+    s3.put_bucket_lifecycle_configuration(Bucket=BUCKET, LifecycleConfiguration={'Rules': [
+        {'ID': 'otra', 'Filter': {'Prefix': 'logs/'}, 'Status': 'Enabled', 'Expiration': {'Days': 30}}]})
+
+    assert storage.ensure_lifecycle_rule(3600) == 1
+    assert storage.ensure_lifecycle_rule(3 * 24 * 3600 + 1) == 4
+    assert storage.ensure_lifecycle_rule(3 * 24 * 3600 + 1) == 4
+
+    rules = {rule['ID']: rule for rule in s3.get_bucket_lifecycle_configuration(Bucket=BUCKET)['Rules']}
+    assert set(rules) == {'otra', 'pdf-compressor-expiration:results/'}
+    rule = rules['pdf-compressor-expiration:results/']
+    assert rule['Filter'] == {'Prefix': 'results/'}
+    assert rule['Expiration'] == {'Days': 4}
+    assert rule['Status'] == 'Enabled'
+
+
+def test_lifecycle_rule_on_bucket_without_rules(s3, storage):
+    assert storage.ensure_lifecycle_rule(7200) == 1
+    rules = s3.get_bucket_lifecycle_configuration(Bucket=BUCKET)['Rules']
+    assert [rule['ID'] for rule in rules] == ['pdf-compressor-expiration:results/']
@@ -0,0 +1,94 @@
+"""
+Pruebas del modo adaptativo (target_size_mb): orden de los niveles y una sola compresión a la vez
+"""
+
+import os
+import threading
+from contextlib import closing
+
+import pytest
+
+import app as service
+
+ORIGINAL_SIZE = 100 * 1024
+# Tamaño de la salida de cada nivel
+SIZES = {1: 90 * 1024, 2: 50 * 1024, 3: 20 * 1024}
+
+
+@pytest.fixture
+def candidates(monkeypatch):
+    """compress_with_cache simulado: anota el orden de los niveles y cuántos se ejecutan a la vez"""
+    runs = {'levels': [], 'running': 0, 'max_running': 0}
+    lock = threading.Lock()
+
+    def fake_compress(input_path, output_path, level, input_sha256=None, cancel_event=None, **kwargs):
+        with lock:
+            runs['levels'].append(level)
+            runs['running'] += 1
+            runs['max_running'] = max(runs['max_running'], runs['running'])
+        try:
+            with open(output_path, 'wb') as f:
+                f.write(b'0' * SIZES[level])
+        finally:
+            with lock:
+                runs['running'] -= 1
+        return False
+
+    monkeypatch.setattr(service, 'compress_with_cache', fake_compress)
+    return runs
+
+
+@pytest.fixture
+def upload():
+    path = os.path.join(service.UPLOAD_FOLDER, 'entrada.pdf')
+    with open(path, 'wb') as f:
+        f.write(b'0' * ORIGINAL_SIZE)
+    return path
+
+
+def learn(level, target_bytes):
+    """Dar al perfil de la entrada las victorias necesarias para que el nivel cuente como aprendido"""
+    profile = service.adaptive_profile(ORIGINAL_SIZE, target_bytes)
+    with closing(service.db_connect()) as conn, conn:
+        conn.execute('INSERT INTO adaptive_levels (profile, level, wins) VALUES (?, ?, ?)',
+                     (profile, level, service.ADAPTIVE_MIN_WINS))
+
+
+def compress(upload, target_bytes):
+    return service.compress_to_target(upload, 'id', 'entrada.pdf', target_bytes, keep_smaller=False)
+
+
+def test_levels_run_one_at_a_time_from_best_quality(candidates, upload):
+    result = compress(upload, 60 * 1024)
+
+    assert candidates['levels'] == [1, 2]
+    assert candidates['max_running'] == 1
+    assert result['level'] == 2 and result['target_met']
+    assert [c['level'] for c in result['candidates']] == [1, 2]
+    assert not os.path.exists(os.path.join(service.COMPRESSED_FOLDER, 'id_compressed_level_1_entrada.pdf'))
+
+
+def test_unreachable_target_returns_the_smallest(candidates, upload):
+    result = compress(upload, 1024)
+
+    assert candidates['levels'] == [1, 2, 3]
+    assert result['level'] == 3 and not result['target_met']
+
+
+def test_learned_level_that_meets_tries_better_quality(candidates, upload):
+    learn(3, 60 * 1024)
+
+    result = compress(upload, 60 * 1024)
+
+    # El nivel 3 cumple, el 2 también y el 1 ya no
+    assert candidates['levels'] == [3, 2, 1]
+    assert result['level'] == 2
+
+
+def test_learned_level_that_misses_tries_lower_quality(candidates, upload):
+    learn(2, 30 * 1024)
+
+    result = compress(upload, 30 * 1024)
+
+    assert candidates['levels'] == [2, 3]
+    assert result['level'] == 3 and result['target_met']
@@ -0,0 +1,69 @@
+"""
+Pruebas del resumen de la salida de Ghostscript en las trazas detalladas
+"""
+
+import sys
+
+from pdf_compression import execute
+from tracing import parse_ghostscript_output
+
+GS_STDOUT = ('Processing pages 1 through 3.\n'
+             'Page 1\n'
+             'Loading NimbusSans-Regular font from /usr/share/fonts/n019003l.pfb... 4 bytes.\n'
+             'Page 2\n'
+             'Page 3\n')
+
+
+def marks_for(stdout, times):
+    """Marcas de escritura con la salida acumulada hasta cada línea, en los instantes dados"""
+    marks, written = [], 0
+    for line, seconds in zip(stdout.splitlines(keepends=True), times):
+        written += len(line.encode('utf-8'))
+        marks.append((seconds, written))
+    return marks
+
+
+def test_summary_without_marks():
+    summary = parse_ghostscript_output(GS_STDOUT, '**** Warning: An error occurred while reading an XREF table.\n')
+    assert summary['pages'] == 3
+    assert summary['page_range'] == [1, 3]
+    assert summary['fonts_loaded'] == ['NimbusSans-Regular']
+    assert summary['warnings'] == ['Warning: An error occurred while reading an XREF table.']
+    assert 'page_timing' not in summary
+
+
+def test_page_timing_from_marks():
+    marks = marks_for(GS_STDOUT, [0.1, 0.2, 0.3, 1.7, 1.9])
+    summary = parse_ghostscript_output(GS_STDOUT, '', marks, wall_seconds=2.5)
+    assert summary['page_timing'] == {
+        'startup_seconds': 0.2,
+        'pages_timed': 2,
+        'mean_page_seconds': 0.85,
+        'slowest_pages': [{'page': 1, 'seconds': 1.5}, {'page': 2, 'seconds': 0.2}],
+        'finish_seconds': 0.6
+    }
+
+
+def test_page_timing_with_coarse_marks():
+    # Una marca puede cubrir varias líneas: las páginas escritas a la vez comparten instante
+    marks = [(0.5, len('Processing pages 1 through 3.\nPage 1\n')), (1.0, len(GS_STDOUT.encode('utf-8')))]
+    timing = parse_ghostscript_output(GS_STDOUT, '', marks, wall_seconds=1.2)['page_timing']
+    assert timing['startup_seconds'] == 0.5
+    assert timing['slowest_pages'] == [{'page': 1, 'seconds': 0.5}, {'page': 2, 'seconds': 0.0}]
+    assert timing['finish_seconds'] == 0.2
+
+
+def test_execute_marks_output_as_it_is_written():
+    script = ('import sys, time\n'
+              'for page in range(1, 4):\n'
+              '    print(f"Page {page}", flush=True)\n'
+              '    time.sleep(0.3 if page == 1 else 0.05)\n')
+    marks = []
+    result = execute([sys.executable, '-c', script], timeout=30, stdout_marks=marks)
+
+    assert result['code'] == 0
+    timing = parse_ghostscript_output(result['stdout'], result['stderr'], marks,
+                                      result['usage']['wall_seconds'])['page_timing']
+    assert timing['pages_timed'] == 2
+    assert timing['slowest_pages'][0]['page'] == 1
+    assert 0.2 <= timing['slowest_pages'][0]['seconds'] <= 0.6
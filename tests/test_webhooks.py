@@ -0,0 +1,101 @@
+"""
+Pruebas de WebhookSender: destinos permitidos, direcciones no públicas y redirecciones
+"""
+
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import webhooks
+from webhooks import Delivery, InvalidCallbackUrl, WebhookSender
+
+
+@pytest.fixture
+def receiver():
+    """Servidor HTTP local que anota las peticiones; /redirigir responde con una redirección a /destino"""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(self.path)
+            self.rfile.read(int(self.headers['Content-Length']))
+            if self.path == '/redirigir':
+                self.send_response(302)
+                self.send_header('Location', '/destino')
+            else:
+                self.send_response(200)
+            self.end_headers()
+
+        def do_GET(self):
+            # urllib sigue un 302 con GET
+            received.append(self.path)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_port, received
+    server.shutdown()
+    server.server_close()
+
+
+def deliver(sender, url):
+    """Hacer un intento de entrega y devolver los resultados que informa el sender"""
+    results = []
+    sender.on_result = results.append
+    sender._attempt(Delivery('entrega', url, {'event': 'compression.completed'}))
+    return results
+
+
+@pytest.mark.parametrize('url', ['http://127.0.0.1/hook', 'http://10.0.0.5/hook', 'http://169.254.169.254/latest',
+                                 'http://[::1]/hook', 'http://[::ffff:192.168.1.1]/hook', 'ftp://example.com/hook'])
+def test_private_addresses_are_rejected_without_allow_list(url):
+    with pytest.raises(InvalidCallbackUrl):
+        WebhookSender(workers=0).validate_url(url)
+
+
+def test_allow_list_accepts_listed_hosts_only():
+    sender = WebhookSender(workers=0, allowed_hosts=['127.0.0.1'])
+    sender.validate_url('http://127.0.0.1:8000/hook')
+    with pytest.raises(InvalidCallbackUrl):
+        sender.validate_url('https://example.com/hook')
+
+
+def test_names_resolving_to_private_addresses_are_not_contacted(receiver):
+    port, received = receiver
+    sender = WebhookSender(workers=0)
+    # Un nombre pasa la validación; se comprueba la dirección a la que se conecta
+    sender.validate_url(f'http://localhost:{port}/hook')
+
+    assert deliver(sender, f'http://localhost:{port}/hook') == ['failed']
+    assert received == []
+
+
+def test_dns_answer_is_checked_when_connecting(monkeypatch):
+    def rebinding_dns(host, port, *args, **kwargs):
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', port))]
+    monkeypatch.setattr(webhooks.socket, 'getaddrinfo', rebinding_dns)
+
+    with pytest.raises(webhooks.ForbiddenAddress):
+        webhooks.create_public_connection(('hooks.example.com', 443))
+
+
+def test_redirects_are_not_followed(receiver):
+    port, received = receiver
+    sender = WebhookSender(workers=0, allowed_hosts=['127.0.0.1'])
+
+    assert deliver(sender, f'http://127.0.0.1:{port}/redirigir') == ['failed']
+    assert received == ['/redirigir']
+
+
+def test_allow_listed_host_is_delivered(receiver):
+    port, received = receiver
+    sender = WebhookSender(workers=0, allowed_hosts=['127.0.0.1'])
+
+    assert deliver(sender, f'http://127.0.0.1:{port}/hook') == ['delivered']
+    assert received == ['/hook']
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Trazas por petición para diagnosticar compresiones lentas
+Cada petición lleva un identificador (X-Request-ID) que aparece en todos sus logs y una traza con tramos
+cronometrados de cada etapa (subida, análisis, espera de turno, Ghostscript, registro...). La traza activa
+se guarda en una ContextVar: es propia de cada hilo y, bajo gevent, de cada greenlet.
+"""
+
+import bisect
+import contextvars
+import logging
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+# Identificadores aceptados del cliente o del balanceador; cualquier otro se sustituye por uno nuevo
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+# Líneas de Ghostscript que se conservan por categoría en la traza
+MAX_OUTPUT_LINES = 20
+
+_GS_PAGE = re.compile(r'^Page (\d+)$')
+_GS_PAGE_RANGE = re.compile(r'^Processing pages (\d+) through (\d+)\.$')
+_GS_FONT_LOAD = re.compile(r'^Loading (\S+) font from')
+_GS_FONT_SUBSTITUTION = re.compile(r"^(?:Substituting font|Can't find \(or can't open\) font file)")
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def new_request_id(value=None):
+    """El identificador recibido si es válido o uno nuevo"""
+    if value and REQUEST_ID_PATTERN.match(value):
+        return value
+    return uuid.uuid4().hex
+
+
+class Trace:
+    """Tramos cronometrados de una petición o trabajo; verbose también captura la salida de Ghostscript"""
+
+    def __init__(self, request_id, verbose=False):
+        self.request_id = request_id
+        self.verbose = verbose
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans = []
+        self.attributes = {}
+
+    def elapsed(self):
+        """Segundos desde el inicio de la traza"""
+        return time.perf_counter() - self._start
+
+    def add_span(self, name, start, duration, **attributes):
+        """Añadir un tramo ya medido (start en segundos de perf_counter)"""
+        span = {'name': name, 'start_ms': round((start - self._start) * 1000, 1),
+                'duration_ms': round(duration * 1000, 1), **attributes}
+        # Los bloques de la compresión paralela añaden tramos desde varios hilos
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Cronometrar un bloque; los atributos se pueden completar dentro del bloque"""
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.add_span(name, start, time.perf_counter() - start, **attributes)
+
+    def annotate(self, **attributes):
+        """Añadir datos de la petición (nivel, motor, características del PDF...)"""
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start_ms'])
+        return {'request_id': self.request_id, 'duration_ms': round(self.elapsed() * 1000, 1),
+                **self.attributes, 'spans': spans}
+
+
+def current():
+    """Traza activa en este hilo o greenlet, o None"""
+    return _current.get()
+
+
+@contextmanager
+def activate(trace):
+    """Hacer que trace sea la traza activa durante el bloque"""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def start(trace):
+    """Activar una traza hasta llamar a stop() con el token devuelto (hooks de Flask)"""
+    return _current.set(trace)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Cronometrar un bloque en la traza activa; sin traza no hace nada"""
+    trace = current()
+    if trace is None:
+        yield attributes
+        return
+    with trace.span(name, **attributes) as span_attributes:
+        yield span_attributes
+
+
+def record_span(name, start, **attributes):
+    """Añadir a la traza activa un tramo que empezó en start (perf_counter) y termina ahora"""
+    trace = current()
+    if trace is not None:
+        trace.add_span(name, start, time.perf_counter() - start, **attributes)
+
+
+def annotate(**attributes):
+    """Añadir datos a la traza activa, si la hay"""
+    trace = current()
+    if trace is not None:
+        trace.annotate(**attributes)
+
+
+def propagate(function):
+    """Envolver una función para que, ejecutada en otro hilo (pools), use la traza activa al envolverla"""
+    trace = current()
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with activate(trace):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class RequestIdFilter(logging.Filter):
+    """Añadir request_id a los registros de log ('-' fuera de una petición)"""
+
+    def filter(self, record):
+        trace = current()
+        record.request_id = trace.request_id if trace is not None else '-'
+        return True
+
+
+def parse_ghostscript_output(stdout, stderr, stdout_marks=None, wall_seconds=None):
+    """Resumen estructurado de la salida de Ghostscript sin -dQUIET: páginas, fuentes, avisos y errores
+
+    Con stdout_marks (instantes de escritura en stdout, ver pdf_compression.execute) y el tiempo total de la
+    ejecución se añade page_timing con lo que tardó cada página, medido entre las líneas "Page N" consecutivas.
+    """
+    summary = {'pages': 0, 'page_range': None, 'fonts_loaded': [], 'font_substitutions': [], 'warnings': [],
+               'errors': []}
+    # (página, segundos desde el inicio en que apareció su línea "Page N")
+    page_starts = []
+    mark_sizes = [size for _, size in stdout_marks] if stdout_marks else []
+
+    def keep(category, line):
+        if len(summary[category]) < MAX_OUTPUT_LINES:
+            summary[category].append(line)
+
+    def summarize(line, written=None):
+        line = line.strip()
+        if not line:
+            return
+        if _GS_PAGE.match(line):
+            summary['pages'] += 1
+            # La línea estaba escrita en la primera marca que alcanza su último byte
+            index = bisect.bisect_left(mark_sizes, written) if written is not None else len(mark_sizes)
+            if index < len(mark_sizes):
+                page_starts.append((int(_GS_PAGE.match(line).group(1)), stdout_marks[index][0]))
+        elif _GS_PAGE_RANGE.match(line):
+            first, last = _GS_PAGE_RANGE.match(line).groups()
+            summary['page_range'] = [int(first), int(last)]
+        elif _GS_FONT_LOAD.match(line):
+            keep('fonts_loaded', _GS_FONT_LOAD.match(line).group(1))
+        elif _GS_FONT_SUBSTITUTION.match(line):
+            keep('font_substitutions', line)
+        elif '**** Error' in line or line.startswith('Error:'):
+            keep('errors', line.lstrip('* '))
+        elif '**** Warning' in line or line.startswith('****'):
+            keep('warnings', line.lstrip('* '))
+
+    written = 0
+    for line in stdout.splitlines(keepends=True):
+        written += len(line.encode('utf-8'))
+        summarize(line, written)
+    for line in stderr.splitlines():
+        summarize(line)
+    if page_starts and wall_seconds is not None:
+        summary['page_timing'] = page_timing(page_starts, wall_seconds)
+    return summary
+
+
+def page_timing(page_starts, wall_seconds):
+    """Tiempos por página a partir del instante en que Ghostscript empezó cada una
+
+    La última página no se puede separar de la escritura final del PDF (fuentes, imágenes compartidas, tabla
+    de referencias): su tiempo y el de esa escritura van juntos en finish_seconds.
+    """
+    durations = [(page, round(next_start - start, 3))
+                 for (page, start), (_, next_start) in zip(page_starts, page_starts[1:])]
+    slowest = sorted(durations, key=lambda duration: duration[1], reverse=True)[:MAX_OUTPUT_LINES]
+    return {
+        'startup_seconds': page_starts[0][1],
+        'pages_timed': len(durations),
+        'mean_page_seconds': round(sum(seconds for _, seconds in durations) / len(durations), 3) if durations else None,
+        'slowest_pages': [{'page': page, 'seconds': seconds} for page, seconds in slowest],
+        'finish_seconds': round(max(wall_seconds - page_starts[-1][1], 0), 3)
+    }
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Envío de notificaciones (webhooks) al terminar una compresión
+Las entregas se guardan en un heap ordenado por el instante del siguiente intento y las envían unos pocos
+hilos dedicados, con reintentos y backoff exponencial, sin ocupar los workers de compresión.
+Las redirecciones no se siguen y, sin lista de hosts permitidos, solo se conecta a direcciones públicas.
+"""
+
+import hashlib
+import heapq
+import hmac
+import http.client
+import ipaddress
+import itertools
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Respuestas tras las que tiene sentido reintentar; el resto de 4xx son definitivas
+RETRY_STATUS_CODES = {408, 425, 429}
+
+
+class InvalidCallbackUrl(ValueError):
+    """La callback_url no es una URL http(s) válida o su host no está permitido"""
+
+
+class ForbiddenAddress(OSError):
+    """El host de la callback_url resuelve a una dirección privada, de loopback, link-local o reservada"""
+
+
+def is_public_address(address):
+    """True si la IP es enrutable en Internet (ni privada, ni loopback, ni link-local, ni reservada, ni multicast)"""
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def create_public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """socket.create_connection que rechaza el host si alguna de sus direcciones no es pública
+
+    Se comprueban las mismas direcciones a las que se conecta, así que un DNS que cambie de respuesta entre
+    la validación y la conexión no puede llevar la petición a la red interna.
+    """
+    host, port = address
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    for *_, sockaddr in infos:
+        if not is_public_address(sockaddr[0]):
+            raise ForbiddenAddress(f'{host} resuelve a una dirección no pública: {sockaddr[0]}')
+    error = None
+    for family, socktype, proto, _, sockaddr in infos:
+        sock = socket.socket(family, socktype, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    """Conexión HTTP que solo conecta con direcciones públicas"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_public_connection
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    """Conexión HTTPS que solo conecta con direcciones públicas (el certificado se valida con el nombre del host)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_public_connection
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Devolver las redirecciones como HTTPError en lugar de seguirlas (podrían apuntar a la red interna)"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def sign_payload(secret, timestamp, body):
+    """Firma HMAC-SHA256 de '<timestamp>.<cuerpo>' en hexadecimal"""
+    message = f'{timestamp}.'.encode('utf-8') + body
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+class Delivery:
+    """Una notificación pendiente y sus intentos"""
+
+    def __init__(self, delivery_id, url, payload):
+        self.delivery_id = delivery_id
+        self.url = url
+        self.body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.attempts = 0
+
+
+class WebhookSender:
+    """Cola de entregas con reintentos: heap (instante, orden, entrega) atendido por hilos dedicados"""
+
+    def __init__(self, secret=None, workers=2, max_attempts=5, backoff_seconds=2, max_backoff_seconds=300,
+                 timeout_seconds=10, allowed_hosts=None, on_result=None):
+        self.secret = secret
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.allowed_hosts = set(allowed_hosts or [])
+        if self.allowed_hosts:
+            self._opener = urllib.request.build_opener(_NoRedirectHandler)
+        else:
+            # Sin lista de hosts permitidos cualquiera puede elegir el destino: solo direcciones públicas y sin
+            # proxy, para que la comprobación se haga sobre la dirección a la que realmente se conecta
+            self._opener = urllib.request.build_opener(urllib.request.ProxyHandler({}), _NoRedirectHandler,
+                                                       _PublicHTTPHandler, _PublicHTTPSHandler)
+        # on_result(resultado) con 'delivered', 'retry' o 'failed', para métricas
+        self.on_result = on_result
+        self._heap = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def validate_url(self, url):
+        """Comprobar que la URL es http(s) y que su host está en la lista de hosts permitidos o, sin lista,
+        que no es una IP privada, de loopback, link-local o reservada
+
+        Los nombres se resuelven al enviar: una dirección no pública descarta la entrega sin reintentos.
+        """
+        parsed = urlparse(url)
+        hostname = parsed.hostname
+        if parsed.scheme not in ('http', 'https') or not hostname:
+            raise InvalidCallbackUrl('callback_url debe ser una URL http o https')
+        if self.allowed_hosts:
+            if hostname not in self.allowed_hosts:
+                raise InvalidCallbackUrl(f'Host de callback_url no permitido: {hostname}')
+            return
+        try:
+            public = is_public_address(hostname)
+        except ValueError:
+            return
+        if not public:
+            raise InvalidCallbackUrl(f'Host de callback_url no permitido: {hostname} no es una dirección pública')
+
+    def enqueue(self, delivery_id, url, payload):
+        """Programar el envío inmediato de una notificación"""
+        self._schedule(Delivery(delivery_id, url, payload), time.time())
+
+    def _schedule(self, delivery, due_at):
+        with self._cond:
+            heapq.heappush(self._heap, (due_at, next(self._order), delivery))
+            self._cond.notify()
+
+    def pending(self):
+        """Notificaciones pendientes de enviar o de reintentar"""
+        with self._cond:
+            return len(self._heap)
+
+    def _next_due(self):
+        """Bloquear hasta que venza la siguiente entrega y sacarla del heap"""
+        with self._cond:
+            while True:
+                if self._heap:
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self._heap)[2]
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _worker(self):
+        while True:
+            delivery = self._next_due()
+            try:
+                self._attempt(delivery)
+            except Exception as e:
+                logger.error(f"Error inesperado al enviar el webhook {delivery.delivery_id}: {str(e)}")
+
+    def _attempt(self, delivery):
+        """Enviar una notificación y reprogramarla con backoff exponencial si falla de forma recuperable"""
+        delivery.attempts += 1
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'pdf-compressor-webhook/1.0',
+            'X-Webhook-Id': delivery.delivery_id,
+            'X-Webhook-Attempt': str(delivery.attempts),
+            'X-Webhook-Timestamp': timestamp
+        }
+        if self.secret:
+            headers['X-Webhook-Signature'] = f'sha256={sign_payload(self.secret, timestamp, delivery.body)}'
+        request = urllib.request.Request(delivery.url, data=delivery.body, headers=headers, method='POST')
+        try:
+            with self._opener.open(request, timeout=self.timeout_seconds) as response:
+                response.read()
+            self._report('delivered')
+            logger.info(f"Webhook {delivery.delivery_id} entregado en el intento {delivery.attempts}")
+            return
+        except urllib.error.HTTPError as e:
+            # Las redirecciones llegan aquí como 3xx y no se reintentan
+            retryable = e.code >= 500 or e.code in RETRY_STATUS_CODES
+            error = f'HTTP {e.code}'
+        except (urllib.error.URLError, OSError) as e:
+            reason = getattr(e, 'reason', e)
+            retryable = not isinstance(reason, ForbiddenAddress)
+            error = str(reason)
+
+        if not retryable or delivery.attempts >= self.max_attempts:
+            self._report('failed')
+            logger.warning(f"Webhook {delivery.delivery_id} descartado tras {delivery.attempts} intentos: {error}")
+            return
+        # Backoff exponencial con jitter para no sincronizar los reintentos de muchas entregas
+        delay = min(self.backoff_seconds * 2 ** (delivery.attempts - 1), self.max_backoff_seconds)
+        delay *= random.uniform(0.8, 1.2)
+        self._report('retry')
+        logger.info(f"Webhook {delivery.delivery_id} falló ({error}), reintento en {delay:.1f} s")
+        self._schedule(delivery, time.time() + delay)
+
+    def _report(self, result):
+        if self.on_result is not None:
+            self.on_result(result)